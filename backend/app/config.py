@@ -11,6 +11,47 @@ class Settings:
     
     # 模型配置
     MODEL_PATH: str = os.getenv("MODEL_PATH", "./models/test/SmolLM-135M-Instruct")
+    MODEL_PATHS: str = os.getenv("MODEL_PATHS", "")  # 模型ID到本地路径的映射，格式 id=路径,id=路径；未配置的模型ID是默认模型的别名，使用MODEL_PATH
+    MODEL_POOL_MEMORY_MB: int = int(os.getenv("MODEL_POOL_MEMORY_MB", 0))  # 模型池内存预算，超出时卸载最久未使用的模型，0表示不限制
+    MODEL_WARMUP_TOKENS: int = int(os.getenv("MODEL_WARMUP_TOKENS", 8))  # 模型加载后预热生成的token数，0表示不预热
+    MODEL_COMPILE: bool = os.getenv("MODEL_COMPILE", "false").lower() == "true"  # 是否用torch.compile编译模型前向，编译失败时回退到eager
+    COMPILE_BUCKETS: str = os.getenv("COMPILE_BUCKETS", "32,64,128,256,512")  # 编译模式下预填充长度分桶，启动时逐个预热
+    MODEL_PRECISION: str = os.getenv("MODEL_PRECISION", "auto")  # 模型精度: auto/fp32/bf16/int8，auto在CPU上为fp32、GPU上为fp16
+    INFERENCE_BACKEND: str = os.getenv("INFERENCE_BACKEND", "torch")  # 推理后端: torch 或 onnx（ONNX Runtime CPU，加载模型目录下由export_onnx.py导出的onnx子目录）
+    
+    # 推理调度配置
+    MAX_BATCH_SIZE: int = int(os.getenv("MAX_BATCH_SIZE", 8))  # 连续批处理的最大并发序列数
+    INFERENCE_QUEUE_SIZE: int = int(os.getenv("INFERENCE_QUEUE_SIZE", 64))  # 等待队列最大长度，超出时立即拒绝
+    SESSION_KV_CACHE_MB: int = int(os.getenv("SESSION_KV_CACHE_MB", 256))  # 会话KV缓存内存预算，0表示关闭
+    KV_CACHE_MB: int = int(os.getenv("KV_CACHE_MB", 512))  # 分块KV缓存内存池大小（MB），启动时一次性分配
+    KV_BLOCK_SIZE: int = int(os.getenv("KV_BLOCK_SIZE", 16))  # KV缓存每块容纳的token数
+    PREFIX_CACHE_MB: int = int(os.getenv("PREFIX_CACHE_MB", 64))  # 共享系统提示词前缀KV最多占用的缓存池大小（MB），0表示关闭
+    MAX_CONTEXT_TOKENS: int = int(os.getenv("MAX_CONTEXT_TOKENS", 0))  # 模型上下文长度，0表示读取模型配置
+    INFERENCE_WORKERS: int = int(os.getenv("INFERENCE_WORKERS", 0))  # 推理进程数，0表示在API进程内推理
+    WORKER_THREADS: int = int(os.getenv("WORKER_THREADS", 0))  # 每个推理进程的torch线程数，0表示按CPU核数平均分配
+    WORKER_START_TIMEOUT: int = int(os.getenv("WORKER_START_TIMEOUT", 600))  # 等待推理进程加载模型的最长时间（秒）
+    WORKER_CHECK_INTERVAL: float = float(os.getenv("WORKER_CHECK_INTERVAL", 1.0))  # 检查推理进程存活的间隔（秒）
+    WORKER_SESSION_AFFINITY_SIZE: int = int(os.getenv("WORKER_SESSION_AFFINITY_SIZE", 10000))  # 记录会话所在推理进程的最大会话数
+    TORCH_THREADS: int = int(os.getenv("TORCH_THREADS", 0))  # API进程内推理的torch线程数，0表示torch默认
+    TORCH_INTEROP_THREADS: int = int(os.getenv("TORCH_INTEROP_THREADS", 0))  # torch inter-op线程数，0表示torch默认
+    CPU_AFFINITY: str = os.getenv("CPU_AFFINITY", "")  # 推理线程绑定的CPU核，如 0-7 或 0,2,4，为空表示不绑定
+    THREAD_AUTOTUNE: bool = os.getenv("THREAD_AUTOTUNE", "false").lower() == "true"  # 启动时自动测试并选择推理线程数和CPU绑定
+    THREAD_AUTOTUNE_TARGET: str = os.getenv("THREAD_AUTOTUNE_TARGET", "throughput")  # 调优目标：throughput（解码吞吐）或 ttft（首token延迟）
+    THREAD_AUTOTUNE_PATH: str = os.getenv("THREAD_AUTOTUNE_PATH", "./thread_tuning.json")  # 线程调优结果文件，之后启动时直接使用
+    TOKEN_COUNT_CACHE_SIZE: int = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", 10000))  # 单条消息token缓存条数
+    MAX_COMPLETION_CHOICES: int = int(os.getenv("MAX_COMPLETION_CHOICES", 8))  # 单个请求n和best_of的上限
+    BATCH_DIR: str = os.getenv("BATCH_DIR", "./batches")  # 离线批处理任务的输入输出文件目录
+    BATCH_CONCURRENCY: int = int(os.getenv("BATCH_CONCURRENCY", 8))  # 离线批处理同时提交给调度器的请求数
+    MAX_BATCH_FILE_MB: int = int(os.getenv("MAX_BATCH_FILE_MB", 100))  # 离线批处理输入文件的大小上限
+    EMBEDDING_BATCH_SIZE: int = int(os.getenv("EMBEDDING_BATCH_SIZE", 32))  # 向量化时单次前向最多合批的文本数
+    EMBEDDING_POOLING: str = os.getenv("EMBEDDING_POOLING", "mean")  # 隐藏状态池化方式：mean（平均）或 last（最后一个token）
+    EMBEDDING_CACHE_SIZE: int = int(os.getenv("EMBEDDING_CACHE_SIZE", 10000))  # 文本向量的LRU缓存条数，0表示关闭
+    MAX_EMBEDDING_INPUTS: int = int(os.getenv("MAX_EMBEDDING_INPUTS", 2048))  # 单个向量化请求最多包含的文本数
+    RESPONSE_CACHE_SIZE: int = int(os.getenv("RESPONSE_CACHE_SIZE", 1000))  # temperature为0的请求的响应缓存条数，0表示关闭
+    RESPONSE_CACHE_TTL: int = int(os.getenv("RESPONSE_CACHE_TTL", 3600))  # 响应缓存过期时间（秒）
+    RESPONSE_CACHE_PATH: str = os.getenv("RESPONSE_CACHE_PATH", "")  # 响应缓存的SQLite文件路径，为空时只缓存在内存中
+    DRAFT_MODEL_PATH: str = os.getenv("DRAFT_MODEL_PATH", "")  # 推测解码使用的草稿模型路径，为空表示关闭
+    SPECULATIVE_TOKENS: int = int(os.getenv("SPECULATIVE_TOKENS", 4))  # 草稿模型每步提议的token数
     
     # 服务器配置
     HOST: str = os.getenv("HOST", "0.0.0.0")
@@ -5,9 +5,12 @@ from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from prometheus_client import Counter, Histogram, make_asgi_app
 from app.config import settings
-from app.routers import health, models, chat_completions, chat_ws
-from app.routers import sessions, api_keys
-from app.utils import get_logger
+from app.routers import health, models, chat_completions, chat_ws, embeddings
+from app.routers import sessions, api_keys, batches
+from app.models.database import create_tables
+from app.models.model_pool import model_pool
+from app.services.batch_service import batch_runner
+from app.utils import get_logger, get_or_create_metric
 import time
 
 # 配置日志
@@ -22,24 +25,21 @@ async def lifespan(app: FastAPI):
     logger.info(f"应用启动: {settings.PROJECT_NAME} v{settings.VERSION}")
     logger.info(f"模型路径: {settings.MODEL_PATH}")
     logger.info(f"监听地址: {settings.HOST}:{settings.PORT}")
+    # 创建数据表并补齐旧数据库缺少的列，需在批处理执行器读取任务前完成
+    create_tables()
+    # 在后台加载默认模型，服务立即开始接受连接，加载完成前推理接口返回503
+    model_pool.load_in_background()
+    # 继续处理未完成的离线批处理任务
+    batch_runner.start()
     yield
     # 应用关闭事件
+    batch_runner.stop()
+    model_pool.close()
     logger.info("应用关闭")
 
 # 监控指标
-# 使用 prometheus_client 的 REGISTRY 来避免重复注册
-from prometheus_client import REGISTRY
-
-# 检查指标是否已注册，避免重复注册
-try:
-    REQUEST_COUNT = REGISTRY._names_to_collectors["api_requests_total"]
-except KeyError:
-    REQUEST_COUNT = Counter("api_requests_total", "Total API requests", ["method", "endpoint", "status"])
-
-try:
-    REQUEST_LATENCY = REGISTRY._names_to_collectors["api_request_latency_seconds"]
-except KeyError:
-    REQUEST_LATENCY = Histogram("api_request_latency_seconds", "Request latency", ["endpoint"])
+REQUEST_COUNT = get_or_create_metric(Counter, "api_requests_total", "Total API requests", ["method", "endpoint", "status"])
+REQUEST_LATENCY = get_or_create_metric(Histogram, "api_request_latency_seconds", "Request latency", ["endpoint"])
 
 # 创建FastAPI应用
 app = FastAPI(
@@ -118,9 +118,11 @@ app.mount("/metrics", metrics_app)
 app.include_router(health.router, prefix=settings.API_PREFIX)
 app.include_router(models.router, prefix=settings.API_PREFIX)
 app.include_router(chat_completions.router, prefix=settings.API_PREFIX)
+app.include_router(embeddings.router, prefix=settings.API_PREFIX)
 app.include_router(chat_ws.router, prefix=settings.API_PREFIX)
 app.include_router(sessions.router, prefix=settings.API_PREFIX)
 app.include_router(api_keys.router, prefix=settings.API_PREFIX)
+app.include_router(batches.router, prefix=settings.API_PREFIX)
 
 # 添加根路径处理
 @app.get("/")
@@ -34,4 +34,5 @@ async def verify_api_key(request: Request, db: Session = Depends(get_db)):
         raise HTTPException(status_code=401, detail="API Key已被停用")
     
     # 将API Key信息添加到请求状态中
-    request.state.api_key = db_api_key
\ No newline at end of file
+    request.state.api_key = db_api_key
+    return db_api_key
\ No newline at end of file
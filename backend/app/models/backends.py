@@ -0,0 +1,156 @@
+import glob
+import os
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+from app.models.precision import load_dtype, apply_precision, model_size_bytes
+from app.models.thread_tuning import apply_thread_config
+from app.utils import get_logger
+
+logger = get_logger()
+
+BACKENDS = ("torch", "onnx")
+
+
+def load_tokenizer(model_path: str):
+    """加载分词器，没有pad_token时使用eos_token作为pad_token"""
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+def mmap_load_kwargs(model_path: str) -> dict:
+    """优先以内存映射方式加载safetensors权重，避免先把整个权重文件读入内存再复制"""
+    kwargs = {"low_cpu_mem_usage": True}
+    if glob.glob(os.path.join(model_path, "*.safetensors")):
+        kwargs["use_safetensors"] = True
+    return kwargs
+
+
+def _to_cache(legacy):
+    """将 (key, value) 元组形式的KV转换为模型可接收的Cache对象"""
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(legacy)
+    return DynamicCache(legacy)
+
+
+def _to_legacy(cache):
+    """将模型返回的Cache对象转换为 (key, value) 元组形式"""
+    if isinstance(cache, tuple):
+        return cache
+    if hasattr(cache, "to_legacy_cache"):
+        return cache.to_legacy_cache()
+    return tuple((layer.keys, layer.values) for layer in cache.layers)
+
+
+def resolve_backend(name: str) -> str:
+    """校验推理后端配置，未知的后端回退到torch"""
+    name = (name or "torch").lower()
+    if name not in BACKENDS:
+        logger.warning(f"未知的推理后端 {name}，可选值: {', '.join(BACKENDS)}，回退到torch")
+        return "torch"
+    return name
+
+
+class InferenceBackend:
+    """推理后端接口
+
+    调度器只通过这里的方法运行模型：prefill把一段新token接在已有KV之后做前向，decode_step为一批序列各解码一个token。
+    KV（缓存句柄）统一为每层一个 (key, value) torch张量的元组，形状为 (batch, heads, 长度, dim)，
+    由调度器写入分块KV缓存池，因此连续批处理、共享前缀缓存和会话缓存对所有后端都生效。
+    """
+
+    name = ""
+    version = ""
+    supports_embeddings = False  # 是否提供embed（最后一层隐藏状态），不支持时 /embeddings 返回501
+    model = None  # 底层的transformers模型，只有torch后端提供（草稿模型和torch.compile依赖它）
+    tokenizer = None
+    config = None
+    generation_config = None
+    device = torch.device("cpu")
+
+    @property
+    def max_positions(self):
+        """模型支持的最大位置数，未知时为无穷大"""
+        return getattr(self.config, "max_position_embeddings", None) or float("inf")
+
+    @property
+    def memory_bytes(self) -> int:
+        """模型权重占用的内存"""
+        return 0
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor = None, position_ids: torch.Tensor = None,
+                past=None):
+        """对input_ids做一次前向，past为已有的KV（None表示没有），返回 (所有位置的logits, 包含本次输入的KV)"""
+        raise NotImplementedError
+
+    def prefill(self, input_ids: torch.Tensor, past=None):
+        """预填充：input_ids的每行接在past（各行长度相同）之后"""
+        attention_mask = None
+        if past is not None:
+            attention_mask = torch.ones((input_ids.shape[0], past[0][0].shape[2] + input_ids.shape[1]),
+                                        dtype=torch.long, device=input_ids.device)
+        return self.forward(input_ids, attention_mask, past=past)
+
+    def decode_step(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, position_ids: torch.Tensor, past):
+        """解码一步：每行一个token，past为左填充后拼成的批次KV，attention_mask屏蔽填充位置"""
+        return self.forward(input_ids, attention_mask, position_ids, past)
+
+    def embed(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        """返回最后一层隐藏状态，形状为 (batch, 长度, hidden)"""
+        raise NotImplementedError(f"{self.name}推理后端不支持向量化")
+
+    def apply_thread_config(self, config: dict):
+        """在当前（推理）线程应用线程配置"""
+        apply_thread_config(config)
+
+
+class TorchBackend(InferenceBackend):
+    """基于transformers模型的推理后端"""
+
+    name = "torch"
+    version = f"torch-{torch.__version__}"
+    supports_embeddings = True
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.config = getattr(model, "config", None)
+        self.generation_config = getattr(model, "generation_config", None)
+
+    @classmethod
+    def load(cls, model_path: str, precision: str) -> "TorchBackend":
+        """加载模型和分词器，并应用精度模式"""
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            dtype=load_dtype(precision),
+            device_map="auto" if torch.cuda.is_available() else None,
+            trust_remote_code=True,
+            **mmap_load_kwargs(model_path)
+        )
+        model.eval()
+        return cls(apply_precision(model, precision), load_tokenizer(model_path))
+
+    @property
+    def device(self):
+        return self.model.device
+
+    @property
+    def memory_bytes(self) -> int:
+        return model_size_bytes(self.model)
+
+    def forward(self, input_ids, attention_mask=None, position_ids=None, past=None):
+        forward_kwargs = {"input_ids": input_ids, "use_cache": True}
+        if attention_mask is not None:
+            forward_kwargs["attention_mask"] = attention_mask
+        if position_ids is not None:
+            forward_kwargs["position_ids"] = position_ids
+        if past is not None:
+            forward_kwargs["past_key_values"] = _to_cache(past)
+        outputs = self.model(**forward_kwargs)
+        return outputs.logits, _to_legacy(outputs.past_key_values)
+
+    def embed(self, input_ids, attention_mask):
+        # 只运行不含输出层的基座模型，与生成共用同一份权重
+        return self.model.base_model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
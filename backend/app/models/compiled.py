@@ -0,0 +1,55 @@
+import torch
+from app.utils import get_logger
+
+logger = get_logger()
+
+
+def parse_buckets(value: str) -> list:
+    """解析 COMPILE_BUCKETS 配置，返回从小到大排序的预填充长度分桶"""
+    buckets = set()
+    for item in (value or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            length = int(item)
+        except ValueError:
+            logger.warning(f"忽略格式错误的预填充分桶: {item}")
+            continue
+        if length > 0:
+            buckets.add(length)
+    return sorted(buckets)
+
+
+def bucket_length(length: int, buckets: list) -> int:
+    """返回不小于length的最小分桶长度，超出最大分桶时返回length本身"""
+    for bucket in buckets:
+        if bucket >= length:
+            return bucket
+    return length
+
+
+def compile_model(model):
+    """用torch.compile编译模型前向（动态形状），返回原eager前向以便编译失败时恢复
+
+    编译在首次调用时才真正发生，调用方需要随后执行预热。运行中遇到新形状重新编译失败或编译后的前向出错时，
+    恢复eager前向并重试本次调用，之后不再使用编译后的前向。
+    """
+    eager_forward = model.forward
+    compiled_forward = torch.compile(eager_forward, dynamic=True)
+
+    def forward(*args, **kwargs):
+        past = kwargs.get("past_key_values")
+        past_len = past.get_seq_length() if hasattr(past, "get_seq_length") else None
+        try:
+            return compiled_forward(*args, **kwargs)
+        except Exception as e:
+            logger.warning(f"编译后的模型前向失败，回退到eager模式: {str(e)}")
+            model.forward = eager_forward
+            # 出错前可能已把本次输入的KV追加到缓存，重试前截回原长度
+            if past_len is not None and past.get_seq_length() != past_len:
+                past.crop(past_len)
+            return eager_forward(*args, **kwargs)
+
+    model.forward = forward
+    return eager_forward
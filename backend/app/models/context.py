@@ -0,0 +1,145 @@
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from app.config import settings
+from app.utils import get_logger
+
+logger = get_logger()
+
+ASSISTANT_PREFIX = "Assistant:"
+
+# 模型开始续写下一轮对话时的轮次边界，生成遇到时自动停止
+TURN_STOP_SEQUENCES = ["\nUser:", "\nAssistant:"]
+
+# 提示词格式版本，修改render_message时递增，使数据库中按旧格式保存的token id失效
+PROMPT_FORMAT_VERSION = 2
+
+
+def pack_token_ids(token_ids) -> bytes:
+    """把token id打包为小端uint32字节串，用于写入数据库"""
+    packed = array("I", token_ids)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_token_ids(data: bytes) -> list:
+    """从数据库中的字节串还原token id"""
+    packed = array("I")
+    packed.frombytes(data)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return packed.tolist()
+
+
+def message_text(message) -> str:
+    """提取消息中的文本内容（多模态内容只保留文本部分）"""
+    if isinstance(message.content, str):
+        return message.content
+    return "".join(item.text for item in message.content if item.type == "text" and item.text)
+
+
+def render_message(message) -> str:
+    """按提示词格式渲染单条消息，不参与提示词的角色返回空字符串"""
+    if message.role == "system":
+        return f"System: {message_text(message)}\n"
+    if message.role == "user":
+        return f"User: {message_text(message)}\n"
+    if message.role == "assistant":
+        return f"Assistant: {message_text(message)}\n"
+    return ""
+
+
+class ContextBuilder:
+    """按token预算构建提示词
+
+    每条消息单独编码并缓存token id，从最新的消息开始向前保留，
+    直到达到 上下文长度 - max_new_tokens 的预算，保证提示词长度和预填充耗时有上界。
+    开头连续的system消息（系统提示词、人设、工具说明）作为固定前缀总是保留，不参与截断，
+    调度器据此在请求之间共享这段前缀的KV。
+    从数据库加载的历史消息带有写入时保存的token id，来源与当前分词器一致时直接使用。
+    """
+
+    def __init__(self, tokenizer, max_context_tokens: int, cache_size: int = settings.TOKEN_COUNT_CACHE_SIZE):
+        self.tokenizer = tokenizer
+        self.max_context_tokens = max_context_tokens
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # token id的来源标识，分词器或提示词格式变化时不再使用已保存的token id
+        self.source = f"{getattr(tokenizer, 'name_or_path', '')}#{PROMPT_FORMAT_VERSION}"
+        self.suffix_ids = self._encode(ASSISTANT_PREFIX)
+
+    def _encode(self, text: str):
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def encode_message(self, message):
+        """返回单条消息渲染后的token id（带缓存）"""
+        token_ids = getattr(message, "_token_ids", None)
+        if token_ids is not None and getattr(message, "_token_source", None) == self.source:
+            return token_ids
+        text = render_message(message)
+        if not text:
+            return []
+        key = (message.role, text)
+        with self._lock:
+            token_ids = self._cache.get(key)
+            if token_ids is not None:
+                self._cache.move_to_end(key)
+                return token_ids
+        token_ids = self._encode(text)
+        with self._lock:
+            self._cache[key] = token_ids
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return token_ids
+
+    def count_tokens(self, message) -> int:
+        """返回单条消息的token数"""
+        return len(self.encode_message(message))
+
+    def prompt_budget(self, max_new_tokens: int) -> int:
+        """提示词可用的token预算，至少保留一半上下文给提示词"""
+        return max(self.max_context_tokens - max_new_tokens, self.max_context_tokens // 2) - len(self.suffix_ids)
+
+    def system_prefix(self, messages):
+        """开头连续的system消息渲染后的token id，即提示词的固定前缀"""
+        prefix_ids = []
+        for message in messages:
+            if message.role != "system":
+                break
+            prefix_ids.extend(self.encode_message(message))
+        return prefix_ids
+
+    def build(self, messages, max_new_tokens: int):
+        """构建提示词token id，保留固定前缀，其余只保留预算内最近的消息"""
+        budget = self.prompt_budget(max_new_tokens)
+        prefix_ids = self.system_prefix(messages)
+        if len(prefix_ids) < budget:
+            messages = messages[next((i for i, message in enumerate(messages) if message.role != "system"), len(messages)):]
+            budget -= len(prefix_ids)
+        else:
+            # 前缀本身超出预算时不再单独保留，与其他消息一起按预算截取
+            prefix_ids = []
+        segments = []
+        used = 0
+        for message in reversed(messages):
+            token_ids = self.encode_message(message)
+            if not token_ids:
+                continue
+            if used + len(token_ids) > budget:
+                if not segments:
+                    # 最新的消息本身超出预算时保留其末尾部分
+                    segments.append(token_ids[-budget:])
+                    used = budget
+                logger.debug(f"历史消息超出token预算，保留最近 {len(segments)} 条，共 {used} tokens")
+                break
+            segments.append(token_ids)
+            used += len(token_ids)
+
+        prompt_ids = list(prefix_ids)
+        for token_ids in reversed(segments):
+            prompt_ids.extend(token_ids)
+        prompt_ids.extend(self.suffix_ids)
+        return prompt_ids
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, String, Text, DateTime, Boolean, Integer, ForeignKey
+from sqlalchemy import create_engine, inspect, text, Column, String, Text, DateTime, Boolean, Integer, LargeBinary, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.sql import func
@@ -33,7 +33,9 @@ class MessageModel(Base):
     role = Column(String, nullable=False)  # user, assistant, system
     content = Column(Text, nullable=False)
     created_at = Column(DateTime, default=func.now(), nullable=False, index=True)
-    tokens = Column(Integer, default=0)
+    tokens = Column(Integer, default=0)  # 渲染后的消息在提示词中占用的token数（含角色前缀），与token_ids长度一致
+    token_ids = Column(LargeBinary)  # 写入时渲染消息的token id（小端uint32），构建提示词时无需重新分词
+    token_source = Column(String)  # token_ids对应的分词器和提示词格式
     metadata_info = Column(Text)  # JSON格式存储额外信息
     
     # 关联回话
@@ -56,14 +58,40 @@ class APIKeyModel(Base):
         return "sk-" + secrets.token_urlsafe(32)
 
 
+class BatchJobModel(Base):
+    """离线批处理任务模型"""
+    __tablename__ = 'batch_jobs'
+    
+    id = Column(String, primary_key=True, index=True)
+    status = Column(String, default="queued", nullable=False)  # queued, running, completed, failed, cancelled
+    total = Column(Integer, default=0)  # 输入文件中的请求数
+    completed = Column(Integer, default=0)  # 已成功完成的请求数
+    failed = Column(Integer, default=0)  # 失败的请求数
+    error = Column(Text)  # 整个任务失败时的原因
+    created_at = Column(DateTime, default=func.now(), nullable=False, index=True)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), nullable=False)
+
+
 # 数据库引擎和会话工厂
 # 从配置中读取数据库URL
 engine = create_engine(settings.DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 def create_tables():
-    """创建所有表"""
+    """创建所有表，并为已存在的表补充新增的列"""
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+
+def add_missing_columns():
+    """create_all不会修改已存在的表，这里用ALTER TABLE补充模型中新增的可空列"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
 
 def get_db():
     """获取数据库会话"""
@@ -0,0 +1,59 @@
+class IncrementalDetokenizer:
+    """增量解码器
+
+    维护已生成的token及前缀偏移量，每次只解码最近一小段token，
+    仅在得到完整字符时输出新增文本，避免多字节字符（如中文）和合并词片被拆开。
+    """
+
+    # 上下文窗口超过 WINDOW 个token时向前滑动，只保留最近 CONTEXT 个token作为前缀
+    WINDOW = 6
+    CONTEXT = 3
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids = []
+        self.text = ""
+        self._prefix_offset = 0
+        self._read_offset = 0
+        self._prefix_text = ""
+        # 快速分词器直接调用底层解码，省去transformers封装的开销；需要清理空格时保持原有行为
+        backend = getattr(tokenizer, "backend_tokenizer", None)
+        if backend is not None and not getattr(tokenizer, "clean_up_tokenization_spaces", False):
+            self._backend_decode = backend.decode
+        else:
+            self._backend_decode = None
+
+    def _decode(self, token_ids) -> str:
+        if self._backend_decode is not None:
+            return self._backend_decode(token_ids, skip_special_tokens=self.skip_special_tokens)
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
+
+    def push(self, token_id: int) -> str:
+        """加入一个token，返回新增的完整文本（可能为空）"""
+        self.token_ids.append(token_id)
+        new_text = self._decode(self.token_ids[self._prefix_offset:])
+        # 末尾是替换字符说明多字节字符尚未完整，等待后续token
+        if len(new_text) <= len(self._prefix_text) or new_text.endswith("�"):
+            return ""
+        delta = new_text[len(self._prefix_text):]
+        self.text += delta
+        self._read_offset = len(self.token_ids)
+        if self._read_offset - self._prefix_offset > self.WINDOW:
+            self._prefix_offset = self._read_offset - self.CONTEXT
+            self._prefix_text = self._decode(self.token_ids[self._prefix_offset:self._read_offset])
+        else:
+            self._prefix_text = new_text
+        return delta
+
+    def flush(self) -> str:
+        """生成结束时输出剩余未完成的文本"""
+        if self._read_offset >= len(self.token_ids):
+            return ""
+        new_text = self._decode(self.token_ids[self._prefix_offset:])
+        delta = new_text[len(self._prefix_text):]
+        self.text += delta
+        self._read_offset = len(self.token_ids)
+        self._prefix_offset = self._read_offset
+        self._prefix_text = ""
+        return delta
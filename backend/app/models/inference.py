@@ -1,6 +1,17 @@
-import torch
+import asyncio
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from app.config import settings
+from app.models.scheduler import BatchScheduler, GenerationRequest, CancellationToken, EmbeddingTask
+from app.models.kv_cache import SessionKVCache
+from app.models.detokenizer import IncrementalDetokenizer
+from app.models.context import ContextBuilder, render_message, ASSISTANT_PREFIX
+from app.models.schemas import ChatMessage
+from app.models.precision import resolve_precision, load_dtype, apply_precision, model_size_bytes
+from app.models.backends import TorchBackend, resolve_backend, mmap_load_kwargs
+from app.models.onnx_backend import OnnxBackend, onnx_model_dir
+from app.models.compiled import parse_buckets, compile_model
+from app.models.stopping import stop_sequences, truncate_at_stop, StopMatcher
+from app.models.thread_tuning import thread_autotuner, set_interop_threads
 from app.utils import get_logger
 import time
 
@@ -8,130 +19,251 @@ logger = get_logger()
 
 
 class LLMInference:
-    _instance = None
-    _initialized = False
-
-    def __new__(cls, model_path: str = settings.MODEL_PATH):
-        if cls._instance is None:
-            cls._instance = super(LLMInference, cls).__new__(cls)
-        return cls._instance
-
-    def __init__(self, model_path: str = settings.MODEL_PATH):
-        if not self._initialized:
-            logger.info(f"正在加载模型: {model_path}")
-            self.model_path = model_path
-            self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
-            
-            # 如果分词器没有pad_token，使用eos_token作为pad_token
-            if self.tokenizer.pad_token is None:
-                self.tokenizer.pad_token = self.tokenizer.eos_token
-            
-            # 加载模型
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_path,
-                torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                device_map="auto" if torch.cuda.is_available() else None,
-                trust_remote_code=True
-            )
-            self.model.eval()
-            self._initialized = True
-            logger.info("模型加载完成")
+    """单个模型的推理实例，由模型池按需创建和卸载
+
+    模型由推理后端（INFERENCE_BACKEND）运行：torch后端直接加载transformers模型，onnx后端加载导出的ONNX模型；
+    调度、缓存和采样与后端无关，上层服务和路由不区分后端。
+    """
+
+    def __init__(self, model_path: str = settings.MODEL_PATH, draft_model_path: str = settings.DRAFT_MODEL_PATH,
+                 thread_config: dict = None, backend: str = settings.INFERENCE_BACKEND):
+        """thread_config为推理线程配置，未提供时按配置项决定（开启THREAD_AUTOTUNE时自动调优）"""
+        logger.info(f"正在加载模型: {model_path}")
+        set_interop_threads(settings.TORCH_INTEROP_THREADS)
+        self.model_path = model_path
+        self.backend = self._load_backend(model_path, resolve_backend(backend))
+        self.backend_name = self.backend.name
+        self.supports_embeddings = self.backend.supports_embeddings
+        self.tokenizer = self.backend.tokenizer
+        self.model = self.backend.model
+        logger.info(f"推理后端: {self.backend.name}，模型精度: {self.precision}")
+        self.max_context_tokens = settings.MAX_CONTEXT_TOKENS or getattr(self.backend.config, "max_position_embeddings", None) or 2048
+        self.context_builder = ContextBuilder(self.tokenizer, self.max_context_tokens)
+        self.session_cache = SessionKVCache()
+        if self.model is None and (draft_model_path or settings.MODEL_COMPILE):
+            logger.warning(f"{self.backend.name}推理后端不支持推测解码和模型编译，相关配置将被忽略")
+        self.draft_model = self._load_draft_model(draft_model_path) if draft_model_path and self.model is not None else None
+        compile_enabled = settings.MODEL_COMPILE and self.model is not None
+        buckets = [length for length in parse_buckets(settings.COMPILE_BUCKETS) if length <= self.max_context_tokens]
+        self.thread_config = thread_config or thread_autotuner.configure(self.backend, model_path)
+        self.scheduler = BatchScheduler(
+            self.backend,
+            self.tokenizer,
+            session_cache=self.session_cache,
+            draft_model=self.draft_model,
+            prefill_buckets=buckets if compile_enabled else None,
+            thread_config=self.thread_config
+        )
+        self.compiled = self._compile(buckets) if compile_enabled else False
+        logger.info("模型加载完成")
+
+    def _load_backend(self, model_path: str, backend: str):
+        """加载推理后端，onnx后端使用导出时的fp32精度，忽略精度配置"""
+        if backend == "onnx":
+            if (settings.MODEL_PRECISION or "auto").lower() not in ("auto", "fp32"):
+                logger.warning("onnx推理后端使用导出时的fp32精度，忽略MODEL_PRECISION")
+            self.precision = "fp32"
+            return OnnxBackend(onnx_model_dir(model_path))
+        self.precision = resolve_precision(settings.MODEL_PRECISION)
+        return TorchBackend.load(model_path, self.precision)
+
+    def _compile(self, buckets: list) -> bool:
+        """编译模型前向，并按各预填充分桶预热；任一步失败时回退到eager模式"""
+        start_time = time.time()
+        eager_forward = compile_model(self.model)
+        try:
+            warmup_ids = self.tokenizer.encode("Hello", add_special_tokens=False) or [self.scheduler.pad_token_id]
+            for length in buckets or [len(warmup_ids)]:
+                prompt_ids = (warmup_ids * length)[:length]
+                # 两个请求先以批大小2解码，较短的结束后再以批大小1解码，覆盖两种解码图
+                requests = [
+                    self.scheduler.submit(GenerationRequest(prompt_ids, max_new_tokens=max_new_tokens, temperature=0))
+                    for max_new_tokens in (2, 4)
+                ]
+                for request in requests:
+                    request.result()
+        except Exception as e:
+            self.model.forward = eager_forward
+            self.scheduler.prefill_buckets = []
+            logger.warning(f"模型编译失败，回退到eager模式: {str(e)}")
+            return False
+        if self.model.forward is eager_forward:
+            # 预热中编译后的前向出错，已回退到eager模式
+            self.scheduler.prefill_buckets = []
+            return False
+        logger.info(f"模型编译完成，预填充分桶: {buckets}，耗时: {time.time() - start_time:.2f}s")
+        return True
+
+    def warmup(self, max_new_tokens: int = settings.MODEL_WARMUP_TOKENS):
+        """执行一次短生成，提前完成首次推理的初始化开销"""
+        if max_new_tokens <= 0:
+            return
+        start_time = time.time()
+        request = self.submit([ChatMessage(role="user", content="你好")], max_new_tokens=max_new_tokens, temperature=0)
+        request.result()
+        logger.info(f"模型预热完成，耗时: {time.time() - start_time:.2f}s")
+
+    @property
+    def busy(self) -> bool:
+        """是否有正在生成或排队的请求"""
+        return self.scheduler.num_running > 0 or self.scheduler.num_waiting > 0
+
+    @property
+    def memory_bytes(self) -> int:
+        """模型权重（含草稿模型）及KV缓存池占用的内存"""
+        nbytes = self.backend.memory_bytes + self.scheduler.kv_cache.nbytes
+        if self.draft_model is not None:
+            nbytes += model_size_bytes(self.draft_model)
+        return nbytes
+
+    def close(self):
+        """停止调度器，实例不再被引用后模型内存随之释放"""
+        self.scheduler.stop()
+
+    def _load_draft_model(self, draft_model_path: str):
+        """加载推测解码的草稿模型，词表与主模型不一致时不启用"""
+        logger.info(f"正在加载草稿模型: {draft_model_path}")
+        draft_tokenizer = AutoTokenizer.from_pretrained(draft_model_path, trust_remote_code=True)
+        if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+            logger.warning("草稿模型与主模型的词表不一致，不启用推测解码")
+            return None
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            draft_model_path,
+            dtype=load_dtype(self.precision),
+            trust_remote_code=True,
+            **mmap_load_kwargs(draft_model_path)
+        ).to(self.model.device)
+        if draft_model.config.vocab_size != self.model.config.vocab_size:
+            logger.warning("草稿模型与主模型的输出维度不一致，不启用推测解码")
+            return None
+        draft_model.eval()
+        draft_model = apply_precision(draft_model, self.precision)
+        logger.info("草稿模型加载完成，已启用推测解码")
+        return draft_model
 
     def format_prompt(self, messages):
         """格式化聊天消息为模型输入格式"""
-        prompt = ""
-        for message in messages:
-            content = ""
-            if isinstance(message.content, str):
-                content = message.content
-            else:
-                # 处理多模态内容
-                for item in message.content:
-                    if item.type == "text" and item.text:
-                        content += item.text
-            
-            if message.role == "user":
-                prompt += f"User: {content}\n"
-            elif message.role == "assistant":
-                prompt += f"Assistant: {content}\n"
-        prompt += "Assistant:"
-        return prompt
+        return "".join(render_message(message) for message in messages) + ASSISTANT_PREFIX
+
+    def encode_prompt(self, messages, max_new_tokens: int = 200):
+        """将聊天消息编码为提示词token id，历史按token预算截取最近的部分"""
+        return self.context_builder.build(messages, max_new_tokens)
+
+    def submit(self, messages, max_new_tokens: int = 200, temperature: float = 0.7, top_p: float = 1.0,
+               session_id: str = None, cancel_token: CancellationToken = None, n: int = 1,
+               low_priority: bool = False, stop=None, top_k: int = 0, repetition_penalty: float = 1.0,
+               seed: int = None) -> GenerationRequest:
+        """将生成请求提交给连续批处理调度器，提供session_id时复用该会话上一轮的KV缓存
+
+        n>1时附带n-1个兄弟请求（见request.forks），整组共享一次预填充并在同一批次中解码。
+        low_priority的请求（离线批处理）只在没有在线请求等待时被接纳。
+        stop为请求的停止序列，另外总是在模型开始续写下一轮对话（TURN_STOP_SEQUENCES）时停止。
+        temperature、top_p、top_k、repetition_penalty和seed逐请求生效，参数不同的请求在同一批次中解码。
+        开头的system消息作为固定前缀，其KV由调度器在所有以相同前缀开头的请求之间共享。
+        """
+        prompt_ids = self.encode_prompt(messages, max_new_tokens)
+        prefix_ids = self.context_builder.system_prefix(messages)
+        request = GenerationRequest(
+            prompt_ids,
+            max_new_tokens=min(max_new_tokens, self.max_context_tokens - len(prompt_ids)),
+            temperature=temperature,
+            top_p=top_p,
+            session_id=session_id,
+            cancel_token=cancel_token,
+            low_priority=low_priority,
+            stop=stop_sequences(stop),
+            prefix_len=len(prefix_ids) if prompt_ids[:len(prefix_ids)] == prefix_ids else 0,
+            top_k=top_k or 0,
+            repetition_penalty=repetition_penalty or 1.0,
+            seed=seed
+        )
+        for _ in range(n - 1):
+            request.fork()
+        return self._dispatch(request)
+
+    def _dispatch(self, request: GenerationRequest) -> GenerationRequest:
+        """把生成请求交给本进程的调度器"""
+        return self.scheduler.submit(request)
+
+    def encode_embedding_inputs(self, texts) -> list:
+        """把待向量化的文本分词并截断到最大上下文长度；文本较多时耗时较长，异步调用方应放到线程池中执行"""
+        return [self.tokenizer.encode(text)[:self.max_context_tokens] for text in texts]
+
+    def submit_embeddings(self, token_ids) -> list:
+        """为每个文本的token id提交一个向量化任务，返回顺序一致的任务句柄；推理队列已满时全部拒绝并抛出QueueFullError
+
+        按token长度排序后提交，使同一批前向中的文本长度相近，减少填充。
+        """
+        tasks = [EmbeddingTask(ids) for ids in token_ids]
+        self._dispatch_embeddings(sorted(tasks, key=lambda task: len(task.token_ids)))
+        return tasks
+
+    def _dispatch_embeddings(self, tasks: list) -> list:
+        """把向量化任务交给本进程的调度器"""
+        return self.scheduler.submit_embeddings(tasks)
+
+    def cancel_embeddings(self, tasks: list):
+        """取消尚未完成的向量化任务（如客户端已断开）"""
+        for task in tasks:
+            task.cancel()
+
+    def decode_output(self, request: GenerationRequest) -> str:
+        """解码已完成请求的生成文本，截掉停止序列及之后的部分"""
+        return truncate_at_stop(self.tokenizer.decode(request.output_ids, skip_special_tokens=True), request.stop)
 
     def chat(self, messages, max_new_tokens: int = 200, temperature: float = 0.7, top_p: float = 1.0):
         """生成完整回复"""
-        # 格式化提示词
-        prompt = self.format_prompt(messages)
-        
-        # 编码输入
-        inputs = self.tokenizer(prompt, return_tensors="pt", padding=True, truncation=True, add_special_tokens=False)
-        # 显式创建attention_mask以避免警告
-        if self.tokenizer.pad_token_id == self.tokenizer.eos_token_id:
-            attention_mask = (inputs['input_ids'] != self.tokenizer.pad_token_id).long()
-            inputs['attention_mask'] = attention_mask
-        inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
-        
-        # 生成回复
-        with torch.no_grad():
-            outputs = self.model.generate(
-                **inputs,
-                max_new_tokens=max_new_tokens,
-                temperature=temperature,
-                top_p=top_p,
-                do_sample=True,
-                pad_token_id=self.tokenizer.pad_token_id,
-                eos_token_id=self.tokenizer.eos_token_id
-            )
-        
-        # 解码输出
-        generated_text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-        
-        # 提取助手回复部分
-        response = generated_text[len(prompt):].strip()
-        return response
+        request = self.submit(messages, max_new_tokens, temperature, top_p)
+        request.result()
+        return self.decode_output(request).strip()
+
+    async def agenerate(self, messages, max_new_tokens: int = 200, temperature: float = 0.7, top_p: float = 1.0,
+                        session_id: str = None, n: int = 1, stop=None, top_k: int = 0, repetition_penalty: float = 1.0,
+                        seed: int = None) -> GenerationRequest:
+        """生成完整回复（在事件循环中等待，不阻塞），返回包含文本和token用量的已完成请求，n>1时其余候选见request.forks"""
+        request = self.submit(messages, max_new_tokens, temperature, top_p, session_id, n=n, stop=stop, top_k=top_k,
+                              repetition_penalty=repetition_penalty, seed=seed)
+        try:
+            await asyncio.gather(*[member.wait() for member in request.group])
+        finally:
+            # 等待被取消（如客户端断开）时停止生成
+            request.cancel()
+        for member in request.group:
+            member.text = self.decode_output(member).strip()
+        return request
+
+    async def achat(self, messages, max_new_tokens: int = 200, temperature: float = 0.7, top_p: float = 1.0,
+                    session_id: str = None):
+        """生成完整回复（在事件循环中等待，不阻塞）"""
+        request = await self.agenerate(messages, max_new_tokens, temperature, top_p, session_id)
+        return request.text
+
+    def count_tokens(self, message) -> int:
+        """返回单条消息在提示词中占用的token数"""
+        return self.context_builder.count_tokens(message)
+
+    async def stream_tokens(self, request: GenerationRequest):
+        """增量输出已提交请求的生成文本，只输出完整字符
+
+        可能是停止序列开头的文本先暂存，确认不是停止序列后再输出，停止序列本身不输出。
+        """
+        detokenizer = IncrementalDetokenizer(self.tokenizer)
+        stop_matcher = StopMatcher(request.stop)
+        async for token_id in request.aiter_tokens():
+            text = stop_matcher.push(detokenizer.push(token_id))
+            if text:
+                yield text
+            if stop_matcher.stopped:
+                break
+        text = stop_matcher.push(detokenizer.flush()) + stop_matcher.flush()
+        if text:
+            yield text
 
     async def stream_chat(self, messages, max_new_tokens: int = 200, temperature: float = 0.7, top_p: float = 1.0):
-        """流式生成回复（逐token输出）"""
-        # 格式化提示词
-        prompt = self.format_prompt(messages)
-        
-        # 编码输入
-        inputs = self.tokenizer(prompt, return_tensors="pt", padding=True, truncation=True, add_special_tokens=False)
-        # 显式创建attention_mask以避免警告
-        if self.tokenizer.pad_token_id == self.tokenizer.eos_token_id:
-            attention_mask = (inputs['input_ids'] != self.tokenizer.pad_token_id).long()
-            inputs['attention_mask'] = attention_mask
-        input_ids = inputs.input_ids.to(self.model.device)
-        attention_mask = inputs.attention_mask.to(self.model.device) if 'attention_mask' in inputs else None
-        
-        # 使用模型的generate方法实现流式输出
-        with torch.no_grad():
-            # 生成回复
-            generate_kwargs = {
-                "input_ids": input_ids,
-                "max_new_tokens": max_new_tokens,
-                "temperature": temperature,
-                "top_p": top_p,
-                "do_sample": True,
-                "pad_token_id": self.tokenizer.pad_token_id,
-                "eos_token_id": self.tokenizer.eos_token_id,
-                "output_scores": True,
-                "return_dict_in_generate": True
-            }
-            
-            # 只有当attention_mask存在且不为None时才添加
-            if attention_mask is not None:
-                generate_kwargs["attention_mask"] = attention_mask
-                
-            outputs = self.model.generate(**generate_kwargs)
-        
-        # 解码输出
-        generated_tokens = outputs.sequences[0][len(input_ids[0]):]
-        
-        # 逐token返回
-        for token_id in generated_tokens:
-            token = self.tokenizer.decode([token_id], skip_special_tokens=True)
-            yield token
-            
-            # 检查是否是结束符
-            if token_id == self.tokenizer.eos_token_id:
-                break
\ No newline at end of file
+        """流式生成回复（增量输出）"""
+        request = self.submit(messages, max_new_tokens, temperature, top_p)
+        try:
+            async for token in self.stream_tokens(request):
+                yield token
+        finally:
+            request.cancel()
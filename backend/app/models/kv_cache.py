@@ -0,0 +1,94 @@
+import threading
+from collections import OrderedDict
+from prometheus_client import Counter
+from app.config import settings
+from app.utils import get_logger, get_or_create_metric
+
+logger = get_logger()
+
+SESSION_CACHE_LOOKUPS = get_or_create_metric(Counter, "session_kv_cache_lookups_total", "Session KV cache lookups", ["result"])
+REUSED_PREFILL_TOKENS = get_or_create_metric(Counter, "session_kv_cache_reused_tokens_total", "Prompt tokens served from the session KV cache")
+
+
+def _past_nbytes(past) -> int:
+    return sum(key.numel() * key.element_size() + value.numel() * value.element_size() for key, value in past)
+
+
+def _crop_past(past, length: int):
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in past)
+
+
+class _SessionEntry:
+    def __init__(self, token_ids, past):
+        self.token_ids = token_ids
+        self.past = past
+        self.nbytes = _past_nbytes(past)
+
+
+class SessionKVCache:
+    """按会话缓存上一轮生成结束时的KV，按LRU在内存预算内淘汰"""
+
+    def __init__(self, max_bytes: int = settings.SESSION_KV_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, session_id: str, prompt_ids):
+        """返回可复用的前缀长度和对应的KV，未命中时返回 (0, None)"""
+        if not self.enabled or not session_id:
+            return 0, None
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                SESSION_CACHE_LOOKUPS.labels(result="miss").inc()
+                return 0, None
+            self._entries.move_to_end(session_id)
+
+        # 计算与缓存token的最长公共前缀，至少保留一个token用于预填充得到logits
+        limit = min(len(entry.token_ids), len(prompt_ids) - 1)
+        prefix_len = 0
+        while prefix_len < limit and entry.token_ids[prefix_len] == prompt_ids[prefix_len]:
+            prefix_len += 1
+        if prefix_len == 0:
+            SESSION_CACHE_LOOKUPS.labels(result="miss").inc()
+            return 0, None
+
+        SESSION_CACHE_LOOKUPS.labels(result="hit").inc()
+        REUSED_PREFILL_TOKENS.inc(prefix_len)
+        return prefix_len, _crop_past(entry.past, prefix_len)
+
+    def store(self, session_id: str, token_ids, past):
+        """保存会话的KV；past需与token_ids长度一致"""
+        if not self.enabled or not session_id:
+            return
+        # 复制一份，避免持有整个批次张量的视图
+        past = tuple((key.clone(), value.clone()) for key, value in past)
+        entry = _SessionEntry(list(token_ids), past)
+        if entry.nbytes > self.max_bytes:
+            self.evict(session_id)
+            return
+        with self._lock:
+            old = self._entries.pop(session_id, None)
+            if old is not None:
+                self.total_bytes -= old.nbytes
+            self._entries[session_id] = entry
+            self.total_bytes += entry.nbytes
+            while self.total_bytes > self.max_bytes:
+                evicted_id, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+                logger.debug(f"淘汰会话KV缓存: {evicted_id}")
+
+    def evict(self, session_id: str):
+        """移除指定会话的KV缓存"""
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is not None:
+                self.total_bytes -= entry.nbytes
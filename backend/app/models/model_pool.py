@@ -0,0 +1,289 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import gc
+import glob
+import os
+import threading
+import time
+from prometheus_client import Counter, Gauge
+from app.config import settings
+from app.models.inference import LLMInference
+from app.models.onnx_backend import onnx_model_dir
+from app.models.workers import WorkerPoolInference
+from app.utils import get_logger, get_or_create_metric
+
+logger = get_logger()
+
+MODEL_LOADS = get_or_create_metric(Counter, "model_pool_loads_total", "Models loaded into the pool")
+MODEL_EVICTIONS = get_or_create_metric(Counter, "model_pool_evictions_total", "Models unloaded to stay within the memory budget")
+RESIDENT_MODELS = get_or_create_metric(Gauge, "model_pool_resident_models", "Models currently loaded")
+RESIDENT_BYTES = get_or_create_metric(Gauge, "model_pool_memory_bytes", "Weight memory of the loaded models")
+
+WEIGHT_FILE_PATTERNS = ("*.safetensors", "*.bin", "*.pt", "*.pth", "*.onnx", "*.onnx.data")
+
+
+def parse_model_paths(value: str) -> dict:
+    """解析 MODEL_PATHS 配置，格式为 模型ID=本地路径，多个以逗号分隔"""
+    model_paths = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        if "=" not in item:
+            logger.warning(f"忽略格式错误的模型路径配置: {item}")
+            continue
+        model_id, path = item.split("=", 1)
+        model_paths[model_id.strip()] = path.strip()
+    return model_paths
+
+
+class ModelLoadingError(Exception):
+    """启动时预加载的模型尚未加载完成，请求需要稍后重试"""
+
+    def __init__(self, model_id: str = None):
+        super().__init__(f"模型加载中: {model_id or 'default'}")
+        self.model_id = model_id
+
+
+class _PoolEntry:
+    def __init__(self, llm, nbytes: int):
+        self.llm = llm
+        self.nbytes = nbytes
+        self.last_used = time.monotonic()
+        self.leases = 0  # 持有该模型、尚未完成的请求数
+
+    @property
+    def idle(self) -> bool:
+        return self.leases == 0 and not self.llm.busy
+
+
+class ModelPool:
+    """模型池
+
+    按模型ID映射到本地路径，首次使用时加载；超出内存预算时按最近最少使用卸载空闲的模型。
+    未单独配置路径的模型ID是默认模型的别名，同一路径只加载一份权重。
+    请求通过 lease=True 获取模型时持有一次租约，直到调用release归还，持有租约的模型不会被卸载。
+    """
+
+    def __init__(self, model_paths: dict = None, default_path: str = settings.MODEL_PATH,
+                 max_bytes: int = settings.MODEL_POOL_MEMORY_MB * 1024 * 1024):
+        self.model_paths = model_paths if model_paths is not None else parse_model_paths(settings.MODEL_PATHS)
+        self.default_path = default_path
+        self.max_bytes = max_bytes
+        self._entries = {}
+        self._loading = {}
+        # 后台加载任务：路径 -> 加载结束时完成的Future，等待同一模型的请求共享一个任务
+        self._loads = {}
+        # 启动时预加载、尚未完成的路径，请求这些模型时直接返回加载中而不等待
+        self._preloading = set()
+        self._lock = threading.Lock()
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(entry.nbytes for entry in self._entries.values())
+
+    def resolve_path(self, model_id: str = None) -> str:
+        """返回模型ID对应的本地路径，别名（见is_alias）返回默认模型的路径"""
+        return self.model_paths.get(model_id) or self.default_path
+
+    def is_alias(self, model_id: str) -> bool:
+        """未在MODEL_PATHS中配置路径的模型ID是默认模型的别名，与默认模型共用同一份权重"""
+        return model_id not in self.model_paths
+
+    def status(self, model_id: str = None) -> str:
+        """模型状态：resident 已加载，loading 加载中，cold 未加载"""
+        path = self.resolve_path(model_id)
+        if path in self._entries:
+            return "resident"
+        if path in self._loading or path in self._loads:
+            return "loading"
+        return "cold"
+
+    def get(self, model_id: str = None, lease: bool = False):
+        """获取模型推理实例，未加载时在当前线程加载（同一模型只加载一次）；lease为True时同时持有租约"""
+        path = self.resolve_path(model_id)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                return self._use(entry, lease)
+            load_lock = self._loading.setdefault(path, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(path)
+                if entry is not None:
+                    return self._use(entry, lease)
+            try:
+                self._make_room(self._estimate_bytes(path), exclude=path)
+                llm = self._load_model(path)
+                self._warmup(llm)
+                entry = _PoolEntry(llm, self._model_bytes(llm))
+                with self._lock:
+                    self._entries[path] = entry
+                    self._use(entry, lease)
+                    MODEL_LOADS.inc()
+                    RESIDENT_MODELS.set(len(self._entries))
+                    RESIDENT_BYTES.set(self.total_bytes)
+            finally:
+                with self._lock:
+                    self._loading.pop(path, None)
+            logger.info(f"模型已载入模型池: {path} ({entry.nbytes / 1024 / 1024:.1f}MB)，"
+                        f"当前共 {len(self._entries)} 个模型")
+            # 估算值可能偏小，加载后按实际占用再检查一次
+            self._make_room(0, exclude=path)
+            return entry.llm
+
+    def resident(self, model_id: str = None):
+        """返回已加载的模型推理实例，未加载时返回None（不触发加载）"""
+        entry = self._entries.get(self.resolve_path(model_id))
+        return entry.llm if entry is not None else None
+
+    async def aget(self, model_id: str = None, lease: bool = False):
+        """获取模型推理实例，lease为True时同时持有租约
+
+        未加载的模型在首次使用时于后台线程加载，请求在事件循环中等待加载完成，不占用线程池；
+        启动时预加载（load_in_background）的模型在加载完成前抛出ModelLoadingError。
+        """
+        path = self.resolve_path(model_id)
+        while True:
+            with self._lock:
+                entry = self._entries.get(path)
+                if entry is not None:
+                    return self._use(entry, lease)
+                if path in self._preloading:
+                    raise ModelLoadingError(model_id)
+            # 加载完成后到取得实例前可能又被卸载，此时重新加载
+            await asyncio.wrap_future(self._start_load(model_id))
+
+    def release(self, llm):
+        """归还get/aget(lease=True)取得的租约"""
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.llm is llm and entry.leases > 0:
+                    entry.leases -= 1
+                    return
+
+    @contextlib.asynccontextmanager
+    async def lease(self, model_id: str = None):
+        """在请求处理期间持有模型：async with model_pool.lease(model_id) as llm"""
+        llm = await self.aget(model_id, lease=True)
+        try:
+            yield llm
+        finally:
+            self.release(llm)
+
+    def _use(self, entry: _PoolEntry, lease: bool):
+        """刷新最近使用时间，按需持有租约（调用方需持有self._lock）"""
+        entry.last_used = time.monotonic()
+        if lease:
+            entry.leases += 1
+        return entry.llm
+
+    def load_in_background(self, model_id: str = None) -> bool:
+        """启动时在后台线程中预加载模型，加载完成前请求该模型返回加载中；已加载或正在加载时不重复启动"""
+        path = self.resolve_path(model_id)
+        with self._lock:
+            if path in self._entries or path in self._loading or path in self._loads:
+                return False
+            self._preloading.add(path)
+        self._start_load(model_id)
+        return True
+
+    def _start_load(self, model_id: str = None) -> concurrent.futures.Future:
+        """在后台线程中加载模型，返回加载结束时完成的Future；该模型已在后台加载时返回同一个Future"""
+        path = self.resolve_path(model_id)
+        with self._lock:
+            future = self._loads.get(path)
+            if future is None:
+                future = self._loads[path] = concurrent.futures.Future()
+                # 标记为运行中，等待的请求被取消时不会连带取消加载任务
+                future.set_running_or_notify_cancel()
+                threading.Thread(target=self._background_load, args=(model_id, future), name="model-loader",
+                                 daemon=True).start()
+        return future
+
+    def _background_load(self, model_id: str, future: concurrent.futures.Future):
+        path = self.resolve_path(model_id)
+        error = None
+        try:
+            self.get(model_id)
+        except Exception as e:
+            logger.error(f"后台加载模型失败: {path}: {str(e)}")
+            error = e
+        with self._lock:
+            self._loads.pop(path, None)
+            self._preloading.discard(path)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(None)
+
+    def unload(self, path: str, idle_only: bool = False) -> bool:
+        """卸载指定路径的模型；idle_only为True时模型被请求持有或正在生成则不卸载"""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or (idle_only and not entry.idle):
+                return False
+            del self._entries[path]
+            RESIDENT_MODELS.set(len(self._entries))
+            RESIDENT_BYTES.set(self.total_bytes)
+        entry.llm.close()
+        del entry
+        gc.collect()
+        logger.info(f"模型已卸载: {path}")
+        return True
+
+    def close(self):
+        """卸载全部模型"""
+        for path in list(self._entries):
+            self.unload(path)
+
+    def _make_room(self, needed: int, exclude: str = None):
+        """按最近最少使用卸载空闲模型，直到可以容纳needed字节"""
+        if self.max_bytes <= 0:
+            return
+        while True:
+            with self._lock:
+                if self.total_bytes + needed <= self.max_bytes:
+                    return
+                # 被请求持有或正在生成的模型不卸载
+                candidates = [
+                    (entry.last_used, path) for path, entry in self._entries.items()
+                    if path != exclude and entry.idle
+                ]
+            if not candidates:
+                logger.warning(f"模型池超出内存预算（{(self.total_bytes + needed) / 1024 / 1024:.1f}MB / "
+                               f"{self.max_bytes / 1024 / 1024:.1f}MB），且没有可卸载的空闲模型")
+                return
+            _, path = min(candidates)
+            # 选出候选后到卸载前可能又被请求取得租约，卸载时在锁内再次确认空闲
+            if self.unload(path, idle_only=True):
+                MODEL_EVICTIONS.inc()
+
+    def _estimate_bytes(self, path: str) -> int:
+        """按权重文件大小估算模型加载后的内存占用"""
+        if settings.INFERENCE_BACKEND.lower() == "onnx":
+            path = onnx_model_dir(path)
+        files = set()
+        for pattern in WEIGHT_FILE_PATTERNS:
+            files.update(glob.glob(os.path.join(path, pattern)))
+        return sum(os.path.getsize(file) for file in files)
+
+    def _load_model(self, path: str):
+        draft_model_path = settings.DRAFT_MODEL_PATH if path == self.default_path else ""
+        if settings.INFERENCE_WORKERS > 0:
+            return WorkerPoolInference(path, draft_model_path, settings.INFERENCE_WORKERS)
+        return LLMInference(path, draft_model_path)
+
+    def _warmup(self, llm):
+        try:
+            llm.warmup(settings.MODEL_WARMUP_TOKENS)
+        except Exception as e:
+            logger.warning(f"模型预热失败: {str(e)}")
+
+    def _model_bytes(self, llm) -> int:
+        return llm.memory_bytes
+
+
+# 全局模型池
+model_pool = ModelPool()
@@ -0,0 +1,173 @@
+import os
+import tempfile
+import numpy as np
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+from app.models.backends import InferenceBackend, load_tokenizer, _to_cache, _to_legacy
+from app.models.thread_tuning import apply_thread_config
+from app.utils import get_logger
+
+logger = get_logger()
+
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_DATA_FILE = "model.onnx.data"
+ONNX_SUBDIR = "onnx"
+
+# ONNX张量类型到numpy类型
+_NUMPY_TYPES = {"tensor(float)": np.float32, "tensor(float16)": np.float16, "tensor(double)": np.float64}
+
+
+def onnx_model_dir(model_path: str) -> str:
+    """导出的ONNX模型目录：模型目录本身包含model.onnx时直接使用，否则为其下的onnx子目录"""
+    if os.path.exists(os.path.join(model_path, ONNX_MODEL_FILE)):
+        return model_path
+    return os.path.join(model_path, ONNX_SUBDIR)
+
+
+class _ExportWrapper(torch.nn.Module):
+    """把KV展开为逐层的 key/value 输入输出，便于导出为ONNX图"""
+
+    def __init__(self, model, num_layers: int):
+        super().__init__()
+        self.model = model
+        self.num_layers = num_layers
+
+    def forward(self, input_ids, attention_mask, position_ids, *past):
+        legacy = tuple((past[2 * i], past[2 * i + 1]) for i in range(self.num_layers))
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                             past_key_values=_to_cache(legacy), use_cache=True)
+        present = [tensor for layer in _to_legacy(outputs.past_key_values) for tensor in layer]
+        return (outputs.logits, *present)
+
+
+def export_onnx(model_path: str, output_dir: str = None, opset: int = 17) -> str:
+    """把transformers模型导出为ONNX后端可加载的目录（model.onnx、权重数据、模型配置和分词器），返回导出目录
+
+    图的输入为 input_ids、attention_mask、position_ids 和逐层的 past_key_values.{i}.key/value，
+    输出为 logits 和逐层的 present.{i}.key/value，批大小、序列长度和KV长度均为动态维度。
+    """
+    import onnx
+
+    output_dir = output_dir or os.path.join(model_path, ONNX_SUBDIR)
+    model = AutoModelForCausalLM.from_pretrained(model_path, dtype=torch.float32, trust_remote_code=True)
+    model.eval()
+    tokenizer = load_tokenizer(model_path)
+    with torch.no_grad():
+        # 用一次单token前向得到各层KV的形状，构造长度为2的示例KV
+        past = _to_legacy(model(input_ids=torch.tensor([[tokenizer.pad_token_id or 0]]), use_cache=True).past_key_values)
+    num_layers = len(past)
+    example_past = [torch.zeros((1, tensor.shape[1], 2, tensor.shape[3])) for layer in past for tensor in layer]
+    past_names = [f"past_key_values.{i}.{kind}" for i in range(num_layers) for kind in ("key", "value")]
+    present_names = [f"present.{i}.{kind}" for i in range(num_layers) for kind in ("key", "value")]
+    dynamic_axes = {
+        "input_ids": {0: "batch", 1: "sequence"},
+        "attention_mask": {0: "batch", 1: "total_sequence"},
+        "position_ids": {0: "batch", 1: "sequence"},
+        "logits": {0: "batch", 1: "sequence"}
+    }
+    dynamic_axes.update({name: {0: "batch", 2: "past_sequence"} for name in past_names})
+    dynamic_axes.update({name: {0: "batch", 2: "total_sequence"} for name in present_names})
+    logger.info(f"正在导出ONNX模型: {model_path} -> {output_dir}")
+    os.makedirs(output_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory() as directory, torch.no_grad():
+        # 先导出到临时目录，再把全部权重合并为一个外部数据文件，超过2GB的模型也能保存
+        exported = os.path.join(directory, ONNX_MODEL_FILE)
+        torch.onnx.export(
+            _ExportWrapper(model, num_layers),
+            (torch.tensor([[1, 2]]), torch.ones((1, 4), dtype=torch.long), torch.tensor([[2, 3]]), *example_past),
+            exported,
+            input_names=["input_ids", "attention_mask", "position_ids"] + past_names,
+            output_names=["logits"] + present_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            dynamo=False
+        )
+        onnx.save_model(onnx.load(exported), os.path.join(output_dir, ONNX_MODEL_FILE), save_as_external_data=True,
+                        all_tensors_to_one_file=True, location=ONNX_DATA_FILE)
+    model.config.save_pretrained(output_dir)
+    if model.generation_config is not None:
+        model.generation_config.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    logger.info(f"ONNX模型导出完成: {output_dir}")
+    return output_dir
+
+
+class OnnxBackend(InferenceBackend):
+    """基于ONNX Runtime CPU执行器的推理后端
+
+    加载export_onnx导出的目录。每次前向把输入和KV转换为numpy交给ONNX Runtime，输出再零拷贝转换回torch张量，
+    KV的分块缓存、采样和调度仍由调度器完成。不支持向量化、推测解码和torch.compile。
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_dir: str, threads: int = 0):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise RuntimeError("ONNX推理后端需要安装onnxruntime: pip install onnxruntime") from e
+        model_file = os.path.join(model_dir, ONNX_MODEL_FILE)
+        if not os.path.exists(model_file):
+            raise FileNotFoundError(f"未找到导出的ONNX模型: {model_file}，请先运行 python export_onnx.py <模型路径>")
+        logger.info(f"正在加载ONNX模型: {model_file}")
+        self._onnxruntime = onnxruntime
+        self.version = f"onnxruntime-{onnxruntime.__version__}"
+        self.model_dir = model_dir
+        self.model_file = model_file
+        self.tokenizer = load_tokenizer(model_dir)
+        self.config = AutoConfig.from_pretrained(model_dir, trust_remote_code=True)
+        try:
+            self.generation_config = GenerationConfig.from_pretrained(model_dir)
+        except OSError:
+            self.generation_config = None
+        self._thread_key = None
+        self._create_session(threads, None)
+
+    def _create_session(self, threads: int, cores):
+        """创建推理会话；ONNX Runtime的计算线程由创建会话的线程启动并继承其CPU亲和性"""
+        options = self._onnxruntime.SessionOptions()
+        options.graph_optimization_level = self._onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = self._onnxruntime.InferenceSession(self.model_file, options, providers=["CPUExecutionProvider"])
+        self._thread_key = (threads, tuple(cores or ()))
+        self._input_names = {node.name for node in self.session.get_inputs()}
+        self._output_names = [node.name for node in self.session.get_outputs()]
+        # 各层KV的 (heads, dim, numpy类型)，用于在没有KV时构造长度为0的输入
+        self._past_specs = []
+        for node in self.session.get_inputs():
+            if node.name.startswith("past_key_values."):
+                self._past_specs.append((node.name, node.shape[1], node.shape[3], _NUMPY_TYPES.get(node.type, np.float32)))
+
+    @property
+    def memory_bytes(self) -> int:
+        return sum(os.path.getsize(os.path.join(self.model_dir, name)) for name in (ONNX_MODEL_FILE, ONNX_DATA_FILE)
+                   if os.path.exists(os.path.join(self.model_dir, name)))
+
+    def apply_thread_config(self, config: dict):
+        """线程数或绑定的核与当前会话不同时，在当前线程重新创建会话，使计算线程按新配置启动"""
+        apply_thread_config(config)
+        threads = config.get("threads") or 0
+        if self._thread_key != (threads, tuple(config.get("cores") or ())):
+            self._create_session(threads, config.get("cores"))
+
+    def forward(self, input_ids, attention_mask=None, position_ids=None, past=None):
+        batch, length = input_ids.shape
+        past_len = past[0][0].shape[2] if past is not None else 0
+        if attention_mask is None:
+            attention_mask = torch.ones((batch, past_len + length), dtype=torch.long)
+        if position_ids is None:
+            position_ids = torch.arange(past_len, past_len + length, dtype=torch.long).expand(batch, -1)
+        feed = {"input_ids": input_ids, "attention_mask": attention_mask, "position_ids": position_ids}
+        feed = {name: tensor.cpu().long().contiguous().numpy() for name, tensor in feed.items() if name in self._input_names}
+        if past is not None:
+            tensors = [tensor for layer in past for tensor in layer]
+            for (name, _, _, dtype), tensor in zip(self._past_specs, tensors):
+                feed[name] = tensor.contiguous().numpy().astype(dtype, copy=False)
+        else:
+            for name, heads, dim, dtype in self._past_specs:
+                feed[name] = np.zeros((batch, heads, 0, dim), dtype=dtype)
+        outputs = dict(zip(self._output_names, self.session.run(None, feed)))
+        logits = torch.from_numpy(outputs["logits"])
+        present = [torch.from_numpy(outputs[name.replace("past_key_values.", "present.")]) for name, _, _, _ in self._past_specs]
+        return logits, tuple((present[i], present[i + 1]) for i in range(0, len(present), 2))
@@ -0,0 +1,164 @@
+import torch
+from prometheus_client import Counter, Gauge
+from app.utils import get_logger, get_or_create_metric
+
+logger = get_logger()
+
+KV_BLOCKS_TOTAL = get_or_create_metric(Gauge, "kv_cache_blocks_total", "KV cache blocks in the preallocated pool")
+KV_BLOCKS_USED = get_or_create_metric(Gauge, "kv_cache_blocks_used", "KV cache blocks held by running sequences and the prefix cache")
+KV_ADMISSION_DEFERRED = get_or_create_metric(Counter, "kv_cache_admission_deferred_total", "Admissions deferred because not enough KV cache blocks were free")
+
+
+class KVCacheFullError(Exception):
+    """KV缓存块已用完"""
+    pass
+
+
+class BlockTable:
+    """单个序列的块表：按位置顺序记录KV所在的块及每个位置的槽位"""
+
+    def __init__(self, blocks=None, slots=None):
+        self.blocks = list(blocks or [])
+        self.slots = list(slots or [])
+
+    def __len__(self):
+        return len(self.slots)
+
+
+class PagedKVCache:
+    """分块（分页）KV缓存
+
+    创建时按预算一次性分配固定大小的KV内存池，切分为每块block_size个token的块；
+    序列用块表记录KV所在的块，块按需分配、序列结束后立即归还，不会因各序列长度不同产生碎片。
+    兄弟序列共享提示词的块（引用计数），向共享块写入时先复制一份（写时复制）。
+    模型前向仍使用连续的KV，解码前按块表把各序列的KV收集为批次，前向后只写回新token的KV。
+    """
+
+    def __init__(self, layer_shapes, dtype: torch.dtype, device, max_bytes: int, block_size: int = 16,
+                 max_blocks: int = None):
+        self.block_size = max(1, block_size)
+        element_size = torch.tensor([], dtype=dtype).element_size()
+        token_bytes = sum(heads * (key_dim + value_dim) for heads, key_dim, value_dim in layer_shapes) * element_size
+        num_blocks = max(1, max_bytes // (token_bytes * self.block_size))
+        if max_blocks:
+            num_blocks = min(num_blocks, max_blocks)
+        self.num_blocks = num_blocks
+        self.block_bytes = self.block_size * token_bytes
+        self.nbytes = num_blocks * self.block_bytes
+        num_slots = num_blocks * self.block_size
+        # 每层的池形状为 (heads, 槽位数, dim)，块b占用槽位 [b*block_size, (b+1)*block_size)
+        self.keys = [torch.zeros((heads, num_slots, key_dim), dtype=dtype, device=device) for heads, key_dim, _ in layer_shapes]
+        self.values = [torch.zeros((heads, num_slots, value_dim), dtype=dtype, device=device) for heads, _, value_dim in layer_shapes]
+        self.device = device
+        self._free = list(range(num_blocks - 1, -1, -1))
+        self._refs = [0] * num_blocks
+        KV_BLOCKS_TOTAL.inc(num_blocks)
+        logger.info(f"KV缓存池: {num_blocks} 块 x {self.block_size} tokens ({self.nbytes / 1024 / 1024:.1f}MB)")
+
+    @property
+    def free_blocks(self) -> int:
+        return len(self._free)
+
+    @property
+    def used_blocks(self) -> int:
+        return self.num_blocks - len(self._free)
+
+    def blocks_for(self, num_tokens: int) -> int:
+        """容纳num_tokens个token所需的块数"""
+        return -(-num_tokens // self.block_size)
+
+    def _allocate(self) -> int:
+        if not self._free:
+            raise KVCacheFullError("KV缓存块已用完")
+        block = self._free.pop()
+        self._refs[block] = 1
+        KV_BLOCKS_USED.inc()
+        return block
+
+    def _unref(self, block: int):
+        self._refs[block] -= 1
+        if self._refs[block] == 0:
+            self._free.append(block)
+            KV_BLOCKS_USED.dec()
+
+    def extend(self, table: BlockTable, num_tokens: int) -> int:
+        """在块表末尾追加num_tokens个位置的槽位，返回新分配的块数
+
+        末尾块已满时分配新块；末尾块与兄弟序列共享时先复制到新块再写入。
+        """
+        allocated = 0
+        for _ in range(num_tokens):
+            position = len(table.slots)
+            offset = position % self.block_size
+            if offset == 0:
+                table.blocks.append(self._allocate())
+                allocated += 1
+            elif self._refs[table.blocks[-1]] > 1:
+                shared = table.blocks[-1]
+                block = self._allocate()
+                allocated += 1
+                source = torch.arange(shared * self.block_size, shared * self.block_size + offset, device=self.device)
+                target = source + (block - shared) * self.block_size
+                for keys, values in zip(self.keys, self.values):
+                    keys.index_copy_(1, target, keys.index_select(1, source))
+                    values.index_copy_(1, target, values.index_select(1, source))
+                self._unref(shared)
+                table.blocks[-1] = block
+                table.slots[position - offset:] = target.tolist()
+            table.slots.append(table.blocks[-1] * self.block_size + offset)
+        return allocated
+
+    def fork(self, table: BlockTable, length: int = None) -> BlockTable:
+        """创建共享同一批块的块表（兄弟序列共享提示词的KV），提供length时只共享前length个位置"""
+        length = len(table) if length is None else length
+        blocks = table.blocks[:self.blocks_for(length)]
+        for block in blocks:
+            self._refs[block] += 1
+        return BlockTable(blocks, table.slots[:length])
+
+    def release(self, table: BlockTable):
+        """归还块表持有的块"""
+        for block in table.blocks:
+            self._unref(block)
+        table.blocks, table.slots = [], []
+
+    def write(self, table: BlockTable, start: int, past):
+        """把单个序列从位置start开始的KV（每层形状为 (1, heads, T, dim)）写入其槽位"""
+        length = past[0][0].shape[2]
+        index = torch.tensor(table.slots[start:start + length], dtype=torch.long, device=self.device)
+        for layer_idx, (key, value) in enumerate(past):
+            self.keys[layer_idx].index_copy_(1, index, key[0])
+            self.values[layer_idx].index_copy_(1, index, value[0])
+
+    def write_last(self, tables, past):
+        """把批次中每行最后一个位置的KV写入各序列最后一个槽位"""
+        index = torch.tensor([table.slots[-1] for table in tables], dtype=torch.long, device=self.device)
+        for layer_idx, (key, value) in enumerate(past):
+            self.keys[layer_idx].index_copy_(1, index, key[:, :, -1].transpose(0, 1))
+            self.values[layer_idx].index_copy_(1, index, value[:, :, -1].transpose(0, 1))
+
+    def gather(self, tables, max_len: int, lengths=None):
+        """按块表收集各序列前lengths个位置的KV，左填充到max_len后拼为批次（每层形状为 (batch, heads, max_len, dim)）
+
+        填充位置读取槽位0，由注意力掩码屏蔽。
+        """
+        lengths = lengths or [len(table) for table in tables]
+        slots = []
+        for table, length in zip(tables, lengths):
+            slots.extend([0] * (max_len - length))
+            slots.extend(table.slots[:length])
+        index = torch.tensor(slots, dtype=torch.long, device=self.device)
+        batch = len(tables)
+        past = []
+        for keys, values in zip(self.keys, self.values):
+            key = keys.index_select(1, index).view(keys.shape[0], batch, max_len, keys.shape[2]).transpose(0, 1)
+            value = values.index_select(1, index).view(values.shape[0], batch, max_len, values.shape[2]).transpose(0, 1)
+            past.append((key, value))
+        return tuple(past)
+
+    def close(self):
+        """释放内存池并更新指标"""
+        KV_BLOCKS_USED.dec(self.used_blocks)
+        KV_BLOCKS_TOTAL.dec(self.num_blocks)
+        self.keys, self.values = [], []
+        self._free, self._refs = [], []
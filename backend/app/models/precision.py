@@ -0,0 +1,77 @@
+import torch
+from app.utils import get_logger
+
+logger = get_logger()
+
+PRECISIONS = ("auto", "fp32", "bf16", "int8")
+
+
+def cpu_supports_bf16() -> bool:
+    """CPU是否有原生bfloat16指令（AVX512-BF16 或 AMX），否则bf16计算会退化为软件模拟"""
+    for check in ("_is_avx512_bf16_supported", "_is_amx_tile_supported"):
+        func = getattr(torch.cpu, check, None)
+        if func is not None and func():
+            return True
+    return False
+
+
+def int8_supported() -> bool:
+    """当前torch是否支持CPU动态int8量化"""
+    return hasattr(torch.ao.quantization, "quantize_dynamic") and \
+        any(engine in torch.backends.quantized.supported_engines for engine in ("x86", "fbgemm", "qnnpack", "onednn"))
+
+
+def resolve_precision(precision: str) -> str:
+    """校验精度配置，不支持时回退到fp32（CUDA上auto使用fp16）"""
+    precision = (precision or "auto").lower()
+    if precision not in PRECISIONS:
+        logger.warning(f"未知的模型精度 {precision}，可选值: {', '.join(PRECISIONS)}，回退到auto")
+        precision = "auto"
+    if torch.cuda.is_available():
+        if precision == "int8":
+            logger.warning("动态int8量化仅支持CPU推理，回退到fp16")
+            return "fp16"
+        return "fp16" if precision == "auto" else precision
+    if precision == "auto":
+        return "fp32"
+    if precision == "bf16" and not cpu_supports_bf16():
+        logger.warning("当前CPU不支持原生bfloat16计算，回退到fp32")
+        return "fp32"
+    if precision == "int8" and not int8_supported():
+        logger.warning("当前torch不支持动态int8量化，回退到fp32")
+        return "fp32"
+    return precision
+
+
+def load_dtype(precision: str) -> torch.dtype:
+    """加载模型权重时使用的数据类型，int8先按fp32加载再量化"""
+    return {"fp16": torch.float16, "bf16": torch.bfloat16}.get(precision, torch.float32)
+
+
+def apply_precision(model, precision: str):
+    """对已加载的模型应用精度模式，int8对全部Linear层做动态量化"""
+    if precision == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def _tensor_bytes(value) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(_tensor_bytes(item) for item in value)
+    return 0
+
+
+def model_size_bytes(model) -> int:
+    """模型权重占用的字节数（包含量化后的打包权重）"""
+    # 共享权重（如词嵌入与输出层）只计算一次
+    seen = set()
+    total = 0
+    for value in model.state_dict().values():
+        if isinstance(value, torch.Tensor):
+            if value.data_ptr() in seen:
+                continue
+            seen.add(value.data_ptr())
+        total += _tensor_bytes(value)
+    return total
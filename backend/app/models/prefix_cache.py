@@ -0,0 +1,80 @@
+import threading
+from collections import OrderedDict
+from prometheus_client import Counter
+from app.models.paged_kv import PagedKVCache, BlockTable
+from app.utils import get_logger, get_or_create_metric
+
+logger = get_logger()
+
+PREFIX_CACHE_LOOKUPS = get_or_create_metric(Counter, "prefix_kv_cache_lookups_total", "Shared system-prompt prefix KV cache lookups", ["result"])
+REUSED_PREFIX_TOKENS = get_or_create_metric(Counter, "prefix_kv_cache_reused_tokens_total", "Prompt tokens served from the shared prefix KV cache")
+
+
+class PrefixCache:
+    """共享的系统提示词前缀KV缓存
+
+    每个不同的前缀（开头连续的system消息）只预填充一次，其KV所在的块由缓存持有一份引用，
+    以相同前缀开头的请求（不限会话）共享这些块，只预填充前缀之后的部分。
+    共享块只读：序列写入与前缀共用的末尾块前由分块缓存复制一份。
+    缓存持有的块数超过上限时按LRU释放引用，块在没有序列使用后归还内存池。
+    """
+
+    def __init__(self, kv_cache: PagedKVCache, max_blocks: int):
+        self.kv_cache = kv_cache
+        self.max_blocks = max_blocks
+        self.total_blocks = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_blocks > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, prefix_ids) -> BlockTable:
+        """返回前缀的块表，未命中时返回None"""
+        if not self.enabled or not prefix_ids:
+            return None
+        key = tuple(prefix_ids)
+        with self._lock:
+            table = self._entries.get(key)
+            if table is not None:
+                self._entries.move_to_end(key)
+        return table
+
+    def insert(self, prefix_ids, table: BlockTable):
+        """缓存序列块表中前缀部分的KV（共享块而不复制）"""
+        if not self.enabled or not prefix_ids:
+            return
+        key = tuple(prefix_ids)
+        if self.kv_cache.blocks_for(len(key)) > self.max_blocks:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            entry = self.kv_cache.fork(table, len(key))
+            self._entries[key] = entry
+            self.total_blocks += len(entry.blocks)
+            logger.debug(f"缓存提示词前缀KV: {len(key)} tokens")
+            while self.total_blocks > self.max_blocks:
+                self._evict_oldest()
+
+    def evict_oldest(self) -> bool:
+        """释放最久未使用的前缀，缓存为空时返回False"""
+        with self._lock:
+            if not self._entries:
+                return False
+            self._evict_oldest()
+            return True
+
+    def _evict_oldest(self):
+        _, table = self._entries.popitem(last=False)
+        self.total_blocks -= len(table.blocks)
+        self.kv_cache.release(table)
+
+    def clear(self):
+        """释放全部前缀"""
+        while self.evict_oldest():
+            pass
@@ -0,0 +1,106 @@
+import torch
+
+
+def fork_seed(seed: int, index: int) -> int:
+    """第index个兄弟请求使用的seed，未指定seed时返回None"""
+    return None if seed is None else seed + index + 1
+
+
+def _row_tensor(values, default: float, device) -> torch.Tensor:
+    return torch.tensor([default if value is None else value for value in values], dtype=torch.float32, device=device)
+
+
+def apply_repetition_penalty(logits: torch.Tensor, requests) -> torch.Tensor:
+    """对各行已出现过的token（提示词和已生成部分）施加该行的重复惩罚：正logit除以惩罚系数，负logit乘以惩罚系数"""
+    rows = [i for i, request in enumerate(requests) if request.repetition_penalty not in (None, 1.0)]
+    if not rows:
+        return logits
+    row_index, token_index = [], []
+    for i in rows:
+        token_ids = requests[i].prompt_ids + requests[i].output_ids
+        row_index.extend([i] * len(token_ids))
+        token_index.extend(token_ids)
+    seen = torch.zeros(logits.shape, dtype=torch.bool, device=logits.device)
+    seen[torch.tensor(row_index, device=logits.device), torch.tensor(token_index, device=logits.device)] = True
+    penalty = _row_tensor([request.repetition_penalty for request in requests], 1.0, logits.device)[:, None]
+    return torch.where(seen, torch.where(logits > 0, logits / penalty, logits * penalty), logits)
+
+
+def _truncate(probs: torch.Tensor, top_p: torch.Tensor, top_k: torch.Tensor, candidates: int = 256):
+    """按top_k和top_p截断各行分布，返回按概率降序排列的候选概率（被截掉的置0）及其token id
+
+    先用topk只取前candidates个候选，比对整个词表排序快得多；有top_k限制的行保留的token都在候选内，
+    其余行候选的累计概率不足top_p时才对整行排序。
+    """
+    vocab_size = probs.shape[-1]
+    k = min(vocab_size, max(candidates, int(top_k.max())))
+    sorted_probs, sorted_indices = torch.topk(probs, k, dim=-1)
+    cumulative = torch.cumsum(sorted_probs, dim=-1)
+    if k < vocab_size and not bool(((top_k > 0) | (cumulative[:, -1] >= top_p)).all()):
+        sorted_probs, sorted_indices = torch.sort(probs, dim=-1, descending=True)
+        cumulative = torch.cumsum(sorted_probs, dim=-1)
+    # 保留累计概率达到top_p所需的最少token，且不超过top_k个（0表示不限制）
+    drop = (cumulative - sorted_probs) > top_p[:, None]
+    ranks = torch.arange(sorted_probs.shape[-1], device=probs.device)[None, :]
+    drop |= (top_k[:, None] > 0) & (ranks >= top_k[:, None])
+    return sorted_probs.masked_fill(drop, 0), sorted_indices
+
+
+def _sampling_tensors(logits: torch.Tensor, requests):
+    """各行的温度缩放后的分布，以及top_p、top_k张量"""
+    device = logits.device
+    temperature = _row_tensor([request.temperature for request in requests], 0.0, device).clamp_min(1e-5)
+    probs = torch.softmax(logits.float() / temperature[:, None], dim=-1)
+    top_p = _row_tensor([request.top_p for request in requests], 1.0, device)
+    top_k = torch.tensor([request.top_k or 0 for request in requests], dtype=torch.long, device=device)
+    return probs, top_p, top_k
+
+
+def sampling_probs(logits: torch.Tensor, requests) -> torch.Tensor:
+    """按各行请求的温度、top_k和top_p计算采样分布，logits形状为 (batch, vocab)，所有行一次完成"""
+    probs, top_p, top_k = _sampling_tensors(logits, requests)
+    if bool((top_p >= 1.0).all()) and not bool((top_k > 0).any()):
+        return probs
+    sorted_probs, sorted_indices = _truncate(probs, top_p, top_k)
+    probs = torch.zeros_like(probs).scatter_(-1, sorted_indices, sorted_probs)
+    return probs / probs.sum(dim=-1, keepdim=True)
+
+
+def _draw(probs: torch.Tensor, uniforms: torch.Tensor) -> torch.Tensor:
+    """按累积分布为每行选出第一个累积概率超过随机数的位置，概率为0的位置不会被选中"""
+    cdf = torch.cumsum(probs, dim=-1)
+    choice = torch.searchsorted(cdf, (uniforms * cdf[:, -1])[:, None], right=True).squeeze(-1)
+    return choice.clamp_max(probs.shape[-1] - 1)
+
+
+def sample(logits: torch.Tensor, requests) -> list:
+    """按各行请求的采样参数对一批logits一次完成采样，返回每行的token id
+
+    温度、top_p、top_k和重复惩罚以张量形式逐行生效，参数不同的请求可以在同一批次中解码；
+    只有设置了top_p或top_k的行需要截断分布，其余行直接从完整分布中采样。
+    每行从该请求自己的随机数生成器取一个均匀随机数，再按累积分布选出token：
+    指定了seed的请求每个token只消耗一次随机数，结果与批次中的其他请求无关。
+    """
+    logits = apply_repetition_penalty(logits.float(), requests)
+    device = logits.device
+    token_ids = torch.argmax(logits, dim=-1)
+    sampled = torch.tensor([bool(request.temperature) and request.temperature > 0 for request in requests], device=device)
+    if bool(sampled.any()):
+        rows = sampled.nonzero().squeeze(-1)
+        sampled_requests = [requests[i] for i in rows.tolist()]
+        uniforms = torch.rand(len(sampled_requests))
+        for i, request in enumerate(sampled_requests):
+            if request.generator is not None:
+                uniforms[i] = torch.rand(1, generator=request.generator)[0]
+        uniforms = uniforms.to(device)
+        probs, top_p, top_k = _sampling_tensors(logits[rows], sampled_requests)
+        truncated = (top_p < 1.0) | (top_k > 0)
+        choice = torch.empty(len(sampled_requests), dtype=torch.long, device=device)
+        if bool((~truncated).any()):
+            choice[~truncated] = _draw(probs[~truncated], uniforms[~truncated])
+        if bool(truncated.any()):
+            sorted_probs, sorted_indices = _truncate(probs[truncated], top_p[truncated], top_k[truncated])
+            index = _draw(sorted_probs, uniforms[truncated])
+            choice[truncated] = sorted_indices.gather(-1, index[:, None]).squeeze(-1)
+        token_ids[rows] = choice
+    return token_ids.tolist()
@@ -0,0 +1,883 @@
+import asyncio
+import queue
+import threading
+from collections import deque
+import torch
+from prometheus_client import Counter, Gauge
+from app.config import settings
+from app.models.compiled import bucket_length
+from app.models.detokenizer import IncrementalDetokenizer
+from app.models.stopping import StopMatcher
+from app.models.paged_kv import PagedKVCache, BlockTable, KVCacheFullError, KV_ADMISSION_DEFERRED
+from app.models.sampling import sample, sampling_probs, fork_seed
+from app.models.backends import InferenceBackend, TorchBackend, _to_cache, _to_legacy
+from app.models.prefix_cache import PrefixCache, PREFIX_CACHE_LOOKUPS, REUSED_PREFIX_TOKENS
+from app.utils import get_logger, generate_id, get_or_create_metric
+
+logger = get_logger()
+
+QUEUE_DEPTH = get_or_create_metric(Gauge, "inference_queue_depth", "Generation requests waiting for admission")
+RUNNING_SEQUENCES = get_or_create_metric(Gauge, "inference_running_sequences", "Sequences in the running decode batch")
+REJECTED_REQUESTS = get_or_create_metric(Counter, "inference_rejected_total", "Generation requests rejected because the queue was full")
+CANCELLED_REQUESTS = get_or_create_metric(Counter, "inference_cancelled_total", "Generation requests cancelled before completion")
+SPECULATIVE_DRAFT_TOKENS = get_or_create_metric(Counter, "speculative_draft_tokens_total", "Tokens proposed by the draft model")
+SPECULATIVE_ACCEPTED_TOKENS = get_or_create_metric(Counter, "speculative_accepted_tokens_total", "Draft tokens accepted by the main model")
+SPECULATIVE_ACCEPTANCE_RATE = get_or_create_metric(Gauge, "speculative_acceptance_rate", "Fraction of draft tokens accepted since startup")
+
+
+class QueueFullError(Exception):
+    """推理等待队列已满"""
+    pass
+
+
+class CancellationToken:
+    """取消令牌，可在任意线程或协程中触发，调度器在下一个解码步停止对应的生成"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback):
+        """注册取消时的回调，已取消时立即调用"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+
+class GenerationRequest:
+    """生成请求句柄，由调度器线程写入生成结果"""
+
+    def __init__(self, prompt_ids, max_new_tokens: int = 200, temperature: float = 0.7, top_p: float = 1.0,
+                 session_id: str = None, cancel_token: CancellationToken = None, low_priority: bool = False,
+                 stop: list = None, prefix_len: int = 0, top_k: int = 0, repetition_penalty: float = 1.0,
+                 seed: int = None):
+        self.request_id = generate_id("gen-")
+        self.session_id = session_id
+        # 提示词开头固定前缀（system消息）的长度，这部分KV在请求之间共享
+        self.prefix_len = prefix_len if 0 < prefix_len < len(prompt_ids) else 0
+        # 低优先级请求（离线批处理）只在没有在线请求等待时接纳
+        self.low_priority = low_priority
+        self.cancel_token = cancel_token or CancellationToken()
+        self.prompt_ids = list(prompt_ids)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.repetition_penalty = repetition_penalty
+        # 指定seed时用独立的随机数生成器采样，相同参数的请求结果可复现
+        self.seed = seed
+        self.generator = torch.Generator().manual_seed(seed) if seed is not None else None
+        # 停止序列，生成的文本中出现任一序列时停止（返回的文本不包含该序列）
+        self.stop = list(stop or [])
+        self.output_ids = []
+        self.finish_reason = None
+        self.error = None
+        # 生成token在模型分布下的累计对数概率，用于best_of挑选候选
+        self.cumulative_logprob = 0.0
+        # 共享本请求提示词和预填充的兄弟请求（n>1时的其余候选）
+        self.forks = []
+        self._tokens = queue.Queue()
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._async_tokens = None
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_token.cancelled
+
+    @property
+    def usage(self) -> dict:
+        """本次生成的token用量：输入为实际送入模型的提示词长度，输出为生成的token数"""
+        prompt_tokens = len(self.prompt_ids)
+        completion_tokens = len(self.output_ids)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+
+    @property
+    def group(self) -> list:
+        """本请求及其全部兄弟请求"""
+        return [self] + self.forks
+
+    @property
+    def mean_logprob(self) -> float:
+        """每个生成token的平均对数概率"""
+        return self.cumulative_logprob / max(1, len(self.output_ids))
+
+    def fork(self) -> "GenerationRequest":
+        """创建共享同一提示词、采样参数和取消令牌的兄弟请求，调度器只为整组做一次预填充
+
+        指定了seed时各兄弟请求依次使用 seed+1、seed+2...，候选之间互不相同且各自可复现。
+        """
+        sibling = GenerationRequest(self.prompt_ids, self.max_new_tokens, self.temperature, self.top_p,
+                                    cancel_token=self.cancel_token, low_priority=self.low_priority, stop=self.stop,
+                                    prefix_len=self.prefix_len, top_k=self.top_k, repetition_penalty=self.repetition_penalty,
+                                    seed=fork_seed(self.seed, len(self.forks)))
+        self.forks.append(sibling)
+        return sibling
+
+    def cancel(self):
+        """取消生成，兄弟请求共享取消令牌，一并取消（整组都已结束时无效果）"""
+        if not all(member.done for member in self.group):
+            self.cancel_token.cancel()
+
+    def _publish(self, item):
+        """把token投递给消费者：已绑定事件循环时投递到异步队列，否则投递到线程队列"""
+        with self._lock:
+            if self._loop is None:
+                self._tokens.put(item)
+                return
+            try:
+                self._loop.call_soon_threadsafe(self._async_tokens.put_nowait, item)
+            except RuntimeError:
+                # 事件循环已关闭，消费者不再接收
+                pass
+
+    def _emit(self, token_id: int):
+        self.output_ids.append(token_id)
+        self._publish(token_id)
+
+    def _finish(self, reason: str, error: Exception = None):
+        if self._done.is_set():
+            return
+        self.finish_reason = reason
+        self.error = error
+        self._done.set()
+        self._publish(None)
+
+    def _attach_loop(self):
+        """绑定当前事件循环，并迁移已产生但尚未消费的token"""
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._loop = asyncio.get_running_loop()
+            self._async_tokens = asyncio.Queue()
+            while True:
+                try:
+                    self._async_tokens.put_nowait(self._tokens.get_nowait())
+                except queue.Empty:
+                    break
+
+    def iter_tokens(self):
+        """逐个返回生成的token id，直到生成结束"""
+        while True:
+            token_id = self._tokens.get()
+            if token_id is None:
+                break
+            yield token_id
+        if self.error is not None:
+            raise self.error
+
+    async def wait(self):
+        """在事件循环中等待生成结束并返回全部生成的token id"""
+        async for _ in self.aiter_tokens():
+            pass
+        return self.output_ids
+
+    async def aiter_tokens(self):
+        """在事件循环中逐个等待生成的token id，不阻塞事件循环"""
+        self._attach_loop()
+        while True:
+            token_id = await self._async_tokens.get()
+            if token_id is None:
+                break
+            yield token_id
+        if self.error is not None:
+            raise self.error
+
+    def result(self, timeout: float = None):
+        """等待生成结束并返回全部生成的token id"""
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.output_ids
+
+
+class EmbeddingTask:
+    """向量化任务句柄，由调度器线程写入池化后的向量"""
+
+    def __init__(self, token_ids):
+        self.request_id = generate_id("emb-")
+        self.token_ids = list(token_ids)
+        self.embedding = None
+        self.finish_reason = None
+        self.error = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._future = None
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def cancel(self):
+        """取消尚未计算的任务，调度器取出时直接丢弃"""
+        self._finish("cancelled")
+
+    def _complete(self, embedding: list):
+        self.embedding = embedding
+        self._finish("stop")
+
+    def _finish(self, reason: str, error: Exception = None):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self.finish_reason = reason
+            self.error = error
+            self._done.set()
+            loop, future = self._loop, self._future
+        if future is not None:
+            try:
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+            except RuntimeError:
+                # 事件循环已关闭，消费者不再接收
+                pass
+
+    async def wait(self) -> list:
+        """在事件循环中等待计算结束并返回向量"""
+        with self._lock:
+            if not self._done.is_set() and self._future is None:
+                self._loop = asyncio.get_running_loop()
+                self._future = self._loop.create_future()
+            future = self._future
+        if future is not None:
+            await future
+        if self.error is not None:
+            raise self.error
+        return self.embedding
+
+    def result(self, timeout: float = None) -> list:
+        """等待计算结束并返回向量"""
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.embedding
+
+
+class _Sequence:
+    """调度器内部的运行中序列"""
+
+    def __init__(self, request: GenerationRequest, table: BlockTable, cache_len: int, next_token: int, tokenizer=None):
+        self.request = request
+        # KV所在的块表，以及按最大生成长度预留、尚未分配的块数
+        self.table = table
+        self.reserved = 0
+        self.cache_len = cache_len
+        self.next_token = next_token
+        # 请求带停止序列时逐token解码并增量匹配
+        self.detokenizer = IncrementalDetokenizer(tokenizer) if request.stop and tokenizer is not None else None
+        self.stop_matcher = StopMatcher(request.stop) if self.detokenizer is not None else None
+        # 草稿模型的KV及其覆盖的token数，仅在推测解码时使用
+        self.draft_past = None
+        self.draft_len = 0
+
+    @property
+    def cached_token_ids(self):
+        """已写入KV的token id（提示词加已送入模型的生成token）"""
+        return (self.request.prompt_ids + self.request.output_ids)[:self.cache_len]
+
+
+class BatchScheduler:
+    """连续批处理调度器
+
+    在每个解码步之间接纳新请求加入运行中的批次，并在序列结束时立即移出，
+    所有运行中的序列共享一次批量前向计算，整个调度线程运行在torch.inference_mode下。提供草稿模型时，批次中只有一个序列
+    的解码步改为推测解码：草稿模型连续提议多个token，主模型一次前向验证。
+    model为推理后端（InferenceBackend），传入transformers模型时包装为torch后端；草稿模型总是transformers模型。
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = settings.MAX_BATCH_SIZE,
+                 max_queue_size: int = settings.INFERENCE_QUEUE_SIZE, session_cache=None,
+                 draft_model=None, num_speculative_tokens: int = settings.SPECULATIVE_TOKENS,
+                 prefill_buckets: list = None, embedding_batch_size: int = settings.EMBEDDING_BATCH_SIZE,
+                 embedding_pooling: str = settings.EMBEDDING_POOLING, kv_cache_bytes: int = settings.KV_CACHE_MB * 1024 * 1024,
+                 kv_block_size: int = settings.KV_BLOCK_SIZE, prefix_cache_bytes: int = settings.PREFIX_CACHE_MB * 1024 * 1024,
+                 thread_config: dict = None):
+        self.backend = model if isinstance(model, InferenceBackend) else TorchBackend(model, tokenizer)
+        self.model = self.backend.model
+        self.tokenizer = tokenizer
+        self.session_cache = session_cache
+        self.draft_model = draft_model
+        self.num_speculative_tokens = max(1, num_speculative_tokens)
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_queue_size = max(0, max_queue_size)
+        self.eos_token_ids = self._resolve_eos_token_ids()
+        self.prefill_buckets = prefill_buckets or []
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+        self.max_positions = self.backend.max_positions
+        self._waiting = deque()
+        self._background = deque()
+        self._embeddings = deque()
+        self.embedding_batch_size = max(1, embedding_batch_size)
+        self.embedding_pooling = embedding_pooling
+        self.kv_cache = self._create_kv_cache(kv_cache_bytes, kv_block_size)
+        self.prefix_cache = PrefixCache(self.kv_cache, prefix_cache_bytes // self.kv_cache.block_bytes)
+        self.thread_config = thread_config or {}
+        self._running = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    @torch.inference_mode()
+    def _create_kv_cache(self, max_bytes: int, block_size: int) -> PagedKVCache:
+        """按一次单token前向得到的各层KV形状创建分块KV缓存池
+
+        块数不超过每个批次槽位都用满模型上下文长度所需的数量（另加写时复制的余量）。
+        """
+        _, past = self.backend.prefill(torch.tensor([[self.pad_token_id]], dtype=torch.long, device=self.backend.device))
+        layer_shapes = [(key.shape[1], key.shape[3], value.shape[3]) for key, value in past]
+        max_blocks = None
+        if self.max_positions != float("inf"):
+            max_blocks = self.max_batch_size * (-(-self.max_positions // max(1, block_size)) + 1)
+        return PagedKVCache(layer_shapes, past[0][0].dtype, self.backend.device, max_bytes, block_size, max_blocks)
+
+    def _resolve_eos_token_ids(self):
+        eos_ids = set()
+        if self.tokenizer.eos_token_id is not None:
+            eos_ids.add(self.tokenizer.eos_token_id)
+        generation_config = self.backend.generation_config
+        config_eos = getattr(generation_config, "eos_token_id", None)
+        if isinstance(config_eos, int):
+            eos_ids.add(config_eos)
+        elif config_eos:
+            eos_ids.update(config_eos)
+        return eos_ids
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        """提交生成请求，将在下一个解码步被接纳；等待队列已满时立即拒绝
+
+        低优先级请求进入单独的后台队列，不占用在线请求的队列长度，由提交方自行控制数量。
+        """
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("调度器已停止")
+            if request.low_priority:
+                self._background.append(request)
+                self._cond.notify()
+                return request
+            # 批次中的空闲槽位可立即接纳，其余请求最多排队 max_queue_size 个
+            free_slots = max(0, self.max_batch_size - len(self._running))
+            if len(self._waiting) >= self.max_queue_size + free_slots:
+                REJECTED_REQUESTS.inc()
+                raise QueueFullError("推理队列已满")
+            self._waiting.append(request)
+            QUEUE_DEPTH.set(len(self._waiting))
+            self._cond.notify()
+        return request
+
+    def submit_embedding(self, task: EmbeddingTask) -> EmbeddingTask:
+        """提交向量化任务，在解码步之间与其他待计算文本合批做一次前向"""
+        return self.submit_embeddings([task])[0]
+
+    def submit_embeddings(self, tasks: list) -> list:
+        """一次提交同一请求的多个向量化任务，全部接纳或全部拒绝
+
+        下一次前向可计算 embedding_batch_size 个文本，其余最多排队 max_queue_size 个，超出时立即拒绝；
+        队列为空时总是接纳，单个请求的文本数可以超过该上限。
+        """
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("调度器已停止")
+            limit = self.max_queue_size + self.embedding_batch_size
+            if self._embeddings and len(self._embeddings) + len(tasks) > limit:
+                # 先移除已取消的任务再判断
+                self._embeddings = deque(task for task in self._embeddings if not task.done)
+                if self._embeddings and len(self._embeddings) + len(tasks) > limit:
+                    REJECTED_REQUESTS.inc()
+                    raise QueueFullError("推理队列已满")
+            self._embeddings.extend(tasks)
+            self._cond.notify()
+        return tasks
+
+    def stop(self):
+        """停止调度器线程"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(timeout=5)
+        if not self._thread.is_alive():
+            self.prefix_cache.clear()
+            self.kv_cache.close()
+
+    @property
+    def num_running(self) -> int:
+        return len(self._running)
+
+    @property
+    def num_waiting(self) -> int:
+        return len(self._waiting) + len(self._background) + len(self._embeddings)
+
+    @property
+    def acceptance_rate(self) -> float:
+        """草稿token被主模型接受的比例"""
+        return self.accepted_tokens / self.draft_tokens if self.draft_tokens else 0.0
+
+    @torch.inference_mode()
+    def _loop(self):
+        # 在第一次前向之前应用线程配置，本线程创建的torch计算线程继承其CPU亲和性
+        self.backend.apply_thread_config(self.thread_config)
+        while True:
+            with self._cond:
+                while not self._stopped and not self._waiting and not self._background and not self._embeddings and not self._running:
+                    self._cond.wait()
+                if self._stopped:
+                    break
+                self._drop_cancelled()
+                admitted, slots = [], len(self._running)
+                # 空闲块数扣除运行中序列为生成剩余token预留的块
+                available = self.kv_cache.free_blocks - sum(seq.reserved for seq in self._running)
+                # 在线请求优先，没有在线请求等待时才接纳后台队列中的请求
+                for pending in (self._waiting, self._background):
+                    while pending and not (pending is self._background and self._waiting):
+                        width = len(pending[0].group)
+                        # 候选数超过批大小的请求只在批次为空时接纳
+                        if slots + width > self.max_batch_size and slots > 0:
+                            break
+                        needed = self._blocks_needed(pending[0])
+                        if needed > self.kv_cache.num_blocks:
+                            request = pending.popleft()
+                            for member in request.group:
+                                member._finish("error", KVCacheFullError("请求所需的KV缓存超过缓存池容量"))
+                            continue
+                        # 块不足时先释放前缀缓存中的块，仍不足时等待运行中的序列结束后再接纳
+                        while needed > available:
+                            free_blocks = self.kv_cache.free_blocks
+                            if not self.prefix_cache.evict_oldest():
+                                break
+                            available += self.kv_cache.free_blocks - free_blocks
+                        if needed > available:
+                            KV_ADMISSION_DEFERRED.inc()
+                            break
+                        admitted.append(pending.popleft())
+                        slots += width
+                        available -= needed
+                QUEUE_DEPTH.set(len(self._waiting))
+                embeddings = []
+                while self._embeddings and len(embeddings) < self.embedding_batch_size:
+                    task = self._embeddings.popleft()
+                    # 已取消的任务直接丢弃
+                    if not task.done:
+                        embeddings.append(task)
+
+            if embeddings:
+                self._embed(embeddings)
+            # 后台请求按命中的共享前缀分组，每组一次前向完成预填充
+            background = {}
+            for request in admitted:
+                if not request.low_priority:
+                    self._prefill(request)
+                    continue
+                prefix_ids = tuple(request.prompt_ids[:request.prefix_len])
+                if self.prefix_cache.lookup(prefix_ids) is None:
+                    prefix_ids = ()
+                background.setdefault(prefix_ids, []).append(request)
+            for prefix_ids, requests in background.items():
+                if len(requests) > 1:
+                    self._prefill_batch(requests, prefix_ids)
+                else:
+                    self._prefill(requests[0])
+            self._drop_cancelled()
+            if self.draft_model is not None and len(self._running) == 1 and not self._waiting and not self._background \
+                    and self._can_speculate(self._running[0].request):
+                self._speculative_step(self._running[0])
+            elif self._running:
+                self._decode_step()
+            RUNNING_SEQUENCES.set(len(self._running))
+
+        for seq in self._running:
+            self._free(seq)
+            seq.request._finish("abort", RuntimeError("调度器已停止"))
+        for request in list(self._waiting) + list(self._background):
+            for member in request.group:
+                member._finish("abort", RuntimeError("调度器已停止"))
+        for task in self._embeddings:
+            task._finish("abort", RuntimeError("调度器已停止"))
+
+    def _drop_cancelled(self):
+        """移除已取消的请求，立即释放其批次槽位"""
+        for pending in (self._waiting, self._background):
+            for request in [request for request in pending if request.cancelled]:
+                pending.remove(request)
+                for member in request.group:
+                    self._cancel(member)
+        running = []
+        for seq in self._running:
+            if seq.request.cancelled:
+                self._free(seq)
+                self._cancel(seq.request)
+            else:
+                running.append(seq)
+        self._running = running
+
+    def _cancel(self, request: GenerationRequest):
+        CANCELLED_REQUESTS.inc()
+        logger.info(f"生成已取消 [{request.request_id}]，已生成 {len(request.output_ids)} tokens")
+        request._finish("cancelled")
+
+    def _acquire_prefix(self, prefix_ids):
+        """查找共享前缀缓存，命中时返回持有其块引用的块表（用完后需release），避免使用期间被淘汰"""
+        table = self.prefix_cache.lookup(prefix_ids)
+        return self.kv_cache.fork(table) if table is not None else None
+
+    def _record_prefix(self, request: GenerationRequest, hit: bool):
+        """记录带固定前缀的请求是否命中共享前缀缓存"""
+        if request.prefix_len and self.prefix_cache.enabled:
+            PREFIX_CACHE_LOOKUPS.labels(result="hit" if hit else "miss").inc()
+            if hit:
+                REUSED_PREFIX_TOKENS.inc(request.prefix_len)
+
+    def _prefill(self, request: GenerationRequest):
+        """对新接纳的请求做预填充，并采样第一个token
+
+        若会话KV缓存中存在匹配的前缀，只预填充前缀之后的新token；否则若共享前缀缓存中有提示词的固定前缀
+        （system消息），只预填充固定前缀之后的部分。
+        请求带有兄弟请求时整组共享这次预填充的KV，各自从同一分布采样第一个token。
+        """
+        prefix = None
+        try:
+            prefix_len, past = 0, None
+            if self.session_cache is not None:
+                prefix_len, past = self.session_cache.lookup(request.session_id, request.prompt_ids)
+            if prefix_len < request.prefix_len:
+                prefix = self._acquire_prefix(request.prompt_ids[:request.prefix_len])
+                self._record_prefix(request, prefix is not None)
+                if prefix is not None:
+                    prefix_len, past = request.prefix_len, self.kv_cache.gather([prefix], request.prefix_len)
+            device = self.backend.device
+            new_ids = request.prompt_ids[prefix_len:]
+            # 编译模式下把输入右填充到分桶长度以复用已编译的图，因果注意力下填充不影响真实token
+            padded_len = bucket_length(len(new_ids), self.prefill_buckets)
+            if prefix_len + padded_len > self.max_positions:
+                padded_len = len(new_ids)
+            input_ids = torch.tensor([new_ids + [self.pad_token_id] * (padded_len - len(new_ids))], dtype=torch.long, device=device)
+            logits, past = self.backend.prefill(input_ids, past)
+            logits = logits[0, len(new_ids) - 1]
+            if padded_len > len(new_ids):
+                past = tuple((key[:, :, :len(request.prompt_ids)], value[:, :, :len(request.prompt_ids)]) for key, value in past)
+        except Exception as e:
+            logger.error(f"预填充失败 [{request.request_id}]: {str(e)}", exc_info=True)
+            for member in request.group:
+                member._finish("error", e)
+            past = None
+        if past is not None:
+            self._start(request, past, logits, prefix)
+        if prefix is not None:
+            self.kv_cache.release(prefix)
+
+    def _prefill_batch(self, requests, prefix_ids=()):
+        """把多个没有会话缓存的请求右填充到相同长度，一次前向完成预填充
+
+        因果注意力下右侧填充不影响真实token，各行在自身最后一个token处取logits，并裁掉填充部分的KV。
+        提供prefix_ids时这些请求共享缓存中的同一固定前缀，只预填充前缀之后的部分。
+        """
+        prefix = self._acquire_prefix(prefix_ids) if prefix_ids else None
+        prefix_len = len(prefix) if prefix is not None else 0
+        for request in requests:
+            self._record_prefix(request, prefix is not None)
+        lengths = [len(request.prompt_ids) - prefix_len for request in requests]
+        padded_len = bucket_length(max(lengths), self.prefill_buckets)
+        if prefix_len + padded_len > self.max_positions:
+            padded_len = max(lengths)
+        try:
+            input_ids = torch.tensor(
+                [request.prompt_ids[prefix_len:] + [self.pad_token_id] * (padded_len - length) for request, length in zip(requests, lengths)],
+                dtype=torch.long, device=self.backend.device
+            )
+            past = self.kv_cache.gather([prefix] * len(requests), prefix_len) if prefix is not None else None
+            logits, past = self.backend.prefill(input_ids, past)
+        except Exception as e:
+            logger.error(f"批量预填充失败: {str(e)}", exc_info=True)
+            for request in requests:
+                for member in request.group:
+                    member._finish("error", e)
+            past = None
+        if past is not None:
+            for i, (request, length) in enumerate(zip(requests, lengths)):
+                row_past = tuple((key[i:i + 1, :, :prefix_len + length], value[i:i + 1, :, :prefix_len + length]) for key, value in past)
+                self._start(request, row_past, logits[i, length - 1], prefix)
+        if prefix is not None:
+            self.kv_cache.release(prefix)
+
+    def _embed(self, tasks):
+        """右填充后一次前向计算一批文本的最后一层隐藏状态，按注意力掩码池化并L2归一化
+
+        隐藏状态由推理后端计算，torch后端只运行不含输出层的基座模型，与生成共用同一份权重。
+        """
+        lengths = [len(task.token_ids) for task in tasks]
+        max_len = max(lengths)
+        device = self.backend.device
+        try:
+            input_ids = torch.tensor(
+                [task.token_ids + [self.pad_token_id] * (max_len - length) for task, length in zip(tasks, lengths)],
+                dtype=torch.long, device=device
+            )
+            attention_mask = (torch.arange(max_len, device=device)[None, :] < torch.tensor(lengths, device=device)[:, None]).long()
+            hidden = self.backend.embed(input_ids, attention_mask).float()
+            if self.embedding_pooling == "last":
+                pooled = hidden[torch.arange(len(tasks), device=device), torch.tensor(lengths, device=device) - 1]
+            else:
+                mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+                pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1)
+            pooled = torch.nn.functional.normalize(pooled, dim=-1).cpu()
+        except Exception as e:
+            logger.error(f"向量计算失败: {str(e)}", exc_info=True)
+            for task in tasks:
+                task._finish("error", e)
+            return
+        for task, embedding in zip(tasks, pooled):
+            task._complete(embedding.tolist())
+
+    def _start(self, request: GenerationRequest, past, logits: torch.Tensor, prefix: BlockTable = None):
+        """把预填充得到的提示词KV写入分块缓存，为请求及其兄弟请求采样第一个token，未结束的序列加入批次
+
+        提供prefix时共享前缀缓存中的块，只写入前缀之后的KV；否则把提示词的固定前缀加入前缀缓存。
+        """
+        table = self.kv_cache.fork(prefix) if prefix is not None else BlockTable()
+        start = len(table)
+        try:
+            self.kv_cache.extend(table, len(request.prompt_ids) - start)
+            self.kv_cache.write(table, start, tuple((key[:, :, start:], value[:, :, start:]) for key, value in past))
+        except KVCacheFullError as e:
+            logger.error(f"KV缓存块不足 [{request.request_id}]: {str(e)}")
+            self.kv_cache.release(table)
+            for member in request.group:
+                member._finish("error", e)
+            return
+        if prefix is None and request.prefix_len:
+            self.prefix_cache.insert(request.prompt_ids[:request.prefix_len], table)
+        # 兄弟序列共享提示词的块，各自向共享的末尾块写入前先复制
+        tables = [table] + [self.kv_cache.fork(table) for _ in request.forks]
+        reserved = self._generation_blocks(request)
+        token_ids = sample(logits.unsqueeze(0).expand(len(request.group), -1), request.group)
+        for member, member_table, token_id in zip(request.group, tables, token_ids):
+            seq = _Sequence(member, member_table, len(request.prompt_ids), token_id, self.tokenizer)
+            seq.reserved = reserved
+            if not self._advance(seq, token_id, logits):
+                self._running.append(seq)
+
+    def _generation_blocks(self, request: GenerationRequest) -> int:
+        """单个序列在提示词之外最多还需要的块数（含对共享末尾块写时复制的一块）"""
+        prompt_len = len(request.prompt_ids)
+        return self.kv_cache.blocks_for(prompt_len + request.max_new_tokens) - self.kv_cache.blocks_for(prompt_len) + 1
+
+    def _blocks_needed(self, request: GenerationRequest) -> int:
+        """接纳请求需要的块数：整组共享的提示词块加各序列生成所需的块"""
+        return self.kv_cache.blocks_for(len(request.prompt_ids)) + len(request.group) * self._generation_blocks(request)
+
+    def _extend(self, seq: _Sequence, num_tokens: int):
+        """为序列追加num_tokens个位置的槽位，并从预留块数中扣除新分配的块"""
+        seq.reserved = max(0, seq.reserved - self.kv_cache.extend(seq.table, num_tokens))
+
+    def _free(self, seq: _Sequence):
+        """归还序列持有的KV块"""
+        self.kv_cache.release(seq.table)
+        seq.reserved = 0
+        seq.draft_past = None
+
+    def _decode_step(self):
+        """对所有运行中的序列执行一次批量解码"""
+        batch = self._running
+        max_len = max(seq.cache_len for seq in batch)
+        device = self.backend.device
+
+        attention_mask = torch.zeros((len(batch), max_len + 1), dtype=torch.long, device=device)
+        for i, seq in enumerate(batch):
+            attention_mask[i, max_len - seq.cache_len:] = 1
+        input_ids = torch.tensor([[seq.next_token] for seq in batch], dtype=torch.long, device=device)
+        position_ids = torch.tensor([[seq.cache_len] for seq in batch], dtype=torch.long, device=device)
+
+        try:
+            # 按块表收集各序列的KV，左填充后拼接为批次
+            past = self.kv_cache.gather([seq.table for seq in batch], max_len)
+            logits, past = self.backend.decode_step(input_ids, attention_mask, position_ids, past)
+            # 只把本步新token的KV写回各序列的块
+            for seq in batch:
+                self._extend(seq, 1)
+            self.kv_cache.write_last([seq.table for seq in batch], past)
+        except Exception as e:
+            logger.error(f"批量解码失败: {str(e)}", exc_info=True)
+            for seq in batch:
+                self._free(seq)
+                seq.request._finish("error", e)
+            self._running = []
+            return
+
+        # 各序列的采样参数按行组成张量，整批一次完成采样
+        token_ids = sample(logits[:, -1], [seq.request for seq in batch])
+        still_running = []
+        for i, (seq, token_id) in enumerate(zip(batch, token_ids)):
+            seq.cache_len += 1
+            seq.next_token = token_id
+            if not self._advance(seq, token_id, logits[i, -1]):
+                still_running.append(seq)
+        self._running = still_running
+
+    def _draft_forward(self, seq: _Sequence, token_ids) -> torch.Tensor:
+        """把token送入草稿模型，返回最后一个位置的logits"""
+        device = self.draft_model.device
+        forward_kwargs = {"input_ids": torch.tensor([token_ids], dtype=torch.long, device=device), "use_cache": True}
+        if seq.draft_past is not None:
+            forward_kwargs["past_key_values"] = _to_cache(seq.draft_past)
+            forward_kwargs["attention_mask"] = torch.ones((1, seq.draft_len + len(token_ids)), dtype=torch.long, device=device)
+        outputs = self.draft_model(**forward_kwargs)
+        seq.draft_past = _to_legacy(outputs.past_key_values)
+        seq.draft_len += len(token_ids)
+        return outputs.logits[0, -1].to(self.backend.device)
+
+    def _can_speculate(self, request: GenerationRequest) -> bool:
+        """重复惩罚依赖逐个确定的上文，指定seed的请求需逐token消耗随机数才能复现，二者都按普通解码处理"""
+        return request.seed is None and request.repetition_penalty in (None, 1.0)
+
+    def _speculative_step(self, seq: _Sequence):
+        """推测解码：草稿模型提议k个token，主模型一次前向验证
+
+        贪心解码时接受与主模型argmax一致的最长前缀；采样时按 min(1, p/q) 接受，
+        拒绝处从 max(0, p - q) 重新采样，输出分布与只用主模型一致。
+        """
+        request = seq.request
+        k = min(self.num_speculative_tokens, request.max_new_tokens - len(request.output_ids) - 1)
+        if k < 1:
+            self._decode_step()
+            return
+        greedy = not request.temperature or request.temperature <= 0
+        device = self.backend.device
+
+        try:
+            # 草稿模型补齐批量解码期间落下的token，再逐个提议
+            cached_ids = seq.cached_token_ids
+            if seq.draft_len > len(cached_ids):
+                seq.draft_past, seq.draft_len = None, 0
+            logits = self._draft_forward(seq, cached_ids[seq.draft_len:] + [seq.next_token])
+            draft_ids, draft_probs = [], []
+            for i in range(k):
+                if greedy:
+                    probs, token_id = None, int(torch.argmax(logits))
+                else:
+                    probs = sampling_probs(logits[None], [request])[0]
+                    token_id = int(torch.multinomial(probs, num_samples=1))
+                draft_ids.append(token_id)
+                draft_probs.append(probs)
+                if i < k - 1:
+                    logits = self._draft_forward(seq, [token_id])
+
+            target_logits, target_past = self.backend.prefill(
+                torch.tensor([[seq.next_token] + draft_ids], dtype=torch.long, device=device),
+                self.kv_cache.gather([seq.table], seq.cache_len)
+            )
+            target_logits = target_logits[0]
+
+            accepted, final_id = [], None
+            for i, token_id in enumerate(draft_ids):
+                if greedy:
+                    target_id = int(torch.argmax(target_logits[i]))
+                    if target_id != token_id:
+                        final_id = target_id
+                        break
+                else:
+                    p, q = sampling_probs(target_logits[i][None], [request])[0], draft_probs[i]
+                    if float(torch.rand(())) * float(q[token_id]) > float(p[token_id]):
+                        residual = torch.clamp(p - q, min=0)
+                        if float(residual.sum()) <= 0:
+                            residual = p
+                        final_id = int(torch.multinomial(residual / residual.sum(), num_samples=1))
+                        break
+                accepted.append(token_id)
+            if final_id is None:
+                final_id = sample(target_logits[k][None], [request])[0]
+        except Exception as e:
+            logger.error(f"推测解码失败 [{request.request_id}]: {str(e)}", exc_info=True)
+            self._free(seq)
+            request._finish("error", e)
+            self._running.remove(seq)
+            return
+
+        self.draft_tokens += k
+        self.accepted_tokens += len(accepted)
+        SPECULATIVE_DRAFT_TOKENS.inc(k)
+        SPECULATIVE_ACCEPTED_TOKENS.inc(len(accepted))
+        SPECULATIVE_ACCEPTANCE_RATE.set(self.acceptance_rate)
+
+        # 只把已接受部分的KV写回块中，被拒绝的草稿token从两个模型的缓存中裁掉
+        start, seq.cache_len = seq.cache_len, seq.cache_len + 1 + len(accepted)
+        try:
+            self._extend(seq, seq.cache_len - start)
+            self.kv_cache.write(seq.table, start, tuple(
+                (key[:, :, start:seq.cache_len], value[:, :, start:seq.cache_len])
+                for key, value in target_past
+            ))
+        except KVCacheFullError as e:
+            logger.error(f"推测解码写入KV缓存失败 [{request.request_id}]: {str(e)}")
+            self._free(seq)
+            request._finish("error", e)
+            self._running.remove(seq)
+            return
+        if seq.draft_len > seq.cache_len:
+            seq.draft_len = seq.cache_len
+            seq.draft_past = tuple((key[:, :, :seq.cache_len], value[:, :, :seq.cache_len]) for key, value in seq.draft_past)
+
+        for i, token_id in enumerate(accepted + [final_id]):
+            seq.next_token = token_id
+            if self._advance(seq, token_id, target_logits[i]):
+                self._running.remove(seq)
+                return
+
+    def _advance(self, seq: _Sequence, token_id: int, logits: torch.Tensor = None) -> bool:
+        """输出新token，返回序列是否已结束；logits为采样该token时的模型输出，用于累计对数概率"""
+        request = seq.request
+        if logits is not None:
+            request.cumulative_logprob += float(torch.log_softmax(logits.float(), dim=-1)[token_id])
+        if token_id in self.eos_token_ids:
+            self._release(seq)
+            request._finish("stop")
+            return True
+        request._emit(token_id)
+        if seq.stop_matcher is not None:
+            seq.stop_matcher.push(seq.detokenizer.push(token_id))
+            if seq.stop_matcher.stopped:
+                self._release(seq)
+                request._finish("stop")
+                return True
+        if len(request.output_ids) >= request.max_new_tokens:
+            self._release(seq)
+            request._finish("length")
+            return True
+        return False
+
+    def _release(self, seq: _Sequence):
+        """序列结束时把KV保存到会话缓存供下一轮对话复用，并归还其KV块"""
+        if self.session_cache is not None and seq.request.session_id:
+            try:
+                # 推测解码在结束符处提前结束时，KV可能比已输出的token多
+                token_ids = seq.cached_token_ids
+                past = self.kv_cache.gather([seq.table], len(token_ids), lengths=[len(token_ids)])
+                self.session_cache.store(seq.request.session_id, token_ids, past)
+            except Exception as e:
+                logger.warning(f"保存会话KV缓存失败 [{seq.request.session_id}]: {str(e)}")
+        self._free(seq)
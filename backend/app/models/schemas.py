@@ -1,5 +1,5 @@
 from typing import List, Optional, Union, Dict, Any
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from datetime import datetime
 
 
@@ -11,6 +11,9 @@ class ChatMessageContentItem(BaseModel):
 class ChatMessage(BaseModel):
     role: str
     content: Union[str, List[ChatMessageContentItem]]
+    # 从数据库加载的历史消息在写入时保存的token id及其来源，不出现在请求和响应中
+    _token_ids: Optional[List[int]] = PrivateAttr(default=None)
+    _token_source: Optional[str] = PrivateAttr(default=None)
 
 
 class ChatCompletionRequest(BaseModel):
@@ -18,9 +21,14 @@ class ChatCompletionRequest(BaseModel):
     messages: List[ChatMessage] = Field(description="聊天消息历史")
     temperature: Optional[float] = Field(default=0.7, ge=0, le=2, description="采样温度")
     top_p: Optional[float] = Field(default=1.0, ge=0, le=1, description="核采样")
+    top_k: Optional[int] = Field(default=None, ge=0, description="只从概率最高的k个token中采样，0表示不限制")
+    repetition_penalty: Optional[float] = Field(default=None, gt=0, description="重复惩罚，大于1时降低已出现token的概率")
+    seed: Optional[int] = Field(default=None, description="随机种子，相同种子和参数的请求采样结果可复现")
     max_tokens: Optional[int] = Field(default=None, gt=0, description="最大生成token数")
     stream: Optional[bool] = Field(default=False, description="是否启用流式输出")
     stop: Optional[Union[str, List[str]]] = Field(default=None, description="停止词")
+    n: Optional[int] = Field(default=1, ge=1, description="返回的候选回复数")
+    best_of: Optional[int] = Field(default=None, ge=1, description="生成的候选数，返回其中平均对数概率最高的n个")
     user: Optional[str] = Field(default=None, description="用户标识符")
 
 
@@ -64,11 +72,38 @@ class ChatCompletionChunk(BaseModel):
     choices: List[ChatCompletionChunkChoice]
 
 
+class EmbeddingRequest(BaseModel):
+    model: str = Field(default="stellar-byte-llm", description="模型名称")
+    input: Union[str, List[str]] = Field(description="待向量化的文本或文本列表")
+    encoding_format: Optional[str] = Field(default="float", pattern="^(float|base64)$", description="向量格式：float 或 base64")
+    user: Optional[str] = Field(default=None, description="用户标识符")
+
+
+class EmbeddingData(BaseModel):
+    object: str = "embedding"
+    index: int
+    embedding: Union[List[float], str]
+
+
+class EmbeddingUsage(BaseModel):
+    prompt_tokens: int
+    total_tokens: int
+
+
+class EmbeddingResponse(BaseModel):
+    object: str = "list"
+    data: List[EmbeddingData]
+    model: str
+    usage: EmbeddingUsage
+
+
 class ModelInfo(BaseModel):
     id: str
     object: str = "model"
     created: int
     owned_by: str
+    status: Optional[str] = None  # resident 已加载，loading 加载中，cold 未加载
+    alias_of: Optional[str] = None  # 未单独配置权重、由默认模型提供服务时为默认模型的ID
 
 
 class ModelListResponse(BaseModel):
@@ -77,8 +112,9 @@ class ModelListResponse(BaseModel):
 
 
 class ChatWebSocketMessage(BaseModel):
-    type: str
-    content: str
+    type: str  # chat.message 发送消息，chat.cancel 取消当前生成
+    content: str = ""
+    model: Optional[str] = None  # 使用的模型ID，为空时使用默认模型
 
 
 class SessionStartEvent(BaseModel):
@@ -133,4 +169,21 @@ class APIKeyCreateResponse(APIKeyResponse):
 
 
 class APIKeyListResponse(BaseModel):
-    data: List[APIKeyResponse]
\ No newline at end of file
+    data: List[APIKeyResponse]
+
+
+# 离线批处理相关的数据模型
+class BatchJobResponse(BaseModel):
+    id: str
+    object: str = "batch"
+    status: str  # queued, running, completed, failed, cancelled
+    total: int
+    completed: int
+    failed: int
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+
+
+class BatchJobListResponse(BaseModel):
+    data: List[BatchJobResponse]
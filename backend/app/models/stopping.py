@@ -0,0 +1,63 @@
+from app.models.context import TURN_STOP_SEQUENCES
+
+
+def stop_sequences(stop=None) -> list:
+    """合并请求的停止序列（字符串或列表）与提示词格式的轮次边界，去重并忽略空字符串"""
+    if isinstance(stop, str):
+        stop = [stop]
+    sequences = []
+    for sequence in list(stop or []) + TURN_STOP_SEQUENCES:
+        if sequence and sequence not in sequences:
+            sequences.append(sequence)
+    return sequences
+
+
+def truncate_at_stop(text: str, stop) -> str:
+    """在最早出现的停止序列处截断文本，停止序列本身不保留"""
+    positions = [text.find(sequence) for sequence in stop or []]
+    positions = [position for position in positions if position >= 0]
+    return text[:min(positions)] if positions else text
+
+
+class StopMatcher:
+    """增量检测停止序列
+
+    逐段加入生成的文本，返回可以安全输出的部分：末尾可能是某个停止序列开头的文本先暂存，
+    遇到完整的停止序列时在其之前截断并标记stopped，停止序列本身及之后的文本不输出。
+    """
+
+    def __init__(self, stop):
+        self.stop = [sequence for sequence in stop or [] if sequence]
+        self.stopped = False
+        self._pending = ""
+
+    def push(self, text: str) -> str:
+        """加入新生成的文本，返回可以输出的文本（可能为空）"""
+        if self.stopped or not text:
+            return ""
+        # 暂存的文本短于最长的停止序列，每次只需在这一小段中查找
+        self._pending += text
+        truncated = truncate_at_stop(self._pending, self.stop)
+        if len(truncated) < len(self._pending):
+            self.stopped = True
+            self._pending = ""
+            return truncated
+        held = self._held_length()
+        safe = self._pending[:len(self._pending) - held]
+        self._pending = self._pending[len(safe):]
+        return safe
+
+    def flush(self) -> str:
+        """生成结束时输出暂存的文本"""
+        text, self._pending = self._pending, ""
+        return text
+
+    def _held_length(self) -> int:
+        """暂存文本末尾与某个停止序列开头相同的最长长度"""
+        held = 0
+        for sequence in self.stop:
+            for length in range(min(len(sequence) - 1, len(self._pending)), held, -1):
+                if self._pending.endswith(sequence[:length]):
+                    held = length
+                    break
+        return held
@@ -0,0 +1,188 @@
+import json
+import os
+import threading
+import time
+import torch
+from app.config import settings
+from app.utils import get_logger
+
+logger = get_logger()
+
+# 自动调优使用的固定提示词
+AUTOTUNE_PROMPT = "User: 请详细介绍一下你自己，以及你能帮我做些什么。\nAssistant:"
+
+
+def available_cores() -> list:
+    """当前进程可以使用的CPU核"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def parse_cores(value: str) -> list:
+    """解析CPU核列表配置，如 0-3,6"""
+    cores = []
+    for item in (value or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "-" in item:
+            start, end = item.split("-", 1)
+            cores.extend(range(int(start), int(end) + 1))
+        else:
+            cores.append(int(item))
+    return sorted(set(cores))
+
+
+def set_interop_threads(threads: int):
+    """设置torch的inter-op线程数；只能在进程内第一次并行计算之前设置，之后的设置被忽略"""
+    if threads <= 0:
+        return
+    try:
+        torch.set_num_interop_threads(threads)
+    except RuntimeError:
+        logger.debug("inter-op线程数已生效，忽略设置")
+
+
+def apply_thread_config(config: dict):
+    """在当前线程应用torch线程数和CPU亲和性
+
+    torch的计算线程由首次执行并行计算的线程创建并继承其亲和性，因此需在推理线程第一次前向之前调用。
+    """
+    if config.get("threads"):
+        torch.set_num_threads(config["threads"])
+    if config.get("cores") and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, config["cores"])
+
+
+def default_thread_config() -> dict:
+    """由 TORCH_THREADS 和 CPU_AFFINITY 决定的线程配置，未配置时沿用torch默认值"""
+    return {
+        "threads": settings.TORCH_THREADS or torch.get_num_threads(),
+        "cores": parse_cores(settings.CPU_AFFINITY) or None,
+        "source": "settings"
+    }
+
+
+def candidate_configs(cores: list) -> list:
+    """待测的线程配置：使用全部核、留出一个核给API和分词线程、使用一半的核；
+    线程数少于可用核数时另测把推理线程绑定到前N个核"""
+    total = len(cores)
+    configs = []
+    for threads in sorted({total, max(1, total - 1), max(1, total // 2)}, reverse=True):
+        configs.append({"threads": threads, "cores": None})
+        if threads < total:
+            configs.append({"threads": threads, "cores": cores[:threads]})
+    return configs
+
+
+class ThreadAutotuner:
+    """推理线程自动调优
+
+    启动时用固定提示词对几组线程数和CPU亲和性配置各做一次预填充和解码，
+    按解码吞吐（throughput）或首token延迟（ttft）选出最优配置，并按模型、可用核和推理后端版本保存到文件，
+    之后启动时直接使用保存的结果。每组配置在新线程中测量，使torch的计算线程按该配置重新创建。
+    """
+
+    def __init__(self, path: str = settings.THREAD_AUTOTUNE_PATH, target: str = settings.THREAD_AUTOTUNE_TARGET,
+                 prompt_tokens: int = 128, decode_tokens: int = 32):
+        self.path = path
+        self.target = target if target in ("throughput", "ttft") else "throughput"
+        self.prompt_tokens = prompt_tokens
+        self.decode_tokens = decode_tokens
+        self._lock = threading.Lock()
+
+    def configure(self, backend, model_path: str) -> dict:
+        """返回推理线程配置：未开启自动调优时使用配置项，开启时优先使用保存的调优结果"""
+        if not settings.THREAD_AUTOTUNE:
+            return default_thread_config()
+        cores = available_cores()
+        key = f"{os.path.abspath(model_path)}|{','.join(map(str, cores))}|{backend.version}|{self.target}"
+        with self._lock:
+            saved = self._load().get(key)
+            if saved is not None:
+                logger.info(f"使用保存的线程调优结果: {saved['threads']} 线程，绑定核: {saved['cores']}")
+                return dict(saved, source="saved")
+            try:
+                config = self.tune(backend, cores)
+            except Exception as e:
+                logger.warning(f"线程调优失败，使用默认配置: {str(e)}")
+                return default_thread_config()
+            results = self._load()
+            results[key] = config
+            self._save(results)
+        return dict(config, source="autotune")
+
+    def tune(self, backend, cores: list) -> dict:
+        """逐个测量候选配置，返回最优配置及其测量结果"""
+        prompt_ids = (backend.tokenizer.encode(AUTOTUNE_PROMPT, add_special_tokens=False) * self.prompt_tokens)[:self.prompt_tokens]
+        original_threads = torch.get_num_threads()
+        best = None
+        for config in candidate_configs(cores):
+            ttft, tokens_per_second = self._measure(backend, prompt_ids, config)
+            logger.info(f"线程调优: {config['threads']} 线程，绑定核: {config['cores']}，"
+                        f"首token {ttft * 1000:.1f}ms，解码 {tokens_per_second:.1f} tokens/s")
+            result = dict(config, ttft_ms=round(ttft * 1000, 2), tokens_per_second=round(tokens_per_second, 2))
+            if best is None or self._better(result, best):
+                best = result
+        torch.set_num_threads(original_threads)
+        logger.info(f"线程调优完成（目标: {self.target}）: {best['threads']} 线程，绑定核: {best['cores']}")
+        return best
+
+    def _better(self, result: dict, best: dict) -> bool:
+        if self.target == "ttft":
+            return result["ttft_ms"] < best["ttft_ms"]
+        return result["tokens_per_second"] > best["tokens_per_second"]
+
+    def _measure(self, backend, prompt_ids, config: dict):
+        """在新线程中按配置运行一次预热和一次计时的预填充+解码，返回 (首token耗时, 解码tokens/s)"""
+        results = []
+
+        @torch.inference_mode()
+        def run():
+            backend.apply_thread_config(config)
+            device = backend.device
+            for _ in range(2):
+                start = time.perf_counter()
+                logits, past = backend.prefill(torch.tensor([prompt_ids], dtype=torch.long, device=device))
+                ttft = time.perf_counter() - start
+                token_id = int(torch.argmax(logits[0, -1]))
+                start = time.perf_counter()
+                for length in range(len(prompt_ids), len(prompt_ids) + self.decode_tokens):
+                    logits, past = backend.decode_step(
+                        torch.tensor([[token_id]], dtype=torch.long, device=device),
+                        torch.ones((1, length + 1), dtype=torch.long, device=device),
+                        torch.tensor([[length]], dtype=torch.long, device=device),
+                        past
+                    )
+                    token_id = int(torch.argmax(logits[0, -1]))
+                results.append((ttft, self.decode_tokens / (time.perf_counter() - start)))
+
+        thread = threading.Thread(target=run, name="thread-autotune", daemon=True)
+        thread.start()
+        thread.join()
+        if not results:
+            raise RuntimeError("线程调优测量失败")
+        # 第一次为预热，只取第二次的结果
+        return results[-1]
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as tuning_file:
+                return json.load(tuning_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, results: dict):
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as tuning_file:
+                json.dump(results, tuning_file, ensure_ascii=False, indent=2)
+        except OSError as e:
+            logger.warning(f"保存线程调优结果失败: {str(e)}")
+
+
+# 全局线程调优器
+thread_autotuner = ThreadAutotuner()
@@ -0,0 +1,441 @@
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+from collections import OrderedDict
+import torch
+from prometheus_client import Gauge
+from transformers import AutoConfig
+from app.config import settings
+from app.models.context import ContextBuilder
+from app.models.inference import LLMInference
+from app.models.backends import TorchBackend, load_tokenizer, resolve_backend
+from app.models.scheduler import GenerationRequest, EmbeddingTask, QueueFullError, REJECTED_REQUESTS
+from app.models.paged_kv import KVCacheFullError
+from app.models.sampling import fork_seed
+from app.utils import get_logger, get_or_create_metric
+
+logger = get_logger()
+
+WORKER_INFLIGHT = get_or_create_metric(Gauge, "inference_worker_inflight", "Generation requests assigned to each inference worker", ["worker"])
+
+
+
+def worker_threads(num_workers: int) -> int:
+    """每个推理进程的线程数：未配置时按可用CPU核数平均分配"""
+    if settings.WORKER_THREADS > 0:
+        return settings.WORKER_THREADS
+    return max(1, (os.cpu_count() or 1) // max(1, num_workers))
+
+
+def _error_payload(error: Exception):
+    """把推理进程中的错误转换为可跨进程传递的 (是否为拒绝, 错误信息)；队列已满和KV缓存不足都属于拒绝"""
+    if error is None:
+        return None
+    return isinstance(error, (QueueFullError, KVCacheFullError)), str(error)
+
+
+def _remote_error(payload) -> Exception:
+    """还原推理进程返回的错误，拒绝还原为QueueFullError，与API进程内推理一样返回503"""
+    if payload is None:
+        return None
+    rejected, message = payload
+    return QueueFullError(message) if rejected else RuntimeError(message)
+
+
+class _EventSender:
+    """推理进程经自己的管道向API进程发送事件
+
+    每个进程使用独立的管道而不是共享的队列：进程在写入中途被杀死时只会断开自己的管道，
+    不会一直持有共享队列的写锁使其他进程无法返回结果。调度线程和命令循环都会发送，用锁避免消息交错。
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._lock = threading.Lock()
+
+    def put(self, event):
+        with self._lock:
+            self._connection.send(event)
+
+
+class _WorkerRequest(GenerationRequest):
+    """推理进程内的生成请求，把token和结束状态转发给API进程"""
+
+    def __init__(self, events, request_id: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.request_id = request_id
+        self._events = events
+
+    def _publish(self, item):
+        if item is None:
+            self._events.put(("finish", self.request_id, (self.finish_reason, _error_payload(self.error), self.cumulative_logprob)))
+        else:
+            self._events.put(("token", self.request_id, item))
+
+
+class _WorkerEmbeddingTask(EmbeddingTask):
+    """推理进程内的向量化任务，把向量或错误转发给API进程"""
+
+    def __init__(self, events, request_id: str, token_ids):
+        super().__init__(token_ids)
+        self.request_id = request_id
+        self._events = events
+
+    def _finish(self, reason: str, error: Exception = None):
+        if self.done:
+            return
+        super()._finish(reason, error)
+        self._events.put(("embedding", self.request_id, (self.embedding, _error_payload(error))))
+
+
+def _pin_threads(index: int, threads: int) -> dict:
+    """设置torch线程数，并在核数足够时把进程绑定到独立的一组CPU核，返回本进程的线程配置"""
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    config = {"threads": threads, "cores": None, "source": "workers"}
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        assigned = cores[index * threads:(index + 1) * threads]
+        if len(assigned) == threads:
+            os.sched_setaffinity(0, assigned)
+            config["cores"] = assigned
+    return config
+
+
+def _worker_main(index: int, model_path: str, draft_model_path: str, threads: int, commands, connection):
+    """推理进程入口：加载模型后循环处理API进程发来的提交和取消命令"""
+    events = _EventSender(connection)
+    try:
+        # 推理进程按进程数平均分配CPU核，不再单独调优
+        llm = LLMInference(model_path, draft_model_path, thread_config=_pin_threads(index, threads))
+    except Exception as e:
+        events.put(("error", index, str(e)))
+        return
+    events.put(("ready", index, {"memory_bytes": llm.memory_bytes, "precision": llm.precision, "compiled": llm.compiled}))
+
+    requests = {}
+    embeddings = {}
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+        action, request_id, payload = command
+        if action == "submit":
+            (prompt_ids, max_new_tokens, temperature, top_p, session_id, fork_ids, low_priority, stop, prefix_len,
+             top_k, repetition_penalty, seed) = payload
+            request = _WorkerRequest(events, request_id, prompt_ids, max_new_tokens, temperature, top_p, session_id,
+                                     low_priority=low_priority, stop=stop, prefix_len=prefix_len, top_k=top_k,
+                                     repetition_penalty=repetition_penalty, seed=seed)
+            for index, fork_id in enumerate(fork_ids):
+                request.forks.append(_WorkerRequest(events, fork_id, prompt_ids, max_new_tokens, temperature, top_p,
+                                                    cancel_token=request.cancel_token, low_priority=low_priority, stop=stop,
+                                                    prefix_len=prefix_len, top_k=top_k, repetition_penalty=repetition_penalty,
+                                                    seed=fork_seed(seed, index)))
+            try:
+                llm.scheduler.submit(request)
+                requests[request_id] = request
+            except Exception as e:
+                events.put(("failed", None, ([member.request_id for member in request.group], _error_payload(e))))
+        elif action == "embed":
+            # 同一请求的向量化任务一起提交，全部接纳或全部拒绝
+            tasks = [_WorkerEmbeddingTask(events, task_id, token_ids) for task_id, token_ids in payload]
+            try:
+                llm.scheduler.submit_embeddings(tasks)
+                embeddings.update((task.request_id, task) for task in tasks)
+            except Exception as e:
+                events.put(("failed", None, ([task.request_id for task in tasks], _error_payload(e))))
+        elif action == "cancel":
+            request = requests.get(request_id) or embeddings.get(request_id)
+            if request is not None:
+                request.cancel()
+        # 清理整组都已结束的请求和已结束的向量化任务
+        for finished_id in [key for key, request in requests.items() if all(member.done for member in request.group)]:
+            del requests[finished_id]
+        for finished_id in [key for key, task in embeddings.items() if task.done]:
+            del embeddings[finished_id]
+    llm.close()
+
+
+class _WorkerHandle:
+    def __init__(self, index: int, process, commands, events):
+        self.index = index
+        self.process = process
+        self.commands = commands
+        # 接收该进程事件的管道，进程退出后管道断开，不再等待
+        self.events = events
+        self.connected = True
+        self.inflight = {}
+        # 加载完模型并报告就绪后才分派请求
+        self.ready = False
+
+
+class WorkerPoolInference(LLMInference):
+    """多进程推理
+
+    启动多个推理进程，每个进程加载一份模型并使用固定的线程数；API进程只负责分词，
+    把生成请求分派给负载最低的进程，并把各进程返回的token写回请求句柄。
+    不调用LLMInference的初始化（API进程不加载模型），只沿用其分词、提交和流式输出的方法，
+    模型相关的属性由推理进程就绪时报告。
+    """
+
+    def __init__(self, model_path: str = settings.MODEL_PATH, draft_model_path: str = settings.DRAFT_MODEL_PATH,
+                 num_workers: int = settings.INFERENCE_WORKERS):
+        logger.info(f"正在启动 {num_workers} 个推理进程: {model_path}")
+        self.model_path = model_path
+        self.draft_model_path = draft_model_path
+        self.tokenizer = load_tokenizer(model_path)
+        config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+        self.max_context_tokens = settings.MAX_CONTEXT_TOKENS or getattr(config, "max_position_embeddings", None) or 2048
+        self.context_builder = ContextBuilder(self.tokenizer, self.max_context_tokens)
+        self.backend = None
+        self.model = None
+        self.draft_model = None
+        self.session_cache = None
+        self.scheduler = None
+        self.backend_name = resolve_backend(settings.INFERENCE_BACKEND)
+        # 精度和编译状态由推理进程就绪时报告
+        self.precision = None
+        self.compiled = False
+        # 推理进程按同一配置加载推理后端，只有torch后端支持向量化
+        self.supports_embeddings = self.backend_name == TorchBackend.name
+        self.capacity = settings.MAX_BATCH_SIZE + settings.INFERENCE_QUEUE_SIZE
+        self.threads = worker_threads(num_workers)
+        self.thread_config = {"threads": self.threads, "cores": None, "workers": num_workers, "source": "workers"}
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._worker_bytes = {}
+        self._stopped = False
+        self._workers = [self._start_worker(index) for index in range(num_workers)]
+        self._wait_ready(set(range(num_workers)))
+        self._receiver = threading.Thread(target=self._receive_loop, name="worker-receiver", daemon=True)
+        self._receiver.start()
+        logger.info(f"推理进程已就绪，每个进程 {self.threads} 个线程")
+
+    def _start_worker(self, index: int) -> _WorkerHandle:
+        commands = self._context.Queue()
+        events, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, self.model_path, self.draft_model_path, self.threads, commands, sender),
+            name=f"inference-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        # 只保留推理进程持有的写端，进程退出时读端即可读到EOF
+        sender.close()
+        return _WorkerHandle(index, process, commands, events)
+
+    def _receive(self, timeout: float) -> list:
+        """等待各推理进程返回事件，返回收到的 (类型, 编号, 内容) 列表"""
+        with self._lock:
+            connections = {worker.events: worker for worker in self._workers if worker.connected}
+        events = []
+        for connection in multiprocessing.connection.wait(list(connections), timeout):
+            try:
+                events.append(connection.recv())
+            except (EOFError, OSError):
+                connections[connection].connected = False
+        return events
+
+    def _wait_ready(self, pending: set):
+        """等待推理进程加载完成，任一进程加载失败时停止全部进程"""
+        deadline = time.monotonic() + settings.WORKER_START_TIMEOUT
+        while pending:
+            events = self._receive(timeout=1)
+            if not events:
+                exited = [index for index in pending if not self._workers[index].process.is_alive()]
+                if exited or time.monotonic() > deadline:
+                    self.close()
+                    raise RuntimeError(f"推理进程启动失败: {exited}" if exited else "等待推理进程启动超时")
+            for kind, index, payload in events:
+                if kind == "error":
+                    self.close()
+                    raise RuntimeError(f"推理进程 {index} 加载模型失败: {payload}")
+                if kind == "ready":
+                    self._mark_ready(index, payload)
+                    pending.discard(index)
+
+    def _mark_ready(self, index: int, status: dict):
+        """记录推理进程报告的模型状态，此后才向该进程分派请求"""
+        with self._lock:
+            self._worker_bytes[index] = status["memory_bytes"]
+            self.precision = status["precision"]
+            self.compiled = status["compiled"]
+            self._workers[index].ready = True
+
+    @property
+    def memory_bytes(self) -> int:
+        return sum(self._worker_bytes.values())
+
+    @property
+    def busy(self) -> bool:
+        return any(worker.inflight for worker in self._workers)
+
+    def _select_worker(self, session_id: str = None, width: int = 1) -> _WorkerHandle:
+        """选择负载最低的已就绪推理进程，负载相同时优先上一次处理该会话的进程以复用会话KV缓存"""
+        available = [worker for worker in self._workers
+                     if worker.ready and len(worker.inflight) + width <= max(self.capacity, width)]
+        if not available:
+            return None
+        least = min(len(worker.inflight) for worker in available)
+        preferred = self._sessions.get(session_id) if session_id else None
+        for worker in available:
+            if worker.index == preferred and len(worker.inflight) == least:
+                return worker
+        return min(available, key=lambda worker: len(worker.inflight))
+
+    def _dispatch(self, request: GenerationRequest) -> GenerationRequest:
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("推理进程已停止")
+            worker = self._select_worker(request.session_id, len(request.group))
+            if worker is None:
+                REJECTED_REQUESTS.inc()
+                raise QueueFullError("推理队列已满")
+            for member in request.group:
+                worker.inflight[member.request_id] = member
+            WORKER_INFLIGHT.labels(worker=str(worker.index)).set(len(worker.inflight))
+            if request.session_id:
+                self._sessions[request.session_id] = worker.index
+                self._sessions.move_to_end(request.session_id)
+                while len(self._sessions) > settings.WORKER_SESSION_AFFINITY_SIZE:
+                    self._sessions.popitem(last=False)
+        payload = (request.prompt_ids, request.max_new_tokens, request.temperature, request.top_p, request.session_id,
+                   [fork.request_id for fork in request.forks], request.low_priority, request.stop, request.prefix_len,
+                   request.top_k, request.repetition_penalty, request.seed)
+        worker.commands.put(("submit", request.request_id, payload))
+        request.cancel_token.add_callback(lambda: self._cancel(request))
+        return request
+
+    def _cancel(self, request: GenerationRequest):
+        """把取消命令发给当前持有该请求的推理进程；请求已结束或所在进程已重启时无需取消"""
+        member_ids = {member.request_id for member in request.group}
+        with self._lock:
+            worker = next((worker for worker in self._workers if member_ids & worker.inflight.keys()), None)
+        if worker is not None:
+            worker.commands.put(("cancel", request.request_id, None))
+
+    def _dispatch_embeddings(self, tasks: list) -> list:
+        """同一请求的向量化任务交给同一个推理进程，全部接纳或全部拒绝"""
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("推理进程已停止")
+            worker = self._select_worker(width=len(tasks))
+            if worker is None:
+                REJECTED_REQUESTS.inc()
+                raise QueueFullError("推理队列已满")
+            for task in tasks:
+                worker.inflight[task.request_id] = task
+            WORKER_INFLIGHT.labels(worker=str(worker.index)).set(len(worker.inflight))
+        worker.commands.put(("embed", None, [(task.request_id, task.token_ids) for task in tasks]))
+        return tasks
+
+    def cancel_embeddings(self, tasks: list):
+        """取消尚未完成的向量化任务，并通知所在的推理进程不再计算"""
+        cancelled = []
+        with self._lock:
+            for worker in self._workers:
+                for task in tasks:
+                    if worker.inflight.pop(task.request_id, None) is not None:
+                        cancelled.append((worker, task))
+                WORKER_INFLIGHT.labels(worker=str(worker.index)).set(len(worker.inflight))
+        for worker, task in cancelled:
+            task.cancel()
+            worker.commands.put(("cancel", task.request_id, None))
+
+    def _receive_loop(self):
+        """接收各推理进程返回的token和结束状态
+
+        每隔WORKER_CHECK_INTERVAL秒检查一次进程存活，其他进程持续返回token时也不会漏掉已退出的进程。
+        """
+        interval = settings.WORKER_CHECK_INTERVAL
+        last_check = time.monotonic()
+        while not self._stopped:
+            if time.monotonic() - last_check >= interval:
+                self._check_workers()
+                last_check = time.monotonic()
+            for kind, request_id, payload in self._receive(timeout=interval):
+                self._handle(kind, request_id, payload)
+
+    def _handle(self, kind: str, request_id, payload):
+        """把推理进程返回的一条事件写回对应的请求句柄"""
+        if kind == "ready":
+            self._mark_ready(request_id, payload)
+            return
+        if kind == "error":
+            logger.error(f"推理进程 {request_id} 重启失败: {payload}")
+            return
+        if kind == "failed":
+            self._fail(*payload)
+            return
+        request = self._find_request(request_id, pop=(kind in ("finish", "embedding")))
+        if request is None:
+            return
+        if kind == "token":
+            request._emit(payload)
+        elif kind == "finish":
+            reason, error, request.cumulative_logprob = payload
+            request._finish(reason, _remote_error(error))
+        elif kind == "embedding":
+            embedding, error = payload
+            if error:
+                request._finish("error", _remote_error(error))
+            else:
+                request._complete(embedding)
+
+    def _fail(self, request_ids: list, error):
+        """推理进程未能接纳提交的请求（整组生成请求或同一请求的全部向量化任务）时逐个结束"""
+        error = _remote_error(error)
+        if isinstance(error, QueueFullError):
+            REJECTED_REQUESTS.inc()
+        for request_id in request_ids:
+            request = self._find_request(request_id, pop=True)
+            if request is not None:
+                request._finish("error", error)
+
+    def _find_request(self, request_id: str, pop: bool = False):
+        with self._lock:
+            for worker in self._workers:
+                request = worker.inflight.get(request_id)
+                if request is not None:
+                    if pop:
+                        del worker.inflight[request_id]
+                        WORKER_INFLIGHT.labels(worker=str(worker.index)).set(len(worker.inflight))
+                    return request
+        return None
+
+    def _check_workers(self):
+        """推理进程意外退出时结束其上的请求并重新启动该进程"""
+        for index, worker in enumerate(self._workers):
+            if self._stopped or worker.process.is_alive():
+                continue
+            logger.error(f"推理进程 {index} 意外退出 (exitcode={worker.process.exitcode})，正在重启")
+            with self._lock:
+                requests = list(worker.inflight.values())
+                worker.inflight.clear()
+                WORKER_INFLIGHT.labels(worker=str(index)).set(0)
+                self._workers[index] = self._start_worker(index)
+            worker.events.close()
+            for request in requests:
+                request._finish("error", RuntimeError("推理进程意外退出"))
+
+    def close(self):
+        """停止全部推理进程"""
+        with self._lock:
+            self._stopped = True
+            workers = list(getattr(self, "_workers", []))
+        for worker in workers:
+            try:
+                worker.commands.put(None)
+            except (OSError, ValueError):
+                pass
+        for worker in workers:
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            for request in worker.inflight.values():
+                request._finish("abort", RuntimeError("推理进程已停止"))
+            worker.inflight.clear()
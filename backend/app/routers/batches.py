@@ -0,0 +1,82 @@
+import os
+from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi.responses import FileResponse
+from sqlalchemy.orm import Session
+from app.models.database import get_db, APIKeyModel, BatchJobModel
+from app.models.schemas import BatchJobResponse, BatchJobListResponse
+from app.services.batch_service import batch_runner, BatchFileTooLargeError
+from app.middleware.api_key_auth import verify_api_key
+from app.utils import get_logger
+
+router = APIRouter()
+logger = get_logger()
+
+
+def batch_job_response(job: BatchJobModel) -> BatchJobResponse:
+    """把任务记录转换为响应模型"""
+    return BatchJobResponse(
+        id=job.id,
+        status=job.status,
+        total=job.total,
+        completed=job.completed,
+        failed=job.failed,
+        error=job.error,
+        created_at=job.created_at,
+        updated_at=job.updated_at
+    )
+
+
+def get_job_or_404(db: Session, batch_id: str) -> BatchJobModel:
+    job = db.get(BatchJobModel, batch_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="批处理任务不存在")
+    return job
+
+
+@router.post("/batches", response_model=BatchJobResponse)
+async def create_batch(
+    request: Request,
+    db: Session = Depends(get_db),
+    api_key: APIKeyModel = Depends(verify_api_key)
+):
+    """创建离线批处理任务，请求体为JSONL，每行一个聊天完成请求（可带custom_id）"""
+    try:
+        job = await batch_runner.create_job(db, request.stream())
+        return batch_job_response(job)
+    except BatchFileTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"创建批处理任务失败: {str(e)}")
+        raise HTTPException(status_code=500, detail="创建批处理任务失败")
+
+
+@router.get("/batches", response_model=BatchJobListResponse)
+async def list_batches(db: Session = Depends(get_db), api_key: APIKeyModel = Depends(verify_api_key)):
+    """获取批处理任务列表"""
+    jobs = db.query(BatchJobModel).order_by(BatchJobModel.created_at.desc()).all()
+    return BatchJobListResponse(data=[batch_job_response(job) for job in jobs])
+
+
+@router.get("/batches/{batch_id}", response_model=BatchJobResponse)
+async def get_batch(batch_id: str, db: Session = Depends(get_db), api_key: APIKeyModel = Depends(verify_api_key)):
+    """获取批处理任务状态和进度"""
+    return batch_job_response(get_job_or_404(db, batch_id))
+
+
+@router.get("/batches/{batch_id}/output")
+async def get_batch_output(batch_id: str, db: Session = Depends(get_db), api_key: APIKeyModel = Depends(verify_api_key)):
+    """下载批处理任务的输出JSONL（任务未结束时为已完成的部分）"""
+    get_job_or_404(db, batch_id)
+    path = batch_runner.output_path(batch_id)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="输出文件尚未生成")
+    return FileResponse(path, media_type="application/jsonl", filename=f"{batch_id}.jsonl")
+
+
+@router.post("/batches/{batch_id}/cancel", response_model=BatchJobResponse)
+async def cancel_batch(batch_id: str, db: Session = Depends(get_db), api_key: APIKeyModel = Depends(verify_api_key)):
+    """取消批处理任务，已写入输出文件的结果保留"""
+    get_job_or_404(db, batch_id)
+    return batch_job_response(batch_runner.cancel_job(db, batch_id))
@@ -1,10 +1,10 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from app.models.inference import LLMInference
+from app.models.model_pool import model_pool, ModelLoadingError
 from app.models.schemas import ChatMessage
+from app.services.chat_service import model_loading_exception
 
 router = APIRouter()
-llm = LLMInference()  # 初始化模型（可替换成单例模式）
 
 
 class ChatRequest(BaseModel):
@@ -22,7 +22,10 @@ async def chat(request: ChatRequest):
         messages = [ChatMessage(role="user", content=request.message)]
         
         # 生成回复
-        reply = llm.chat(messages=messages)
+        async with model_pool.lease() as llm:
+            reply = await llm.achat(messages=messages)
         return ChatResponse(reply=reply)
+    except ModelLoadingError:
+        raise model_loading_exception()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"处理聊天请求失败: {str(e)}")
\ No newline at end of file
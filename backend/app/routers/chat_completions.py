@@ -1,4 +1,5 @@
 import asyncio
+import contextlib
 import uuid
 import json
 import time
@@ -15,12 +16,14 @@ from app.models.schemas import (
     ChatCompletionChunkChoice,
     ChatCompletionChunkDelta
 )
-from app.services.chat_service import ChatService
+from app.services.chat_service import ChatService, model_loading_exception, choice_counts
+from app.config import settings
+from app.models.model_pool import model_pool, ModelLoadingError
 from app.models.database import get_db, APIKeyModel
 from app.services.database_service import DatabaseService
 from app.utils import get_logger
 from app.middleware.api_key_auth import verify_api_key
-from app.routers.models import SUPPORTED_MODELS
+from app.routers.models import supported_model_ids
 
 router = APIRouter()
 logger = get_logger()
@@ -33,23 +36,31 @@ async def create_chat_completion(
     request: ChatCompletionRequest,
     session_id: str = Query(None, description="会话ID，用于保存聊天历史"),
     db: Session = Depends(get_db),
-    api_key: str = Depends(verify_api_key)
+    api_key: APIKeyModel = Depends(verify_api_key)
 ):
     """创建聊天完成"""
     try:
         # 检查模型是否存在
-        supported_model_ids = [model["id"] for model in SUPPORTED_MODELS]
-        if request.model not in supported_model_ids:
+        if request.model not in supported_model_ids():
             raise HTTPException(status_code=400, detail="模型不存在")
         
+        # 检查候选数参数
+        n, best_of = choice_counts(request)
+        if request.best_of is not None and request.best_of < n:
+            raise HTTPException(status_code=400, detail="best_of不能小于n")
+        if best_of > settings.MAX_COMPLETION_CHOICES:
+            raise HTTPException(status_code=400, detail=f"n和best_of不能超过{settings.MAX_COMPLETION_CHOICES}")
+        if request.stream and best_of > n:
+            raise HTTPException(status_code=400, detail="流式输出不支持best_of大于n")
+        
         # 记录API Key使用情况（应用api_key参数）
-        logger.info(f"API Key {request.state.api_key.id} used for chat completion request")
+        logger.info(f"API Key {api_key.id} used for chat completion request")
         
-        # 如果提供了会话ID，获取会话历史并合并到请求中
-        try:
+        # 如果提供了会话ID，获取会话历史并合并到请求中；从加载历史到提交生成期间持有模型，避免其间被模型池卸载
+        async with model_pool.lease(request.model) if session_id else contextlib.nullcontext():
             if session_id:
                 # 获取会话历史
-                session_history = database_service.get_messages_as_chat_history(db, session_id)
+                session_history = await chat_service.load_history(db, session_id, request.max_tokens or 150, request.model)
                 # 合并历史和当前请求消息
                 full_messages = session_history + request.messages
                 # 更新请求消息
@@ -58,16 +69,17 @@ async def create_chat_completion(
             # 如果启用流式输出，返回流式响应
             if request.stream:
                 return StreamingResponse(
-                    chat_service.generate_streaming_response(request),
+                    await chat_service.generate_streaming_response(request, session_id),
                     media_type="text/event-stream"
                 )
             
             # 非流式输出
             return await chat_service.generate_completion(request, session_id, db)
-        finally:
-            pass
     except HTTPException:
         raise
+    except ModelLoadingError:
+        logger.warning("模型加载中，拒绝聊天完成请求")
+        raise model_loading_exception()
     except Exception as e:
         logger.error(f"聊天完成处理失败: {str(e)}")
         raise HTTPException(status_code=500, detail="聊天完成处理失败")
\ No newline at end of file
@@ -1,8 +1,11 @@
+import asyncio
 import uuid
 import json
 import time
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Query
 from fastapi.websockets import WebSocket as WebSocketType
+from pydantic import ValidationError
+from starlette.websockets import WebSocketState
 from sqlalchemy.orm import Session
 from app.models.schemas import (
     ChatWebSocketMessage,
@@ -16,6 +19,8 @@ from app.models.schemas import (
     ChatMessage
 )
 from app.services.chat_service import ChatService
+from app.models.scheduler import QueueFullError, CancellationToken
+from app.models.model_pool import model_pool, ModelLoadingError
 from app.models.database import get_db, APIKeyModel
 from app.services.database_service import DatabaseService
 from app.utils import get_logger
@@ -26,6 +31,56 @@ chat_service = ChatService()
 database_service = DatabaseService()
 
 
+def is_connected(websocket: WebSocket) -> bool:
+    """连接是否仍可发送：客户端未断开且服务端未关闭"""
+    return (websocket.client_state == WebSocketState.CONNECTED
+            and websocket.application_state == WebSocketState.CONNECTED)
+
+
+async def send_error(websocket: WebSocket, error_type: str, message: str):
+    """发送错误事件"""
+    await websocket.send_text(
+        json.dumps(ErrorEvent(
+            data={"type": error_type, "message": message}
+        ).model_dump())
+    )
+
+
+async def receive_messages(websocket: WebSocket, incoming: asyncio.Queue, state: dict):
+    """后台接收客户端消息：chat.cancel 立即取消当前生成，其余消息排队处理
+
+    格式错误的消息只回复错误事件，会话和正在进行的生成不受影响。只有连接断开时取消当前生成，
+    并向队列放入None通知主循环退出；其他接收错误交给主循环结束会话。
+    """
+    try:
+        while True:
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000), frame.get("reason"))
+            try:
+                if frame.get("text") is None:
+                    raise ValueError("只支持文本消息")
+                message = ChatWebSocketMessage.model_validate_json(frame["text"])
+                if message.type not in ("chat.message", "chat.cancel"):
+                    raise ValueError(f"未知的消息类型: {message.type}")
+            except (ValidationError, ValueError) as e:
+                detail = e.errors()[0]["msg"] if isinstance(e, ValidationError) else str(e)
+                logger.warning(f"收到无效的WebSocket消息: {detail}")
+                await send_error(websocket, "invalid_request_error", f"无效的消息: {detail}")
+                continue
+            if message.type == "chat.cancel":
+                if state.get("cancel_token") is not None:
+                    state["cancel_token"].cancel()
+                continue
+            incoming.put_nowait(message)
+    except WebSocketDisconnect:
+        if state.get("cancel_token") is not None:
+            state["cancel_token"].cancel()
+        incoming.put_nowait(None)
+    except Exception as e:
+        incoming.put_nowait(e)
+
+
 async def get_api_key_from_websocket(websocket: WebSocketType):
     """从WebSocket连接中获取并验证API Key"""
     # 首先尝试从Authorization头获取API Key
@@ -94,6 +149,10 @@ async def websocket_chat(websocket: WebSocket, session_id: str = Query(None, des
     # 获取数据库连接
     db = next(get_db())
     
+    incoming = asyncio.Queue()
+    state = {"cancel_token": None}
+    receiver = None
+    
     try:
         # 发送会话开始事件
         await websocket.send_text(
@@ -112,30 +171,46 @@ async def websocket_chat(websocket: WebSocket, session_id: str = Query(None, des
             except Exception as e:
                 logger.warning(f"创建会话失败: {str(e)}")
         
+        # 在后台接收客户端消息，使生成过程中也能及时响应取消和断开
+        receiver = asyncio.create_task(receive_messages(websocket, incoming, state))
+        
         while True:
             # 接收客户端消息
-            data = await websocket.receive_text()
-            message = ChatWebSocketMessage.model_validate_json(data)
+            message = await incoming.get()
+            if message is None:
+                raise WebSocketDisconnect()
+            if isinstance(message, Exception):
+                raise message
             
             if message.type == "chat.message":
                 logger.info(f"[{session_id}] 收到消息: {message.content}")
                 
                 try:
-                    # 获取会话历史（如果有的话）
-                    chat_history = []
-                    if session_id:
-                        try:
-                            chat_history = database_service.get_messages_as_chat_history(db, session_id)
-                        except Exception as e:
-                            logger.warning(f"[{session_id}] 获取会话历史失败: {str(e)}")
+                    # 从加载历史到提交生成期间持有模型，避免其间被模型池卸载
+                    async with model_pool.lease(message.model):
+                        # 获取会话历史（如果有的话）
+                        chat_history = []
+                        if session_id:
+                            try:
+                                chat_history = await chat_service.load_history(db, session_id, model=message.model)
+                            except ModelLoadingError:
+                                raise
+                            except Exception as e:
+                                logger.warning(f"[{session_id}] 获取会话历史失败: {str(e)}")
                     
-                    # 将新消息添加到历史中
-                    messages = chat_history + [ChatMessage(role="user", content=message.content)]
+                        # 将新消息添加到历史中
+                        user_message = ChatMessage(role="user", content=message.content)
+                        messages = chat_history + [user_message]
+                    
+                        # 提交生成请求（推理队列已满时立即拒绝）
+                        cancel_token = CancellationToken()
+                        state["cancel_token"] = cancel_token
+                        generation, stream = await chat_service.generate_stream(messages, session_id, cancel_token, message.model)
                     
                     # 保存用户消息到数据库
                     if session_id:
                         try:
-                            database_service.add_message(db, session_id, "user", message.content, len(message.content))
+                            database_service.add_message(db, session_id, "user", message.content, **chat_service.message_token_ids(user_message, message.model))
                         except Exception as e:
                             logger.warning(f"[{session_id}] 保存用户消息失败: {str(e)}")
                     
@@ -147,9 +222,8 @@ async def websocket_chat(websocket: WebSocket, session_id: str = Query(None, des
                     )
                     
                     # 流式生成回复
-                    token_count = 0
                     assistant_response = ""
-                    async for token in chat_service.generate_stream(messages):
+                    async for token in stream:
                         if token:  # 只发送非空token
                             assistant_response += token
                             # 发送内容块增量事件
@@ -164,12 +238,14 @@ async def websocket_chat(websocket: WebSocket, session_id: str = Query(None, des
                                     }
                                 ).model_dump())
                             )
-                            token_count += 1
                     
-                    # 保存AI回复到数据库
+                    # 保存AI回复到数据库（与用户消息同样按渲染后的token数记录）
+                    usage = generation.usage
                     if session_id and assistant_response:
                         try:
-                            database_service.add_message(db, session_id, "assistant", assistant_response, token_count)
+                            assistant_message = ChatMessage(role="assistant", content=assistant_response)
+                            database_service.add_message(db, session_id, "assistant", assistant_response,
+                                                         **chat_service.message_token_ids(assistant_message, message.model))
                         except Exception as e:
                             logger.warning(f"[{session_id}] 保存AI回复失败: {str(e)}")
                     
@@ -181,11 +257,17 @@ async def websocket_chat(websocket: WebSocket, session_id: str = Query(None, des
                     )
                     
                     # 发送消息增量事件（包含使用量统计）
+                    finish_reason = generation.finish_reason
+                    if cancel_token.cancelled:
+                        logger.info(f"[{session_id}] 生成已被客户端取消")
                     await websocket.send_text(
                         json.dumps(MessageDeltaEvent(
                             data={
-                                "delta": {"finish_reason": "stop"},
-                                "usage": {"output_tokens": token_count}
+                                "delta": {"finish_reason": finish_reason},
+                                "usage": {
+                                    "input_tokens": usage["prompt_tokens"],
+                                    "output_tokens": usage["completion_tokens"]
+                                }
                             }
                         ).model_dump())
                     )
@@ -196,28 +278,41 @@ async def websocket_chat(websocket: WebSocket, session_id: str = Query(None, des
                             data={}
                         ).model_dump())
                     )
+                    state["cancel_token"] = None
                     
+                except WebSocketDisconnect:
+                    # 发送失败说明连接已断开，直接结束会话
+                    raise
+                except QueueFullError:
+                    logger.warning(f"[{session_id}] 推理队列已满，拒绝消息")
+                    state["cancel_token"] = None
+                    await send_error(websocket, "overloaded_error", "推理队列已满，请稍后重试")
+                except ModelLoadingError:
+                    logger.warning(f"[{session_id}] 模型加载中，拒绝消息")
+                    state["cancel_token"] = None
+                    await send_error(websocket, "model_loading", "模型加载中，请稍后重试")
                 except Exception as e:
                     logger.error(f"[{session_id}] 处理消息时出错: {str(e)}")
-                    # 发送错误事件
-                    await websocket.send_text(
-                        json.dumps(ErrorEvent(
-                            data={"type": "server_error", "message": "处理消息时出错"}
-                        ).model_dump())
-                    )
+                    if not is_connected(websocket):
+                        # 连接已关闭时发送本身就会失败，不再重试
+                        raise WebSocketDisconnect()
+                    if state["cancel_token"] is not None:
+                        state["cancel_token"].cancel()
+                        state["cancel_token"] = None
+                    await send_error(websocket, "server_error", "处理消息时出错")
                     
     except WebSocketDisconnect:
         logger.info(f"WebSocket会话断开: {session_id}")
     except Exception as e:
         logger.error(f"WebSocket会话错误: {str(e)}")
-        # 尝试发送错误事件
-        try:
-            await websocket.send_text(
-                json.dumps(ErrorEvent(
-                    data={"type": "server_error", "message": "服务器内部错误"}
-                ).model_dump())
-            )
-        except:
-            pass
+        if is_connected(websocket):
+            try:
+                await send_error(websocket, "server_error", "服务器内部错误")
+            except Exception:
+                pass
     finally:
+        if state["cancel_token"] is not None:
+            state["cancel_token"].cancel()
+        if receiver is not None:
+            receiver.cancel()
         db.close()
\ No newline at end of file
@@ -0,0 +1,79 @@
+import asyncio
+from fastapi import APIRouter, HTTPException, Depends, Request
+from app.config import settings
+from app.models.database import APIKeyModel
+from app.models.model_pool import model_pool, ModelLoadingError
+from app.models.scheduler import QueueFullError
+from app.models.schemas import EmbeddingRequest, EmbeddingResponse, EmbeddingData, EmbeddingUsage
+from app.services.chat_service import model_loading_exception
+from app.services.embedding_service import embedding_service, encode_base64
+from app.middleware.api_key_auth import verify_api_key
+from app.routers.models import supported_model_ids
+from app.utils import get_logger
+
+router = APIRouter()
+logger = get_logger()
+
+async def wait_for_disconnect(http_request: Request):
+    """等待客户端断开连接（请求体已读取完毕，之后只会收到断开消息）"""
+    while (await http_request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def embed_until_disconnect(http_request: Request, llm, texts: list):
+    """计算向量，客户端在计算完成前断开时取消尚未计算的文本并返回None"""
+    embedding = asyncio.create_task(embedding_service.embed(llm, texts))
+    disconnect = asyncio.create_task(wait_for_disconnect(http_request))
+    try:
+        await asyncio.wait({embedding, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        if embedding.done():
+            return embedding.result()
+        logger.info("客户端已断开，取消向量化请求")
+        return None
+    finally:
+        embedding.cancel()
+        disconnect.cancel()
+
+
+@router.post("/embeddings", response_model=EmbeddingResponse)
+async def create_embeddings(request: EmbeddingRequest, http_request: Request, api_key: APIKeyModel = Depends(verify_api_key)):
+    """创建文本向量，由已加载的生成模型池化最后一层隐藏状态得到"""
+    if request.model not in supported_model_ids():
+        raise HTTPException(status_code=400, detail="模型不存在")
+    texts = [request.input] if isinstance(request.input, str) else request.input
+    if not texts or any(not text for text in texts):
+        raise HTTPException(status_code=400, detail="输入不能为空")
+    if len(texts) > settings.MAX_EMBEDDING_INPUTS:
+        raise HTTPException(status_code=400, detail=f"单个请求最多包含{settings.MAX_EMBEDDING_INPUTS}个文本")
+
+    try:
+        async with model_pool.lease(request.model) as llm:
+            if not llm.supports_embeddings:
+                raise HTTPException(status_code=501, detail=f"{llm.backend_name}推理后端不支持向量化，请使用torch推理后端")
+            results = await embed_until_disconnect(http_request, llm, texts)
+        if results is None:
+            raise HTTPException(status_code=499, detail="客户端已断开")
+    except ModelLoadingError:
+        logger.warning("模型加载中，拒绝向量化请求")
+        raise model_loading_exception()
+    except QueueFullError:
+        logger.warning("推理队列已满，拒绝向量化请求")
+        raise HTTPException(status_code=503, detail="推理队列已满，请稍后重试", headers={"Retry-After": "1"})
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"向量化处理失败: {str(e)}")
+        raise HTTPException(status_code=500, detail="向量化处理失败")
+
+    prompt_tokens = sum(tokens for _, tokens in results)
+    return EmbeddingResponse(
+        data=[
+            EmbeddingData(
+                index=index,
+                embedding=encode_base64(embedding) if request.encoding_format == "base64" else embedding
+            )
+            for index, (embedding, _) in enumerate(results)
+        ],
+        model=request.model,
+        usage=EmbeddingUsage(prompt_tokens=prompt_tokens, total_tokens=prompt_tokens)
+    )
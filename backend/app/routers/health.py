@@ -1,8 +1,16 @@
 from fastapi import APIRouter
+from app.models.model_pool import model_pool
 
 router = APIRouter()
 
 @router.get("/health")
 async def health_check():
-    """健康检查接口"""
-    return {"status": "healthy"}
\ No newline at end of file
+    """健康检查接口，model_status为默认模型的加载状态（resident/loading/cold），
+    inference_backend和inference_threads为默认模型的推理后端和线程配置（未加载时为null）"""
+    llm = model_pool.resident()
+    return {
+        "status": "healthy",
+        "model_status": model_pool.status(),
+        "inference_backend": llm.backend_name if llm is not None else None,
+        "inference_threads": llm.thread_config if llm is not None else None
+    }
\ No newline at end of file
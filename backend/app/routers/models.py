@@ -1,9 +1,13 @@
 from fastapi import APIRouter
 from app.models.schemas import ModelListResponse, ModelInfo
+from app.models.model_pool import model_pool
 import time
 
 router = APIRouter()
 
+# 默认模型（MODEL_PATH）的ID，未配置路径的其他模型ID是它的别名
+DEFAULT_MODEL_ID = "stellar-byte-llm"
+
 # 定义支持的模型列表
 SUPPORTED_MODELS = [
     {
@@ -41,15 +45,39 @@ SUPPORTED_MODELS = [
 ]
 
 
+def list_supported_models():
+    """支持的模型列表，包含 MODEL_PATHS 中额外配置的本地模型"""
+    models = list(SUPPORTED_MODELS)
+    known_ids = {model["id"] for model in SUPPORTED_MODELS}
+    for model_id in model_pool.model_paths:
+        if model_id not in known_ids:
+            models.append({"id": model_id, "owned_by": "local"})
+    return models
+
+
+def supported_model_ids():
+    """支持的模型ID列表"""
+    return [model["id"] for model in list_supported_models()]
+
+
+def alias_of(model_id: str):
+    """别名模型由默认模型提供服务，返回默认模型的ID；使用自己权重的模型返回None"""
+    if model_id != DEFAULT_MODEL_ID and model_pool.is_alias(model_id):
+        return DEFAULT_MODEL_ID
+    return None
+
+
 @router.get("/models", response_model=ModelListResponse)
 async def list_models():
-    """获取可用模型列表"""
+    """获取可用模型列表及其加载状态，别名模型的状态即默认模型的状态"""
     models = [
         ModelInfo(
             id=model["id"],
             created=int(time.time()),
-            owned_by=model["owned_by"]
+            owned_by=model["owned_by"],
+            status=model_pool.status(model["id"]),
+            alias_of=alias_of(model["id"])
         )
-        for model in SUPPORTED_MODELS
+        for model in list_supported_models()
     ]
-    return ModelListResponse(data=models)
\ No newline at end of file
+    return ModelListResponse(data=models)
@@ -2,16 +2,13 @@ from fastapi import APIRouter, HTTPException, Depends
 from sqlalchemy.orm import Session
 from typing import List
 from pydantic import BaseModel
-from app.models.database import get_db, create_tables
+from app.models.database import get_db
 from app.services.database_service import DatabaseService
 from app.models.schemas import ChatMessage
 
 router = APIRouter()
 database_service = DatabaseService()
 
-# 在应用启动时创建表
-create_tables()
-
 class SessionCreate(BaseModel):
     title: str
 
@@ -0,0 +1,289 @@
+import asyncio
+import json
+import os
+import shutil
+import threading
+from collections import defaultdict
+from prometheus_client import Counter
+from pydantic import ValidationError
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.models.database import SessionLocal, BatchJobModel
+from app.models.model_pool import model_pool
+from app.models.schemas import ChatCompletionRequest
+from app.services.chat_service import ChatService, choice_counts
+from app.utils import get_logger, generate_id, get_or_create_metric
+
+logger = get_logger()
+
+BATCH_REQUESTS = get_or_create_metric(Counter, "batch_requests_total", "Offline batch requests processed", ["result"])
+
+# 尚未结束、需要（继续）处理的任务状态
+ACTIVE_STATUSES = ("queued", "running")
+
+
+class BatchFileTooLargeError(ValueError):
+    """上传的输入文件超过 MAX_BATCH_FILE_MB"""
+
+
+class BatchRunner:
+    """离线批处理任务执行器
+
+    后台线程按提交顺序逐个处理任务：输入文件中的请求按模型分组、按提示词长度排序后，
+    每次以低优先级提交一组长度相近的请求，使它们一起预填充、一起解码，且不影响在线请求。
+    每完成一个请求立即追加到输出文件，服务重启后跳过输出文件中已有的请求继续处理。
+    """
+
+    def __init__(self, batch_dir: str = settings.BATCH_DIR, concurrency: int = settings.BATCH_CONCURRENCY,
+                 max_file_bytes: int = settings.MAX_BATCH_FILE_MB * 1024 * 1024):
+        self.batch_dir = batch_dir
+        self.concurrency = max(1, concurrency)
+        self.max_file_bytes = max_file_bytes
+        self.chat_service = ChatService()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._inflight = []
+        self._thread = None
+
+    def input_path(self, job_id: str) -> str:
+        return os.path.join(self.batch_dir, job_id, "input.jsonl")
+
+    def output_path(self, job_id: str) -> str:
+        return os.path.join(self.batch_dir, job_id, "output.jsonl")
+
+    async def create_job(self, db: Session, chunks) -> BatchJobModel:
+        """把上传的JSONL内容写入任务目录并创建任务记录，chunks为字节块的异步迭代器
+
+        文件读写在线程池中执行，不阻塞事件循环；内容超过max_file_bytes时抛出BatchFileTooLargeError。
+        """
+        job_id = generate_id("batch-")
+        path = self.input_path(job_id)
+        await asyncio.to_thread(os.makedirs, os.path.dirname(path), exist_ok=True)
+        try:
+            input_file = await asyncio.to_thread(open, path, "wb")
+            try:
+                size = 0
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_file_bytes:
+                        raise BatchFileTooLargeError(f"输入文件不能超过{self.max_file_bytes // 1024 // 1024}MB")
+                    await asyncio.to_thread(input_file.write, chunk)
+            finally:
+                await asyncio.to_thread(input_file.close)
+            total = await asyncio.to_thread(self._count_input, job_id)
+            if total == 0:
+                raise ValueError("输入文件中没有请求")
+        except BaseException:
+            await asyncio.to_thread(shutil.rmtree, os.path.dirname(path), ignore_errors=True)
+            raise
+        job = BatchJobModel(id=job_id, total=total)
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        logger.info(f"创建批处理任务 {job_id}，共 {total} 个请求")
+        self._wakeup.set()
+        return job
+
+    def cancel_job(self, db: Session, job_id: str):
+        """取消未结束的任务，正在执行的一组请求完成后停止"""
+        job = db.get(BatchJobModel, job_id)
+        if job is not None and job.status in ACTIVE_STATUSES:
+            job.status = "cancelled"
+            db.commit()
+            db.refresh(job)
+        return job
+
+    def start(self):
+        """启动后台线程，继续处理上次未完成的任务"""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._loop, name="batch-runner", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止后台线程，正在执行的请求被取消且不写入输出，下次启动时重新处理"""
+        self._stopped.set()
+        self._wakeup.set()
+        for generation in list(self._inflight):
+            generation.cancel()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            job_id = self._next_job()
+            if job_id is None:
+                self._wakeup.wait(timeout=5)
+                self._wakeup.clear()
+                continue
+            try:
+                self._run(job_id)
+            except Exception as e:
+                logger.error(f"批处理任务 {job_id} 失败: {str(e)}", exc_info=True)
+                db = SessionLocal()
+                try:
+                    job = db.get(BatchJobModel, job_id)
+                    job.status, job.error = "failed", str(e)
+                    db.commit()
+                finally:
+                    db.close()
+
+    def _next_job(self):
+        db = SessionLocal()
+        try:
+            job = db.query(BatchJobModel).filter(BatchJobModel.status.in_(ACTIVE_STATUSES)) \
+                .order_by(BatchJobModel.created_at).first()
+            return job.id if job is not None else None
+        finally:
+            db.close()
+
+    def _read_input(self, job_id: str):
+        """逐个返回输入文件中的 (序号, 行)，忽略空行"""
+        with open(self.input_path(job_id), "r", encoding="utf-8") as input_file:
+            index = 0
+            for line in input_file:
+                if line.strip():
+                    yield index, line
+                    index += 1
+
+    def _count_input(self, job_id: str) -> int:
+        return sum(1 for _ in self._read_input(job_id))
+
+    def _load_finished(self, job_id: str) -> dict:
+        """读取输出文件中已完成的请求 {序号: 是否成功}，并截掉上次中断时写了一半的行"""
+        path = self.output_path(job_id)
+        if not os.path.exists(path):
+            return {}
+        with open(path, "rb") as output_file:
+            data = output_file.read()
+        if data and not data.endswith(b"\n"):
+            data = data[:data.rfind(b"\n") + 1]
+            with open(path, "wb") as output_file:
+                output_file.write(data)
+        finished = {}
+        for line in data.decode("utf-8").splitlines():
+            record = json.loads(line)
+            finished[record["index"]] = "error" not in record
+        return finished
+
+    def _run(self, job_id: str):
+        db = SessionLocal()
+        try:
+            job = db.get(BatchJobModel, job_id)
+            job.status = "running"
+            finished = self._load_finished(job_id)
+            job.completed = sum(finished.values())
+            job.failed = len(finished) - job.completed
+            db.commit()
+            logger.info(f"开始处理批处理任务 {job_id}，已完成 {len(finished)}/{job.total}")
+
+            with open(self.output_path(job_id), "a", encoding="utf-8") as output:
+                pending = defaultdict(list)
+                for index, line in self._read_input(job_id):
+                    if index in finished:
+                        continue
+                    custom_id = None
+                    try:
+                        data = json.loads(line)
+                        if isinstance(data, dict):
+                            custom_id = data.pop("custom_id", None)
+                        request = ChatCompletionRequest.model_validate(data)
+                        pending[request.model].append((index, custom_id, request))
+                    except (ValueError, ValidationError) as e:
+                        self._write(output, job, index, custom_id, error=f"无效的请求: {str(e)}")
+                db.commit()
+
+                for model, items in pending.items():
+                    if not self._process(db, job, output, model, items):
+                        logger.info(f"批处理任务 {job_id} 已停止，已完成 {job.completed + job.failed}/{job.total}")
+                        return
+
+            db.refresh(job)
+            if job.status == "running":
+                job.status = "completed"
+                db.commit()
+            logger.info(f"批处理任务 {job_id} 完成，成功 {job.completed}，失败 {job.failed}")
+        finally:
+            db.close()
+
+    def _process(self, db: Session, job: BatchJobModel, output, model: str, items) -> bool:
+        """按提示词长度排序后分组提交同一模型的请求，任务被取消或服务停止时返回False
+
+        处理期间持有模型租约，避免模型在两组请求之间被模型池卸载。
+        """
+        try:
+            llm = model_pool.get(model, lease=True)
+        except Exception as e:
+            for index, custom_id, _ in items:
+                self._write(output, job, index, custom_id, error=f"加载模型失败: {str(e)}")
+            db.commit()
+            return True
+        try:
+            return self._process_chunks(db, job, output, llm, items)
+        finally:
+            model_pool.release(llm)
+
+    def _process_chunks(self, db: Session, job: BatchJobModel, output, llm, items) -> bool:
+        # 长度相近的请求放在同一组，减少批量预填充和解码时的填充
+        items.sort(key=lambda item: len(llm.encode_prompt(item[2].messages, item[2].max_tokens or 150)))
+        for start in range(0, len(items), self.concurrency):
+            db.refresh(job)
+            if job.status == "cancelled" or self._stopped.is_set():
+                return False
+            chunk = items[start:start + self.concurrency]
+            submitted = []
+            for index, custom_id, request in chunk:
+                # 单个请求提交失败（如提示词超长）只记为该请求失败
+                try:
+                    generation = llm.submit(
+                        request.messages,
+                        max_new_tokens=request.max_tokens or 150,
+                        temperature=request.temperature,
+                        top_p=request.top_p,
+                        n=choice_counts(request)[1],
+                        low_priority=True,
+                        stop=request.stop,
+                        top_k=request.top_k,
+                        repetition_penalty=request.repetition_penalty,
+                        seed=request.seed
+                    )
+                except Exception as e:
+                    self._write(output, job, index, custom_id, error=str(e))
+                    continue
+                submitted.append((index, custom_id, request, generation))
+                self._inflight.append(generation)
+            for index, custom_id, request, generation in submitted:
+                try:
+                    for member in generation.group:
+                        member.result()
+                    if self._stopped.is_set():
+                        continue
+                    result = self.chat_service.completion_result(llm, request, generation)
+                    response = self.chat_service.completion_response(request, result)
+                    self._write(output, job, index, custom_id, response=response.model_dump())
+                except Exception as e:
+                    if not self._stopped.is_set():
+                        self._write(output, job, index, custom_id, error=str(e))
+            self._inflight = []
+            db.commit()
+        return not self._stopped.is_set()
+
+    def _write(self, output, job: BatchJobModel, index: int, custom_id, response: dict = None, error: str = None):
+        """追加一条结果到输出文件并更新任务进度"""
+        record = {"index": index, "custom_id": custom_id}
+        if error is not None:
+            record["error"] = {"message": error}
+            job.failed += 1
+            BATCH_REQUESTS.labels(result="failed").inc()
+        else:
+            record["response"] = response
+            job.completed += 1
+            BATCH_REQUESTS.labels(result="completed").inc()
+        output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        output.flush()
+
+
+# 全局批处理执行器
+batch_runner = BatchRunner()
@@ -2,7 +2,8 @@ from fastapi import HTTPException
 import asyncio
 import json
 import time
-from app.models.inference import LLMInference
+from app.models.model_pool import model_pool, ModelLoadingError
+from app.models.scheduler import QueueFullError, CancellationToken
 from app.models.schemas import (
     ChatCompletionRequest, 
     ChatCompletionResponse, 
@@ -14,13 +15,35 @@ from app.models.schemas import (
     ChatCompletionChunkDelta
 )
 from app.services.database_service import DatabaseService
+from app.services.response_cache import response_cache, cache_key, is_deterministic
 from app.utils import get_logger, generate_id, format_timestamp
 
 logger = get_logger()
-llm = LLMInference()
 database_service = DatabaseService()
 
 
+def model_loading_exception() -> HTTPException:
+    """模型仍在后台加载时返回503，客户端稍后重试"""
+    return HTTPException(status_code=503, detail="模型加载中，请稍后重试", headers={"Retry-After": "5"})
+
+
+def choice_counts(request: ChatCompletionRequest) -> tuple:
+    """返回 (返回的候选数n, 生成的候选数best_of)"""
+    n = request.n or 1
+    return n, max(n, request.best_of or n)
+
+
+def group_usage(generations) -> dict:
+    """整组候选的token用量：提示词只预填充一次，输出token按全部生成的候选累加"""
+    prompt_tokens = generations[0].usage["prompt_tokens"]
+    completion_tokens = sum(generation.usage["completion_tokens"] for generation in generations)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+
+
 class ChatService:
     """聊天服务类"""
     
@@ -30,134 +53,197 @@ class ChatService:
             # 记录开始时间
             start_time = time.time()
             
-            # 生成回复
-            response_text = llm.chat(
-                messages=request.messages,
-                max_new_tokens=request.max_tokens or 150,
-                temperature=request.temperature,
-                top_p=request.top_p
-            )
+            # temperature为0的相同请求直接返回缓存的响应
+            max_new_tokens = request.max_tokens or 150
+            key = cache_key(request, max_new_tokens) if is_deterministic(request) else None
+            result = await response_cache.aget(key) if key else None
+            
+            if result is None:
+                # 生成回复
+                async with model_pool.lease(request.model) as llm:
+                    generation = await llm.agenerate(
+                        messages=request.messages,
+                        max_new_tokens=max_new_tokens,
+                        temperature=request.temperature,
+                        top_p=request.top_p,
+                        session_id=session_id,
+                        n=choice_counts(request)[1],
+                        stop=request.stop,
+                        top_k=request.top_k,
+                        repetition_penalty=request.repetition_penalty,
+                        seed=request.seed
+                    )
+                    result = self.completion_result(llm, request, generation)
+                if key and all(choice["finish_reason"] in ("stop", "length") for choice in result["choices"]):
+                    response_cache.put(key, result)
+            response_text = result["choices"][0]["text"].strip()
+            usage = result["usage"]
             
             # 计算耗时
             elapsed_time = time.time() - start_time
-            
-            # 计算token数量（简化计算）
-            prompt_tokens = sum(len(msg.content) if isinstance(msg.content, str) else sum(len(item.text) for item in msg.content if item.type == "text" and item.text) for msg in request.messages)
-            completion_tokens = len(response_text)
-            total_tokens = prompt_tokens + completion_tokens
+            total_tokens = usage["total_tokens"]
             
             # 如果提供了会话ID且有数据库连接，将消息保存到数据库
             if session_id and db:
                 # 保存用户消息
-                for msg in request.messages:
+                for msg, tokens in zip(request.messages, result["message_tokens"]):
                     database_service.add_message(
                         db, 
                         session_id, 
                         msg.role, 
                         msg.content, 
-                        len(msg.content) if isinstance(msg.content, str) else 0
+                        **(self.message_token_ids(msg, request.model) or {"tokens": tokens})
                     )
                 
-                # 保存AI回复
+                # 保存AI回复（与用户消息同样按渲染后的token数记录，而不是生成的token数）
                 database_service.add_message(
                     db, 
                     session_id, 
                     "assistant", 
                     response_text, 
-                    completion_tokens
+                    **self.message_token_ids(ChatMessage(role="assistant", content=response_text), request.model)
                 )
             
             # 构造响应
-            response = ChatCompletionResponse(
-                id=generate_id("chatcmpl-"),
-                created=format_timestamp(),
-                model=request.model,
-                choices=[
-                    ChatCompletionChoice(
-                        index=0,
-                        message=ChatMessage(role="assistant", content=response_text),
-                        finish_reason="stop"
-                    )
-                ],
-                usage=ChatCompletionUsage(
-                    prompt_tokens=prompt_tokens,
-                    completion_tokens=completion_tokens,
-                    total_tokens=total_tokens
-                )
-            )
+            response = self.completion_response(request, result)
             
             logger.info(f"聊天完成生成成功 - 耗时: {elapsed_time:.4f}s, tokens: {total_tokens}")
             return response
             
+        except QueueFullError:
+            logger.warning("推理队列已满，拒绝聊天完成请求")
+            raise HTTPException(status_code=503, detail="推理队列已满，请稍后重试", headers={"Retry-After": "1"})
+        except ModelLoadingError:
+            logger.warning("模型加载中，拒绝聊天完成请求")
+            raise model_loading_exception()
         except Exception as e:
             logger.error(f"生成聊天完成响应失败: {str(e)}", exc_info=True)
             raise HTTPException(status_code=500, detail="生成聊天完成响应失败")
 
-    async def generate_streaming_response(self, request: ChatCompletionRequest):
+    def completion_result(self, llm, request: ChatCompletionRequest, generation) -> dict:
+        """把已完成的生成请求整理为可缓存的结果：各候选的文本和结束原因、token用量及各条消息的token数"""
+        n, best_of = choice_counts(request)
+        candidates = generation.group
+        if best_of > n:
+            # 按每个token的平均对数概率挑选最好的n个候选
+            candidates = sorted(candidates, key=lambda candidate: candidate.mean_logprob, reverse=True)[:n]
+        # token用量取自实际生成过程
+        return {
+            "choices": [
+                {
+                    "text": llm.decode_output(candidate),
+                    "finish_reason": candidate.finish_reason
+                }
+                for candidate in candidates
+            ],
+            "usage": group_usage(generation.group),
+            "message_tokens": [llm.count_tokens(msg) for msg in request.messages]
+        }
+
+    def completion_response(self, request: ChatCompletionRequest, result: dict) -> ChatCompletionResponse:
+        """由生成结果构造聊天完成响应"""
+        return ChatCompletionResponse(
+            id=generate_id("chatcmpl-"),
+            created=format_timestamp(),
+            model=request.model,
+            choices=[
+                ChatCompletionChoice(
+                    index=index,
+                    message=ChatMessage(role="assistant", content=choice["text"].strip()),
+                    finish_reason=choice["finish_reason"]
+                )
+                for index, choice in enumerate(result["choices"])
+            ],
+            usage=ChatCompletionUsage(**result["usage"])
+        )
+
+    async def generate_streaming_response(self, request: ChatCompletionRequest, session_id: str = None):
+        """提交生成请求并返回SSE流式响应（推理队列已满时立即拒绝，命中响应缓存时直接回放）
+
+        n>1时各候选的数据块按产生顺序交错输出，以index区分。
+        """
+        max_new_tokens = request.max_tokens or 150
+        key = cache_key(request, max_new_tokens) if is_deterministic(request) else None
+        cached = await response_cache.aget(key) if key else None
+        if cached is not None:
+            return self._replay_chunks(request, cached)
+
+        try:
+            # 租约只需持有到提交为止，提交后模型处于生成中，不会被卸载
+            async with model_pool.lease(request.model) as llm:
+                generation = llm.submit(
+                    messages=request.messages,
+                    max_new_tokens=max_new_tokens,
+                    temperature=request.temperature,
+                    top_p=request.top_p,
+                    session_id=session_id,
+                    n=request.n or 1,
+                    stop=request.stop,
+                    top_k=request.top_k,
+                    repetition_penalty=request.repetition_penalty,
+                    seed=request.seed
+                )
+        except QueueFullError:
+            logger.warning("推理队列已满，拒绝流式请求")
+            raise HTTPException(status_code=503, detail="推理队列已满，请稍后重试", headers={"Retry-After": "1"})
+        except ModelLoadingError:
+            logger.warning("模型加载中，拒绝流式请求")
+            raise model_loading_exception()
+        return self._stream_chunks(request, llm, generation, key)
+
+    def _chunk(self, completion_id: str, created: int, request: ChatCompletionRequest,
+               delta: ChatCompletionChunkDelta, finish_reason: str = None, index: int = 0) -> str:
+        """构造一条SSE数据块"""
+        chunk = ChatCompletionChunk(
+            id=completion_id,
+            created=created,
+            model=request.model,
+            choices=[
+                ChatCompletionChunkChoice(
+                    index=index,
+                    delta=delta,
+                    finish_reason=finish_reason
+                )
+            ]
+        )
+        return f"data: {json.dumps(chunk.model_dump())}\n\n"
+
+    async def _stream_chunks(self, request: ChatCompletionRequest, llm, generation, key: str = None):
         """生成流式响应"""
         try:
             # 生成唯一ID
             completion_id = generate_id("chatcmpl-")
             created = format_timestamp()
             
-            # 发送初始块
-            first_chunk = ChatCompletionChunk(
-                id=completion_id,
-                created=created,
-                model=request.model,
-                choices=[
-                    ChatCompletionChunkChoice(
-                        index=0,
-                        delta=ChatCompletionChunkDelta(role="assistant", content=""),
-                        finish_reason=None
-                    )
-                ]
-            )
-            yield f"data: {json.dumps(first_chunk.model_dump())}\n\n"
+            candidates = generation.group
             
-            # 流式生成回复
-            token_count = 0
-            async for token in llm.stream_chat(
-                messages=request.messages,
-                max_new_tokens=request.max_tokens or 150,
-                temperature=request.temperature,
-                top_p=request.top_p
-            ):
-                if token:  # 只发送非空token
-                    chunk = ChatCompletionChunk(
-                        id=completion_id,
-                        created=created,
-                        model=request.model,
-                        choices=[
-                            ChatCompletionChunkChoice(
-                                index=0,
-                                delta=ChatCompletionChunkDelta(content=token),
-                                finish_reason=None
-                            )
-                        ]
-                    )
-                    yield f"data: {json.dumps(chunk.model_dump())}\n\n"
-                    token_count += 1
+            # 发送初始块
+            for index in range(len(candidates)):
+                yield self._chunk(completion_id, created, request, ChatCompletionChunkDelta(role="assistant", content=""), index=index)
             
-            # 发送结束块
-            final_chunk = ChatCompletionChunk(
-                id=completion_id,
-                created=created,
-                model=request.model,
-                choices=[
-                    ChatCompletionChunkChoice(
-                        index=0,
-                        delta=ChatCompletionChunkDelta(),
-                        finish_reason="stop"
-                    )
-                ]
-            )
-            yield f"data: {json.dumps(final_chunk.model_dump())}\n\n"
+            # 流式生成回复，各候选结束时立即发送其结束块
+            texts = [""] * len(candidates)
+            async for index, token in self._merge_streams(llm, candidates):
+                if token is None:
+                    yield self._chunk(completion_id, created, request, ChatCompletionChunkDelta(), candidates[index].finish_reason, index)
+                elif token:  # 只发送非空token
+                    texts[index] += token
+                    yield self._chunk(completion_id, created, request, ChatCompletionChunkDelta(content=token), index=index)
             
             # 发送结束标记
             yield "data: [DONE]\n\n"
             
-            logger.info(f"流式响应生成完成 - tokens: {token_count}")
+            usage = group_usage(candidates)
+            if key and all(candidate.finish_reason in ("stop", "length") for candidate in candidates):
+                response_cache.put(key, {
+                    "choices": [
+                        {"text": text, "finish_reason": candidate.finish_reason}
+                        for text, candidate in zip(texts, candidates)
+                    ],
+                    "usage": usage,
+                    "message_tokens": [llm.count_tokens(msg) for msg in request.messages]
+                })
+            logger.info(f"流式响应生成完成 - tokens: {usage['completion_tokens']}")
             
         except Exception as e:
             logger.error(f"生成流式响应失败: {str(e)}", exc_info=True)
@@ -171,14 +257,84 @@ class ChatService:
             }
             yield f"data: {json.dumps(error_chunk)}\n\n"
             yield "data: [DONE]\n\n"
+        finally:
+            # 客户端断开时流被取消或关闭，停止生成并释放批次槽位
+            generation.cancel()
+
+    async def _merge_streams(self, llm, generations):
+        """并发读取多个候选的增量文本，按产生顺序返回 (index, text)，候选结束时text为None"""
+        merged = asyncio.Queue()
+
+        async def pump(index, generation):
+            try:
+                async for token in llm.stream_tokens(generation):
+                    merged.put_nowait((index, token, None))
+                merged.put_nowait((index, None, None))
+            except Exception as e:
+                merged.put_nowait((index, None, e))
+
+        tasks = [asyncio.create_task(pump(index, generation)) for index, generation in enumerate(generations)]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                index, token, error = await merged.get()
+                if error is not None:
+                    raise error
+                if token is None:
+                    remaining -= 1
+                yield index, token
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _replay_chunks(self, request: ChatCompletionRequest, cached: dict):
+        """以SSE流的形式回放缓存的响应"""
+        completion_id = generate_id("chatcmpl-")
+        created = format_timestamp()
+        for index, choice in enumerate(cached["choices"]):
+            yield self._chunk(completion_id, created, request, ChatCompletionChunkDelta(role="assistant", content=""), index=index)
+            if choice["text"]:
+                yield self._chunk(completion_id, created, request, ChatCompletionChunkDelta(content=choice["text"]), index=index)
+            yield self._chunk(completion_id, created, request, ChatCompletionChunkDelta(), choice["finish_reason"], index)
+        yield "data: [DONE]\n\n"
+        logger.info(f"流式响应命中缓存 - tokens: {cached['usage']['completion_tokens']}")
+
+    async def generate_stream(self, messages, session_id: str = None, cancel_token: CancellationToken = None,
+                              model: str = None):
+        """提交生成请求并返回 (生成请求, 流式回复)（用于WebSocket），推理队列已满时抛出QueueFullError，
+        模型尚未加载完成时抛出ModelLoadingError
+
+        cancel_token被触发时生成在下一个解码步停止，流随之结束；结束后可从生成请求读取token用量。
+        """
+        async with model_pool.lease(model) as llm:
+            generation = llm.submit(messages=messages, session_id=session_id, cancel_token=cancel_token)
+        return generation, self._stream_tokens(llm, generation)
+
+    def message_token_ids(self, message: ChatMessage, model: str = None) -> dict:
+        """返回保存消息时写入的token id及其来源，模型未加载时返回空字典（不保存token id）
+
+        数据库按token id的长度记录消息的token数，即渲染后的消息在提示词中占用的token数。
+        """
+        llm = model_pool.resident(model)
+        if llm is None:
+            return {}
+        return {"token_ids": llm.context_builder.encode_message(message), "token_source": llm.context_builder.source}
+
+    async def load_history(self, db, session_id: str, max_new_tokens: int = 200, model: str = None):
+        """加载会话历史，按存储的token数只取提示词预算内最近的消息"""
+        async with model_pool.lease(model) as llm:
+            budget = llm.context_builder.prompt_budget(max_new_tokens)
+        return database_service.get_messages_as_chat_history(db, session_id, max_tokens=budget)
 
-    async def generate_stream(self, messages):
-        """生成流式回复（用于WebSocket）"""
+    async def _stream_tokens(self, llm, generation):
+        """生成流式回复"""
         try:
             # 流式生成回复
-            async for token in llm.stream_chat(messages=messages):
+            async for token in llm.stream_tokens(generation):
                 yield token
                 
         except Exception as e:
             logger.error(f"生成流式回复失败: {str(e)}", exc_info=True)
-            raise
\ No newline at end of file
+            raise
+        finally:
+            generation.cancel()
\ No newline at end of file
@@ -4,6 +4,7 @@ from sqlalchemy import desc
 from typing import List, Optional
 from app.models.database import SessionModel, MessageModel
 from app.models.schemas import ChatMessage
+from app.models.context import pack_token_ids, unpack_token_ids
 from datetime import datetime
 import uuid
 
@@ -51,8 +52,13 @@ class DatabaseService:
             return True
         return False
     
-    def add_message(self, db: Session, session_id: str, role: str, content: str, tokens: int = 0, metadata: dict = None) -> Optional[MessageModel]:
-        """添加消息"""
+    def add_message(self, db: Session, session_id: str, role: str, content: str, tokens: int = 0, metadata: dict = None,
+                    token_ids: Optional[List[int]] = None, token_source: Optional[str] = None) -> Optional[MessageModel]:
+        """添加消息，提供token_ids时一并保存，之后加载历史无需重新分词
+
+        tokens为渲染后的消息在提示词中占用的token数（含角色前缀），即加载历史时计算预算的单位；
+        提供token_ids时以其长度为准。
+        """
         # 验证会话是否存在
         session = self.get_session(db, session_id)
         if not session:
@@ -64,7 +70,9 @@ class DatabaseService:
             session_id=session_id,
             role=role,
             content=content,
-            tokens=tokens,
+            tokens=len(token_ids) if token_ids is not None else tokens,
+            token_ids=pack_token_ids(token_ids) if token_ids is not None else None,
+            token_source=token_source if token_ids is not None else None,
             metadata_info=json.dumps(metadata) if metadata else None
         )
         db.add(db_message)
@@ -74,17 +82,39 @@ class DatabaseService:
         db.refresh(db_message)
         return db_message
     
-    def get_messages(self, db: Session, session_id: str, skip: int = 0, limit: int = 100) -> List[MessageModel]:
-        """获取会话消息"""
-        return db.query(MessageModel).filter(MessageModel.session_id == session_id).order_by(MessageModel.created_at).offset(skip).limit(limit).all()
+    def get_messages(self, db: Session, session_id: str, skip: int = 0, limit: Optional[int] = 100) -> List[MessageModel]:
+        """获取会话消息，limit为None时返回全部"""
+        query = db.query(MessageModel).filter(MessageModel.session_id == session_id).order_by(MessageModel.created_at).offset(skip)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
     
-    def get_messages_as_chat_history(self, db: Session, session_id: str) -> List[ChatMessage]:
-        """获取会话消息并转换为聊天历史格式"""
-        messages = self.get_messages(db, session_id)
+    def get_messages_as_chat_history(self, db: Session, session_id: str, max_tokens: Optional[int] = None) -> List[ChatMessage]:
+        """获取会话消息并转换为聊天历史格式
+
+        指定max_tokens时按写入时存储的token数（渲染后的消息，含角色前缀）从最近的消息向前加载，超出预算即停止，
+        无需对每条历史消息重新分词；精确的截取由推理侧完成。
+        """
+        if max_tokens is None:
+            messages = self.get_messages(db, session_id, limit=None)
+        else:
+            messages = []
+            used = 0
+            query = db.query(MessageModel).filter(MessageModel.session_id == session_id).order_by(desc(MessageModel.created_at))
+            for msg in query.yield_per(100):
+                if messages and used + (msg.tokens or 0) > max_tokens:
+                    break
+                messages.append(msg)
+                used += msg.tokens or 0
+            messages.reverse()
         chat_history = []
         for msg in messages:
-            chat_history.append(ChatMessage(
+            chat_message = ChatMessage(
                 role=msg.role,
                 content=msg.content
-            ))
+            )
+            if msg.token_ids is not None:
+                chat_message._token_ids = unpack_token_ids(msg.token_ids)
+                chat_message._token_source = msg.token_source
+            chat_history.append(chat_message)
         return chat_history
\ No newline at end of file
@@ -0,0 +1,87 @@
+import asyncio
+import base64
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from prometheus_client import Counter
+from app.config import settings
+from app.utils import get_logger, get_or_create_metric
+
+logger = get_logger()
+
+EMBEDDING_CACHE_LOOKUPS = get_or_create_metric(Counter, "embedding_cache_lookups_total", "Embedding cache lookups per input text", ["result"])
+
+
+def encode_base64(embedding: list) -> str:
+    """把向量编码为小端float32的base64字符串（OpenAI encoding_format=base64）"""
+    values = array("f", embedding)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return base64.b64encode(values.tobytes()).decode("ascii")
+
+
+class EmbeddingService:
+    """文本向量化服务
+
+    向量由已加载的生成模型计算（见 LLMInference.encode_embedding_inputs 和 submit_embeddings），不额外加载模型；
+    相同模型下重复出现的文本直接从内存LRU缓存返回。
+    """
+
+    def __init__(self, max_entries: int = settings.EMBEDDING_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        if self.max_entries <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        EMBEDDING_CACHE_LOOKUPS.labels(result="hit" if entry is not None else "miss").inc()
+        return entry
+
+    def _put(self, key, entry):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def embed(self, llm, texts: list) -> list:
+        """返回与texts顺序一致的 (向量, token数) 列表，只为未缓存的文本提交计算，同一请求中重复的文本只计算一次"""
+        results = [None] * len(texts)
+        missing = OrderedDict()
+        for index, text in enumerate(texts):
+            entry = self._get((llm.model_path, text))
+            if entry is not None:
+                results[index] = entry
+            else:
+                missing.setdefault(text, []).append(index)
+
+        if missing:
+            # 分词在线程池中执行，不阻塞事件循环
+            token_ids = await asyncio.to_thread(llm.encode_embedding_inputs, list(missing))
+            tasks = llm.submit_embeddings(token_ids)
+            try:
+                await asyncio.gather(*[task.wait() for task in tasks])
+            finally:
+                # 等待被取消（如客户端断开）时，不再计算尚未完成的文本
+                llm.cancel_embeddings([task for task in tasks if not task.done])
+            for (text, indices), task in zip(missing.items(), tasks):
+                entry = (task.embedding, len(task.token_ids))
+                self._put((llm.model_path, text), entry)
+                for index in indices:
+                    results[index] = entry
+        return results
+
+
+# 全局向量化服务，缓存在各请求间共享
+embedding_service = EmbeddingService()
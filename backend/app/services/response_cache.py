@@ -0,0 +1,183 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import Counter
+from app.config import settings
+from app.models.context import message_text
+from app.utils import get_logger, get_or_create_metric
+
+logger = get_logger()
+
+RESPONSE_CACHE_LOOKUPS = get_or_create_metric(Counter, "response_cache_lookups_total", "Response cache lookups for deterministic completions", ["result"])
+
+
+def is_deterministic(request) -> bool:
+    """temperature为0（贪心解码）时相同请求的输出相同，才可以缓存"""
+    return request.temperature is not None and request.temperature <= 0
+
+
+def cache_key(request, max_tokens: int) -> str:
+    """按模型、规范化后的消息和采样参数计算缓存键"""
+    payload = {
+        "model": request.model,
+        "messages": [[message.role, message_text(message)] for message in request.messages],
+        "max_tokens": max_tokens,
+        "top_p": request.top_p,
+        "top_k": request.top_k,
+        "repetition_penalty": request.repetition_penalty,
+        "stop": request.stop,
+        "n": request.n,
+        "best_of": request.best_of
+    }
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """确定性请求的完整响应缓存
+
+    内存中按LRU保留最近的响应并按TTL过期；配置磁盘路径时额外写入SQLite，
+    进程重启后仍可命中，内存未命中时从磁盘读取并回填到内存。
+
+    SQLite的读写都在单个后台线程中串行执行，不占用事件循环：写入在后台完成，不等待落盘；
+    事件循环中使用aget，内存未命中时在后台线程读取磁盘。
+    """
+
+    def __init__(self, max_entries: int = settings.RESPONSE_CACHE_SIZE, ttl: int = settings.RESPONSE_CACHE_TTL,
+                 disk_path: str = settings.RESPONSE_CACHE_PATH):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk = None
+        if disk_path and self.enabled:
+            self._open_disk(disk_path)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _open_disk(self, disk_path: str):
+        try:
+            directory = os.path.dirname(disk_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"打开响应缓存磁盘存储失败，仅使用内存缓存: {str(e)}")
+            self._db = None
+            return
+        self._disk = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+
+    def get(self, key: str):
+        """返回缓存的响应，未命中或已过期时返回None；内存未命中时同步等待读取磁盘"""
+        if not self.enabled:
+            return None
+        value = self._get_memory(key)
+        if value is None and self._disk is not None:
+            value = self._disk.submit(self._load, key).result()
+        if value is None:
+            RESPONSE_CACHE_LOOKUPS.labels(result="miss").inc()
+        return value
+
+    async def aget(self, key: str):
+        """在事件循环中返回缓存的响应，内存未命中时在后台线程读取磁盘，不阻塞事件循环"""
+        if not self.enabled:
+            return None
+        value = self._get_memory(key)
+        if value is None and self._disk is not None:
+            value = await asyncio.wrap_future(self._disk.submit(self._load, key))
+        if value is None:
+            RESPONSE_CACHE_LOOKUPS.labels(result="miss").inc()
+        return value
+
+    def _get_memory(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at >= now:
+                self._entries.move_to_end(key)
+                RESPONSE_CACHE_LOOKUPS.labels(result="memory_hit").inc()
+                return value
+            del self._entries[key]
+            return None
+
+    def _load(self, key: str):
+        """在后台线程中从磁盘读取未过期的响应并回填到内存"""
+        try:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ? AND expires_at >= ?", (key, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"读取响应缓存失败: {str(e)}")
+            return None
+        if row is None:
+            return None
+        value = json.loads(row[0])
+        with self._lock:
+            self._remember(key, row[1], value)
+        RESPONSE_CACHE_LOOKUPS.labels(result="disk_hit").inc()
+        return value
+
+    def put(self, key: str, value: dict):
+        """写入响应，value需可JSON序列化；磁盘写入在后台线程完成，不等待落盘"""
+        if not self.enabled:
+            return
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, expires_at, value)
+        if self._disk is not None:
+            self._disk.submit(self._store, key, json.dumps(value, ensure_ascii=False), expires_at)
+
+    def _store(self, key: str, value: str, expires_at: float):
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at)
+            )
+            self._db.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"写入响应缓存失败: {str(e)}")
+
+    def _remember(self, key: str, expires_at: float, value: dict):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def flush(self):
+        """等待已提交的磁盘写入完成"""
+        if self._disk is not None:
+            self._disk.submit(lambda: None).result()
+
+    def clear(self):
+        """清空内存和磁盘缓存"""
+        with self._lock:
+            self._entries.clear()
+        if self._disk is not None:
+            self._disk.submit(self._clear_disk).result()
+
+    def _clear_disk(self):
+        self._db.execute("DELETE FROM responses")
+        self._db.commit()
+
+
+# 全局响应缓存
+response_cache = ResponseCache()
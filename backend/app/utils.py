@@ -32,4 +32,16 @@ def generate_id(prefix: str = "") -> str:
 
 def format_timestamp() -> int:
     """生成时间戳"""
-    return int(time.time())
\ No newline at end of file
+    return int(time.time())
+
+
+# 已创建的Prometheus指标，定义指标的模块被重复导入时复用同一个指标，避免重复注册
+_metrics = {}
+
+
+def get_or_create_metric(metric_cls, name: str, documentation: str, labelnames=()):
+    """获取或创建Prometheus指标，同名指标只注册一次"""
+    metric = _metrics.get(name)
+    if metric is None:
+        metric = _metrics[name] = metric_cls(name, documentation, labelnames)
+    return metric
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+推理后端基准测试
+在相同提示词上对比torch与onnx（ONNX Runtime CPU）推理后端的启动耗时、首token延迟、单请求解码吞吐量、
+并发请求总吞吐量及贪心输出的一致程度，用于为当前主机选择 INFERENCE_BACKEND
+"""
+
+import os
+import statistics
+import sys
+import time
+
+# 添加backend目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import settings
+from app.models.inference import LLMInference
+from app.models.onnx_backend import ONNX_MODEL_FILE, onnx_model_dir, export_onnx
+from app.models.schemas import ChatMessage
+
+PROMPTS = [
+    "请介绍一下你自己。",
+    "What is the capital of France?",
+    "用三句话解释什么是大语言模型，并举一个实际应用的例子。",
+    "Write a short poem about the stars.",
+]
+
+
+def messages(i):
+    return [ChatMessage(role="user", content=PROMPTS[i % len(PROMPTS)])]
+
+
+def single(llm, i, max_new_tokens):
+    """单个请求的首token延迟（秒）、解码吞吐量（tokens/s）和生成的token"""
+    start_time = time.perf_counter()
+    request = llm.submit(messages(i), max_new_tokens=max_new_tokens, temperature=0)
+    tokens = request.iter_tokens()
+    next(tokens, None)
+    ttft = time.perf_counter() - start_time
+    for _ in tokens:
+        pass
+    decode_time = time.perf_counter() - start_time - ttft
+    return ttft, (len(request.output_ids) - 1) / decode_time if decode_time > 0 else 0.0, request.output_ids
+
+
+def concurrent(llm, concurrency, max_new_tokens):
+    """同时提交concurrency个请求，返回总吞吐量（tokens/s）"""
+    start_time = time.perf_counter()
+    requests = [llm.submit(messages(i), max_new_tokens=max_new_tokens, temperature=0) for i in range(concurrency)]
+    total_tokens = sum(len(request.result()) for request in requests)
+    return total_tokens / (time.perf_counter() - start_time)
+
+
+def run(name, model_path, rounds, max_new_tokens, concurrency, reference=None):
+    start_time = time.perf_counter()
+    llm = LLMInference(model_path, "", backend=name)
+    startup = time.perf_counter() - start_time
+    single(llm, 0, 4)  # 预热
+    results = [single(llm, i, max_new_tokens) for i in range(rounds)]
+    throughput = concurrent(llm, concurrency, max_new_tokens)
+    llm.close()
+    outputs = [output_ids for _, _, output_ids in results]
+    if reference is None:
+        match = "-"
+    else:
+        match = f"{sum(output == expected for output, expected in zip(outputs, reference))}/{len(outputs)}"
+    print(f"{name:<8} {startup:>9.2f}s {statistics.median(r[0] for r in results) * 1000:>10.1f}ms "
+          f"{statistics.median(r[1] for r in results):>12.1f} {throughput:>12.1f} {match:>8}")
+    return outputs
+
+
+def main():
+    """主函数"""
+    model_path = sys.argv[1] if len(sys.argv) > 1 else settings.MODEL_PATH
+    rounds = int(os.getenv("BENCH_ROUNDS", 8))
+    max_new_tokens = int(os.getenv("BENCH_MAX_NEW_TOKENS", 64))
+    concurrency = int(os.getenv("BENCH_CONCURRENCY", 8))
+    if not os.path.exists(os.path.join(onnx_model_dir(model_path), ONNX_MODEL_FILE)):
+        export_onnx(model_path)
+    print(f"模型: {model_path}")
+    print(f"单请求轮数: {rounds}, 并发请求数: {concurrency}, 每个请求最多生成 {max_new_tokens} tokens")
+    print("=" * 68)
+    print(f"{'后端':<8} {'启动耗时':>8} {'首token(中位数)':>10} {'解码tokens/s':>10} {'并发tokens/s':>10} {'输出一致':>6}")
+    reference = run("torch", model_path, rounds, max_new_tokens, concurrency)
+    run("onnx", model_path, rounds, max_new_tokens, concurrency, reference)
+
+
+if __name__ == "__main__":
+    main()
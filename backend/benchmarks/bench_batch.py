@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+离线批处理基准测试
+对比逐个请求处理与按长度排序后以低优先级分组提交（批量预填充+批量解码）的总吞吐量
+"""
+
+import os
+import sys
+import time
+
+# 添加backend目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import settings
+from app.models.inference import LLMInference
+from app.models.schemas import ChatMessage
+
+PROMPTS = [
+    "请介绍一下你自己。",
+    "What is the capital of France?",
+    "用三句话解释什么是大语言模型，并举一个实际应用的例子。",
+    "Write a short poem about the stars.",
+    "你好",
+    "Summarize the plot of Romeo and Juliet in a few sentences, focusing on the main conflict.",
+]
+
+
+def run(name, llm, messages, max_new_tokens, chunk_size):
+    """每次提交chunk_size个请求并等待完成，返回总吞吐量"""
+    start_time = time.perf_counter()
+    total_tokens = 0
+    for start in range(0, len(messages), chunk_size):
+        requests = [
+            llm.submit(message, max_new_tokens=max_new_tokens, temperature=0, low_priority=chunk_size > 1)
+            for message in messages[start:start + chunk_size]
+        ]
+        total_tokens += sum(len(request.result()) for request in requests)
+    elapsed = time.perf_counter() - start_time
+    print(f"{name:<24} {total_tokens / elapsed:>10.1f} tokens/s  ({len(messages)} 个请求, {total_tokens} tokens, {elapsed:.2f}s)")
+
+
+def main():
+    """主函数"""
+    model_path = sys.argv[1] if len(sys.argv) > 1 else settings.MODEL_PATH
+    num_requests = int(os.getenv("BENCH_REQUESTS", 32))
+    max_new_tokens = int(os.getenv("BENCH_MAX_NEW_TOKENS", 64))
+    chunk_size = settings.BATCH_CONCURRENCY
+    print(f"模型: {model_path}")
+    print(f"请求数: {num_requests}, 每个请求最多生成 {max_new_tokens} tokens, 分组大小: {chunk_size}")
+    print("=" * 60)
+
+    llm = LLMInference(model_path, "")
+    messages = [[ChatMessage(role="user", content=PROMPTS[i % len(PROMPTS)])] for i in range(num_requests)]
+    llm.submit(messages[0], max_new_tokens=4, temperature=0).result()  # 预热
+    run("逐个请求", llm, messages, max_new_tokens, 1)
+    # 与批处理执行器相同：按提示词长度排序，减少组内填充
+    messages.sort(key=lambda message: len(llm.encode_prompt(message, max_new_tokens)))
+    run("批处理 (低优先级分组)", llm, messages, max_new_tokens, chunk_size)
+    llm.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+编译模式基准测试
+对比eager模式与torch.compile编译模式的启动耗时、首个请求延迟和稳定状态下的请求延迟
+"""
+
+import os
+import statistics
+import sys
+import time
+
+# 添加backend目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import settings
+from app.models.inference import LLMInference
+from app.models.schemas import ChatMessage
+
+PROMPTS = [
+    "请介绍一下你自己。",
+    "What is the capital of France?",
+    "用三句话解释什么是大语言模型。",
+    "Write a short poem about the stars.",
+]
+
+
+def latency(llm, prompt, max_new_tokens):
+    """单个请求的端到端延迟（秒）"""
+    start_time = time.perf_counter()
+    llm.submit([ChatMessage(role="user", content=prompt)], max_new_tokens=max_new_tokens, temperature=0).result()
+    return time.perf_counter() - start_time
+
+
+def run(name, model_path, compile_mode, rounds, max_new_tokens):
+    settings.MODEL_COMPILE = compile_mode
+    start_time = time.perf_counter()
+    llm = LLMInference(model_path, "")
+    startup = time.perf_counter() - start_time
+    first = latency(llm, PROMPTS[0], max_new_tokens)
+    steady = [latency(llm, PROMPTS[i % len(PROMPTS)], max_new_tokens) for i in range(rounds)]
+    llm.close()
+    if compile_mode and not llm.compiled:
+        name += " (编译失败，已回退)"
+    print(f"{name:<10} {startup:>9.2f}s {first * 1000:>10.1f}ms {statistics.median(steady) * 1000:>10.1f}ms")
+
+
+def main():
+    """主函数"""
+    model_path = sys.argv[1] if len(sys.argv) > 1 else settings.MODEL_PATH
+    rounds = int(os.getenv("BENCH_ROUNDS", 20))
+    max_new_tokens = int(os.getenv("BENCH_MAX_NEW_TOKENS", 64))
+    print(f"模型: {model_path}")
+    print(f"预填充分桶: {settings.COMPILE_BUCKETS}, 稳定状态请求数: {rounds}, 每个请求最多生成 {max_new_tokens} tokens")
+    print("=" * 56)
+    print(f"{'模式':<10} {'启动耗时':>10} {'首个请求':>10} {'稳定延迟(中位数)':>12}")
+    run("eager", model_path, False, rounds, max_new_tokens)
+    run("compile", model_path, True, rounds, max_new_tokens)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+增量解码基准测试
+对比逐token单独解码与增量解码的吞吐量和输出正确性
+"""
+
+import os
+import sys
+import time
+
+# 添加backend目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transformers import AutoTokenizer
+from app.config import settings
+from app.models.detokenizer import IncrementalDetokenizer
+
+SAMPLE_TEXT = (
+    "StellarChat 是一个基于大语言模型的聊天应用，支持流式输出、会话管理和多轮对话。"
+    "The backend serves OpenAI-compatible chat completions over HTTP and WebSocket. "
+    "在中文场景下，一个汉字通常会被编码为多个字节级token，逐个解码时容易出现乱码。"
+)
+
+
+def per_token_decode(tokenizer, token_ids):
+    """现有实现：每个token单独解码"""
+    return "".join(tokenizer.decode([token_id], skip_special_tokens=True) for token_id in token_ids)
+
+
+def incremental_decode(tokenizer, token_ids):
+    """增量解码"""
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    text = "".join(detokenizer.push(token_id) for token_id in token_ids)
+    return text + detokenizer.flush()
+
+
+def run(name, func, tokenizer, token_ids, expected, rounds):
+    start_time = time.perf_counter()
+    for _ in range(rounds):
+        text = func(tokenizer, token_ids)
+    elapsed = time.perf_counter() - start_time
+    tokens_per_sec = len(token_ids) * rounds / elapsed
+    status = "✓" if text == expected else "✗"
+    print(f"{status} {name:<20} {tokens_per_sec:>12.0f} tokens/s  输出{'一致' if text == expected else '不一致'}")
+
+
+def main():
+    """主函数"""
+    model_path = sys.argv[1] if len(sys.argv) > 1 else settings.MODEL_PATH
+    rounds = int(os.getenv("BENCH_ROUNDS", 20))
+    print(f"加载分词器: {model_path}")
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+
+    token_ids = tokenizer.encode(SAMPLE_TEXT * 4, add_special_tokens=False)
+    expected = tokenizer.decode(token_ids, skip_special_tokens=True)
+    print(f"样本长度: {len(token_ids)} tokens, 轮数: {rounds}")
+    print("=" * 50)
+    run("逐token解码", per_token_decode, tokenizer, token_ids, expected, rounds)
+    run("增量解码", incremental_decode, tokenizer, token_ids, expected, rounds)
+
+
+if __name__ == "__main__":
+    main()
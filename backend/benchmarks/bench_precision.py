@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+模型精度基准测试
+在相同提示词上对比 fp32 / bf16 / int8 三种CPU精度模式的权重内存占用、解码吞吐量和输出与fp32的一致程度
+"""
+
+import os
+import sys
+import time
+
+# 添加backend目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from app.config import settings
+from app.models.context import ContextBuilder
+from app.models.precision import resolve_precision, load_dtype, apply_precision, model_size_bytes
+from app.models.schemas import ChatMessage
+from app.models.scheduler import BatchScheduler, GenerationRequest
+
+PROMPTS = [
+    "请介绍一下你自己。",
+    "What is the capital of France?",
+    "用三句话解释什么是大语言模型。",
+    "Write a short poem about the stars.",
+]
+
+
+def generate(scheduler, prompts, max_new_tokens):
+    """逐个提交请求，返回各请求的输出和吞吐量"""
+    outputs = []
+    start_time = time.perf_counter()
+    for prompt_ids in prompts:
+        request = scheduler.submit(GenerationRequest(prompt_ids, max_new_tokens=max_new_tokens, temperature=0))
+        outputs.append(request.result())
+    elapsed = time.perf_counter() - start_time
+    return outputs, sum(len(output) for output in outputs) / elapsed
+
+
+def match_rate(outputs, expected):
+    """与参考输出逐位置相同的token比例"""
+    total = sum(len(tokens) for tokens in expected)
+    same = sum(a == b for output, tokens in zip(outputs, expected) for a, b in zip(output, tokens))
+    return same / total if total else 1.0
+
+
+def main():
+    """主函数"""
+    model_path = sys.argv[1] if len(sys.argv) > 1 else settings.MODEL_PATH
+    max_new_tokens = int(os.getenv("BENCH_MAX_NEW_TOKENS", 64))
+    print(f"模型: {model_path}")
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+
+    expected = None
+    print(f"请求数: {len(PROMPTS)}, 每个请求最多生成 {max_new_tokens} tokens, 贪心解码")
+    print("=" * 60)
+    print(f"{'精度':<6} {'权重大小':>10} {'吞吐量':>16} {'与fp32一致':>12}")
+    for mode in ("fp32", "bf16", "int8"):
+        precision = resolve_precision(mode)
+        if precision != mode:
+            print(f"{mode:<6} 当前环境不支持，跳过")
+            continue
+        model = AutoModelForCausalLM.from_pretrained(model_path, dtype=load_dtype(precision),
+                                                     trust_remote_code=True).eval()
+        model = apply_precision(model, precision)
+        builder = ContextBuilder(tokenizer, getattr(model.config, "max_position_embeddings", 2048))
+        prompts = [builder.build([ChatMessage(role="user", content=prompt)], max_new_tokens) for prompt in PROMPTS]
+
+        scheduler = BatchScheduler(model, tokenizer, max_batch_size=1)
+        generate(scheduler, prompts[:1], 8)  # 预热
+        outputs, tokens_per_sec = generate(scheduler, prompts, max_new_tokens)
+        scheduler.stop()
+        if expected is None:
+            expected = outputs
+        size_mb = model_size_bytes(model) / 1024 / 1024
+        print(f"{mode:<6} {size_mb:>8.1f}MB {tokens_per_sec:>10.1f} tokens/s {match_rate(outputs, expected):>11.1%}")
+
+
+if __name__ == "__main__":
+    main()
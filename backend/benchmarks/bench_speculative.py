@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+推测解码基准测试
+对比只用主模型与加入草稿模型后的单请求解码吞吐量、草稿接受率和输出一致性
+"""
+
+import os
+import sys
+import time
+
+# 添加backend目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from app.config import settings
+from app.models.context import ContextBuilder
+from app.models.schemas import ChatMessage
+from app.models.scheduler import BatchScheduler, GenerationRequest
+
+PROMPTS = [
+    "请介绍一下你自己。",
+    "What is the capital of France?",
+    "用三句话解释什么是大语言模型。",
+    "Write a short poem about the stars.",
+]
+
+
+def load_model(model_path):
+    return AutoModelForCausalLM.from_pretrained(model_path, dtype=torch.float32, trust_remote_code=True).eval()
+
+
+def run(name, scheduler, prompts, max_new_tokens):
+    """逐个提交请求（单序列解码），返回各请求的输出"""
+    outputs = []
+    total_tokens = 0
+    start_time = time.perf_counter()
+    for prompt_ids in prompts:
+        request = scheduler.submit(GenerationRequest(prompt_ids, max_new_tokens=max_new_tokens, temperature=0))
+        outputs.append(request.result())
+        total_tokens += len(outputs[-1])
+    elapsed = time.perf_counter() - start_time
+    print(f"{name:<12} {total_tokens / elapsed:>10.1f} tokens/s  ({total_tokens} tokens, {elapsed:.2f}s)")
+    return outputs
+
+
+def main():
+    """主函数"""
+    model_path = sys.argv[1] if len(sys.argv) > 1 else settings.MODEL_PATH
+    draft_model_path = sys.argv[2] if len(sys.argv) > 2 else settings.DRAFT_MODEL_PATH
+    if not draft_model_path:
+        print("请通过第二个命令行参数或 DRAFT_MODEL_PATH 指定草稿模型")
+        sys.exit(1)
+    max_new_tokens = int(os.getenv("BENCH_MAX_NEW_TOKENS", 64))
+
+    print(f"主模型: {model_path}")
+    print(f"草稿模型: {draft_model_path}")
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    model = load_model(model_path)
+    draft_model = load_model(draft_model_path)
+    builder = ContextBuilder(tokenizer, getattr(model.config, "max_position_embeddings", 2048))
+    prompts = [builder.build([ChatMessage(role="user", content=prompt)], max_new_tokens) for prompt in PROMPTS]
+
+    print(f"请求数: {len(prompts)}, 每个请求最多生成 {max_new_tokens} tokens, 贪心解码")
+    print("=" * 50)
+    baseline = BatchScheduler(model, tokenizer, max_batch_size=1)
+    expected = run("主模型", baseline, prompts, max_new_tokens)
+    baseline.stop()
+
+    for num_tokens in (2, 4, 8):
+        scheduler = BatchScheduler(model, tokenizer, max_batch_size=1, draft_model=draft_model,
+                                   num_speculative_tokens=num_tokens)
+        outputs = run(f"推测解码 k={num_tokens}", scheduler, prompts, max_new_tokens)
+        scheduler.stop()
+        status = "✓ 输出一致" if outputs == expected else "✗ 输出不一致"
+        print(f"{'':<12} 草稿接受率 {scheduler.acceptance_rate:.1%}  {status}")
+
+
+if __name__ == "__main__":
+    main()
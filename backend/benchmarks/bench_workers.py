@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+多进程推理基准测试
+在相同的并发请求下对比单进程推理与多个推理进程的总吞吐量
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+# 添加backend目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from app.config import settings
+from app.models.inference import LLMInference
+from app.models.schemas import ChatMessage
+from app.models.workers import WorkerPoolInference
+
+PROMPTS = [
+    "请介绍一下你自己。",
+    "What is the capital of France?",
+    "用三句话解释什么是大语言模型。",
+    "Write a short poem about the stars.",
+]
+
+
+async def run(name, llm, concurrency, max_new_tokens):
+    """同时提交concurrency个请求，返回总吞吐量"""
+    messages = [[ChatMessage(role="user", content=PROMPTS[i % len(PROMPTS)])] for i in range(concurrency)]
+    await llm.agenerate(messages[0], max_new_tokens=4, temperature=0)  # 预热
+    start_time = time.perf_counter()
+    results = await asyncio.gather(*[
+        llm.agenerate(message, max_new_tokens=max_new_tokens, temperature=0) for message in messages
+    ])
+    elapsed = time.perf_counter() - start_time
+    total_tokens = sum(len(result.output_ids) for result in results)
+    print(f"{name:<16} {total_tokens / elapsed:>10.1f} tokens/s  ({total_tokens} tokens, {elapsed:.2f}s)")
+
+
+async def main():
+    """主函数"""
+    model_path = sys.argv[1] if len(sys.argv) > 1 else settings.MODEL_PATH
+    num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else max(2, settings.INFERENCE_WORKERS)
+    concurrency = int(os.getenv("BENCH_CONCURRENCY", 16))
+    max_new_tokens = int(os.getenv("BENCH_MAX_NEW_TOKENS", 64))
+    print(f"模型: {model_path}")
+    print(f"CPU核数: {os.cpu_count()}, 并发请求: {concurrency}, 每个请求最多生成 {max_new_tokens} tokens")
+    print("=" * 50)
+
+    llm = LLMInference(model_path, "")
+    await run(f"单进程 ({torch.get_num_threads()}线程)", llm, concurrency, max_new_tokens)
+    llm.close()
+
+    workers = WorkerPoolInference(model_path, "", num_workers)
+    await run(f"{num_workers}进程 (各{workers.threads}线程)", workers, concurrency, max_new_tokens)
+    workers.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+ONNX模型导出脚本
+把transformers模型导出为onnx推理后端（INFERENCE_BACKEND=onnx）加载的目录，默认导出到模型目录下的onnx子目录
+需要安装onnx（导出）和onnxruntime（推理）
+"""
+
+import sys
+import os
+
+# 添加backend目录到Python路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.config import settings
+from app.models.onnx_backend import export_onnx
+
+
+def main():
+    """主函数"""
+    model_path = sys.argv[1] if len(sys.argv) > 1 else settings.MODEL_PATH
+    output_dir = sys.argv[2] if len(sys.argv) > 2 else None
+    print(f"正在导出ONNX模型: {model_path}")
+    try:
+        output_dir = export_onnx(model_path, output_dir)
+        print(f"ONNX模型导出成功: {output_dir}")
+    except Exception as e:
+        print(f"ONNX模型导出失败: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+import torch
+from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+from transformers import PreTrainedTokenizerFast, LlamaConfig, LlamaForCausalLM
+
+CORPUS = ["User: 你好\nAssistant: 你好！\n"]
+
+
+def build_tokenizer(corpus=CORPUS, vocab_size: int = 300):
+    """在corpus上训练一个小型字节级BPE分词器，避免依赖本地模型文件"""
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=["<|endoftext|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    tokenizer.train_from_iterator(corpus, trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|endoftext|>")
+
+
+def build_model(vocab_size, seed):
+    """构建随机初始化的小型Llama模型"""
+    torch.manual_seed(seed)
+    config = LlamaConfig(vocab_size=vocab_size, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=256)
+    return LlamaForCausalLM(config).eval()
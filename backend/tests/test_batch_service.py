@@ -0,0 +1,183 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app.models.database import Base, BatchJobModel
+from app.models.scheduler import GenerationRequest
+from app.services import batch_service
+from app.services.batch_service import BatchRunner, BatchFileTooLargeError
+
+
+class StubInference:
+    """立即完成生成的推理实例：内容为“超长”的请求提交失败，为“出错”的请求生成失败，其余回复“好的”"""
+
+    def __init__(self):
+        self.submitted = []
+        self.on_submit = None
+
+    def encode_prompt(self, messages, max_new_tokens: int = 200):
+        return list(range(len(messages[-1].content)))
+
+    def count_tokens(self, message) -> int:
+        return len(message.content)
+
+    def decode_output(self, request: GenerationRequest) -> str:
+        return "好的"
+
+    def submit(self, messages, **kwargs) -> GenerationRequest:
+        content = messages[-1].content
+        self.submitted.append(content)
+        if self.on_submit is not None:
+            self.on_submit(content)
+        if content == "超长":
+            raise ValueError("提示词过长")
+        generation = GenerationRequest(self.encode_prompt(messages))
+        if content == "出错":
+            generation._finish("error", RuntimeError("生成失败"))
+        else:
+            generation._emit(1)
+            generation._finish("stop")
+        return generation
+
+
+def request_line(content: str, model: str = "stellar-byte-llm", **fields) -> str:
+    return json.dumps({"model": model, "messages": [{"role": "user", "content": content}], **fields}, ensure_ascii=False)
+
+
+async def as_chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+class TestBatchRunner(unittest.TestCase):
+    """直接调用执行器处理任务，模型池替换为桩，数据库使用临时SQLite文件"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        engine = create_engine(f"sqlite:///{os.path.join(self.temp_dir.name, 'test.db')}",
+                               connect_args={"check_same_thread": False})
+        self.addCleanup(engine.dispose)
+        Base.metadata.create_all(engine)
+        self.SessionLocal = sessionmaker(bind=engine)
+        self.db = self.SessionLocal()
+        self.addCleanup(self.db.close)
+
+        self.llm = StubInference()
+        self.model_pool = mock.Mock()
+        self.model_pool.get.side_effect = self.get_model
+        patchers = [
+            mock.patch.object(batch_service, "SessionLocal", self.SessionLocal),
+            mock.patch.object(batch_service, "model_pool", self.model_pool)
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.batch_dir = os.path.join(self.temp_dir.name, "batches")
+        self.runner = BatchRunner(batch_dir=self.batch_dir, concurrency=2, max_file_bytes=1024)
+
+    def get_model(self, model_id, lease=False):
+        if model_id == "missing":
+            raise ValueError(f"模型不存在: {model_id}")
+        return self.llm
+
+    def create_job(self, *lines) -> str:
+        data = "".join(line + "\n" for line in lines).encode("utf-8")
+        return asyncio.run(self.runner.create_job(self.db, as_chunks(data))).id
+
+    def read_output(self, job_id: str) -> dict:
+        with open(self.runner.output_path(job_id), "r", encoding="utf-8") as output_file:
+            records = [json.loads(line) for line in output_file]
+        self.assertEqual(len(records), len({record["index"] for record in records}))
+        return {record["index"]: record for record in records}
+
+    def job(self, job_id: str) -> BatchJobModel:
+        self.db.expire_all()
+        return self.db.get(BatchJobModel, job_id)
+
+    def test_create_job_rejects_oversized_upload(self):
+        # 测试上传内容超过大小上限时拒绝，已写入的部分和任务目录一并删除
+        chunks = as_chunks(request_line("a").encode("utf-8") + b"\n", b"x" * 1024)
+        with self.assertRaises(BatchFileTooLargeError):
+            asyncio.run(self.runner.create_job(self.db, chunks))
+        self.assertEqual(os.listdir(self.batch_dir), [])
+        self.assertEqual(self.db.query(BatchJobModel).count(), 0)
+
+    def test_create_job_rejects_empty_input(self):
+        # 测试只有空行的输入文件被拒绝
+        with self.assertRaises(ValueError):
+            asyncio.run(self.runner.create_job(self.db, as_chunks(b"\n", b"  \n")))
+        self.assertEqual(os.listdir(self.batch_dir), [])
+        self.assertEqual(self.db.query(BatchJobModel).count(), 0)
+
+    def test_create_job_counts_requests(self):
+        job_id = self.create_job(request_line("a"), "", request_line("b"))
+        job = self.job(job_id)
+        self.assertEqual((job.status, job.total), ("queued", 2))
+
+    def test_resume_truncates_partial_line(self):
+        # 测试重启后截掉写了一半的行，只处理输出文件中没有的请求
+        job_id = self.create_job(*(request_line(content) for content in ["a", "b", "c", "d"]))
+        with open(self.runner.output_path(job_id), "w", encoding="utf-8") as output_file:
+            output_file.write(json.dumps({"index": 0, "custom_id": None, "response": {}}) + "\n")
+            output_file.write(json.dumps({"index": 1, "custom_id": None, "error": {"message": "失败"}}) + "\n")
+            output_file.write('{"index": 2, "cus')
+        self.assertEqual(self.runner._load_finished(job_id), {0: True, 1: False})
+        with open(self.runner.output_path(job_id), "rb") as output_file:
+            self.assertTrue(output_file.read().endswith(b"\n"))
+
+        self.runner._run(job_id)
+        self.assertEqual(self.llm.submitted, ["c", "d"])
+        self.assertEqual(sorted(self.read_output(job_id)), [0, 1, 2, 3])
+        job = self.job(job_id)
+        self.assertEqual((job.status, job.completed, job.failed), ("completed", 3, 1))
+
+    def test_cancel_between_chunks(self):
+        # 测试取消后当前一组请求照常完成，之后的组不再提交
+        self.runner.concurrency = 1
+        job_id = self.create_job(*(request_line(content) for content in ["a", "b", "c"]))
+
+        def cancel(content):
+            db = self.SessionLocal()
+            try:
+                self.runner.cancel_job(db, job_id)
+            finally:
+                db.close()
+
+        self.llm.on_submit = cancel
+        self.runner._run(job_id)
+        self.assertEqual(self.llm.submitted, ["a"])
+        self.assertEqual(list(self.read_output(job_id)), [0])
+        job = self.job(job_id)
+        self.assertEqual((job.status, job.completed, job.failed), ("cancelled", 1, 0))
+        self.model_pool.release.assert_called_once_with(self.llm)
+
+    def test_request_failures_are_isolated(self):
+        # 测试无效请求、提交失败、生成失败和模型加载失败只记为对应请求失败，其余请求照常完成
+        job_id = self.create_job(
+            request_line("a", custom_id="ok-1"),
+            "not json",
+            json.dumps({"messages": "x"}),
+            request_line("超长"),
+            request_line("出错"),
+            request_line("a", model="missing"),
+            request_line("bb", custom_id="ok-2")
+        )
+        self.runner._run(job_id)
+        records = self.read_output(job_id)
+        self.assertEqual(sorted(records), list(range(7)))
+        for index in (0, 6):
+            self.assertEqual(records[index]["response"]["choices"][0]["message"]["content"], "好的")
+        self.assertEqual([records[0]["custom_id"], records[6]["custom_id"]], ["ok-1", "ok-2"])
+        for index, message in [(1, "无效的请求"), (2, "无效的请求"), (3, "提示词过长"), (4, "生成失败"), (5, "加载模型失败")]:
+            self.assertIn(message, records[index]["error"]["message"])
+        job = self.job(job_id)
+        self.assertEqual((job.status, job.completed, job.failed), ("completed", 2, 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import asyncio
+import contextlib
+import tempfile
+import unittest
+from unittest import mock
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app.middleware.api_key_auth import verify_api_key
+from app.models.database import Base, get_db, APIKeyModel, MessageModel
+from app.models.inference import LLMInference
+from app.models.scheduler import QueueFullError
+from app.models.schemas import ChatMessage, ChatCompletionRequest
+from app.services import chat_service as chat_service_module
+from app.services.chat_service import ChatService
+from app.routers import chat_completions
+from helpers import build_tokenizer, build_model
+
+MESSAGES = [ChatMessage(role="user", content="你好")]
+
+
+class InferenceTestCase(unittest.TestCase):
+    """加载保存到临时目录的小模型"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        tokenizer = build_tokenizer()
+        build_model(len(tokenizer), seed=0).save_pretrained(cls.directory.name)
+        tokenizer.save_pretrained(cls.directory.name)
+        cls.llm = LLMInference(cls.directory.name, "")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.llm.close()
+        cls.directory.cleanup()
+
+
+class TestQueueFull(InferenceTestCase):
+    """推理队列已满时提交立即被拒绝，聊天完成接口返回503"""
+
+    def setUp(self):
+        @contextlib.asynccontextmanager
+        async def lease(model_id=None):
+            yield self.llm
+
+        self.queued = []
+        patchers = [
+            mock.patch.object(self.llm.scheduler, "max_queue_size", 2),
+            mock.patch.object(chat_service_module.model_pool, "lease", lease)
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # 持有调度器的锁使已提交的请求停留在等待队列中
+        self.scheduler_lock = self.llm.scheduler._cond
+        self.scheduler_lock.acquire()
+        self.addCleanup(self.release_queue)
+
+    def release_queue(self):
+        self.scheduler_lock.release()
+        for request in self.queued:
+            request.cancel()
+            request.result(timeout=60)
+
+    def fill_queue(self):
+        """提交请求直到等待队列已满（空闲槽位加 max_queue_size 个）"""
+        capacity = self.llm.scheduler.max_batch_size + self.llm.scheduler.max_queue_size
+        self.queued = [self.llm.submit(MESSAGES, max_new_tokens=5) for _ in range(capacity)]
+
+    def test_full_queue_raises(self):
+        self.fill_queue()
+        rejected = REGISTRY.get_sample_value("inference_rejected_total")
+        with self.assertRaises(QueueFullError):
+            self.llm.submit(MESSAGES, max_new_tokens=5)
+        self.assertEqual(REGISTRY.get_sample_value("inference_rejected_total"), rejected + 1)
+
+    def test_completion_returns_503(self):
+        self.fill_queue()
+        request = ChatCompletionRequest(messages=MESSAGES, max_tokens=5, temperature=0.7)
+        with self.assertRaises(HTTPException) as context:
+            asyncio.run(ChatService().generate_completion(request))
+        self.assertEqual(context.exception.status_code, 503)
+        self.assertEqual(context.exception.headers, {"Retry-After": "1"})
+
+    def test_streaming_returns_503(self):
+        self.fill_queue()
+        request = ChatCompletionRequest(messages=MESSAGES, max_tokens=5, temperature=0.7, stream=True)
+        with self.assertRaises(HTTPException) as context:
+            asyncio.run(ChatService().generate_streaming_response(request))
+        self.assertEqual(context.exception.status_code, 503)
+
+
+class TestSavedMessageTokens(InferenceTestCase):
+    """会话消息按同一单位记录token数：渲染后的消息在提示词中占用的token数"""
+
+    def setUp(self):
+        @contextlib.asynccontextmanager
+        async def lease(model_id=None):
+            yield self.llm
+
+        patchers = [
+            mock.patch.object(chat_service_module.model_pool, "lease", lease),
+            mock.patch.object(chat_service_module.model_pool, "resident", return_value=self.llm)
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(engine)
+        self.db = sessionmaker(bind=engine)()
+        self.addCleanup(self.db.close)
+        chat_service_module.database_service.create_session(self.db, "s1", "测试会话")
+
+    def test_user_and_assistant_rows_use_rendered_counts(self):
+        # 测试用户消息和AI回复都按渲染后的token数（含角色前缀）保存，而不是生成的token数
+        request = ChatCompletionRequest(messages=MESSAGES, max_tokens=20, temperature=0.7, seed=0)
+        asyncio.run(ChatService().generate_completion(request, "s1", self.db))
+        rows = {row.role: row for row in self.db.query(MessageModel).all()}
+        self.assertEqual(sorted(rows), ["assistant", "user"])
+        for row in rows.values():
+            self.assertEqual(row.tokens, self.llm.count_tokens(ChatMessage(role=row.role, content=row.content)))
+
+
+class FullQueueInference:
+    """推理队列始终已满的推理实例"""
+
+    def submit(self, *args, **kwargs):
+        raise QueueFullError("推理队列已满")
+
+    async def agenerate(self, *args, **kwargs):
+        self.submit()
+
+
+class TestChatCompletionsEndpoint(unittest.TestCase):
+    def setUp(self):
+        @contextlib.asynccontextmanager
+        async def lease(model_id=None):
+            yield FullQueueInference()
+
+        patcher = mock.patch.object(chat_service_module.model_pool, "lease", lease)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        app = FastAPI()
+        app.include_router(chat_completions.router, prefix="/api")
+        app.dependency_overrides[get_db] = lambda: None
+        app.dependency_overrides[verify_api_key] = lambda: APIKeyModel(id="test")
+        self.client = TestClient(app)
+
+    def test_queue_full_returns_503(self):
+        # 测试推理队列已满时非流式和流式请求都返回503并提示稍后重试
+        for stream in (False, True):
+            response = self.client.post("/api/chat/completions", json={
+                "messages": [{"role": "user", "content": "你好"}], "temperature": 0.7, "stream": stream
+            })
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers["Retry-After"], "1")
+
+
+if __name__ == '__main__':
+    unittest.main()
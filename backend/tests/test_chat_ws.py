@@ -0,0 +1,132 @@
+import contextlib
+import json
+import tempfile
+import time
+import unittest
+from unittest import mock
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from app.models.database import APIKeyModel
+from app.models.inference import LLMInference
+from app.routers import chat_ws
+from app.services import chat_service as chat_service_module
+from helpers import build_tokenizer, build_model
+
+
+def wait_until(condition, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("等待超时")
+        time.sleep(0.02)
+
+
+class TestWebSocketChat(unittest.TestCase):
+    """通过WebSocket与小模型对话，数据库和API Key校验替换为桩"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        tokenizer = build_tokenizer()
+        build_model(len(tokenizer), seed=0).save_pretrained(cls.directory.name)
+        tokenizer.save_pretrained(cls.directory.name)
+        cls.llm = LLMInference(cls.directory.name, "")
+        app = FastAPI()
+        app.include_router(chat_ws.router)
+        cls.client = TestClient(app)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.llm.close()
+        cls.directory.cleanup()
+
+    def setUp(self):
+        @contextlib.asynccontextmanager
+        async def lease(model_id=None):
+            yield self.llm
+
+        original_submit = self.llm.submit
+
+        def submit(*args, **kwargs):
+            # 贪心解码这条提示词不会提前生成结束符，回复一直生成到长度上限
+            generation = original_submit(*args, **kwargs, temperature=0)
+            self.generations.append(generation)
+            return generation
+
+        self.generations = []
+        database_service = mock.Mock()
+        database_service.get_messages_as_chat_history.return_value = []
+        patchers = [
+            mock.patch.object(chat_service_module.model_pool, "lease", lease),
+            mock.patch.object(chat_service_module.model_pool, "resident", return_value=None),
+            mock.patch.object(chat_service_module, "database_service", database_service),
+            mock.patch.object(chat_ws, "database_service", database_service),
+            mock.patch.object(chat_ws, "get_db", lambda: iter([mock.Mock()])),
+            mock.patch.object(chat_ws, "get_api_key_from_websocket",
+                              mock.AsyncMock(return_value=APIKeyModel(id="test"))),
+            mock.patch.object(self.llm, "submit", side_effect=submit)
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # 放慢每个解码步，使取消和断开一定发生在生成结束之前
+        hook = self.llm.model.register_forward_pre_hook(lambda module, args: time.sleep(0.01))
+        self.addCleanup(hook.remove)
+
+    @contextlib.contextmanager
+    def connect(self):
+        with self.client.websocket_connect("/ws/chat?session_id=test") as session:
+            self.assertEqual(session.receive_json()["event"], "session_start")
+            yield session
+
+    def receive_until(self, session, event: str) -> list:
+        events = []
+        while not events or events[-1]["event"] != event:
+            events.append(session.receive_json())
+        return events
+
+    def test_invalid_message_keeps_session(self):
+        # 测试无效消息只回复错误事件，之后的消息照常处理
+        with self.connect() as session:
+            for frame in ["not json", json.dumps({"content": "缺少type"}), json.dumps({"type": "chat.unknown"})]:
+                session.send_text(frame)
+                error = session.receive_json()
+                self.assertEqual(error["event"], "error")
+                self.assertEqual(error["data"]["type"], "invalid_request_error")
+            session.send_bytes(b"binary")
+            self.assertEqual(session.receive_json()["data"]["type"], "invalid_request_error")
+
+            session.send_json({"type": "chat.message", "content": "你好"})
+            events = self.receive_until(session, "message_stop")
+            self.assertEqual(events[0]["event"], "content_block_start")
+            self.assertEqual(events[-2]["data"]["delta"]["finish_reason"], "length")
+
+    def test_cancel_stops_generation(self):
+        # 测试chat.cancel在生成过程中停止当前回复，会话继续可用
+        with self.connect() as session:
+            session.send_json({"type": "chat.message", "content": "你好"})
+            self.assertEqual(session.receive_json()["event"], "content_block_start")
+            self.assertEqual(session.receive_json()["event"], "content_block_delta")
+            session.send_json({"type": "chat.cancel"})
+            events = self.receive_until(session, "message_stop")
+            self.assertEqual(events[-2]["data"]["delta"]["finish_reason"], "cancelled")
+            self.assertLess(events[-2]["data"]["usage"]["output_tokens"], 200)
+            self.assertEqual(self.generations[0].finish_reason, "cancelled")
+
+            session.send_json({"type": "chat.message", "content": "你好"})
+            self.assertEqual(self.receive_until(session, "message_stop")[0]["event"], "content_block_start")
+
+    def test_disconnect_stops_generation(self):
+        # 测试生成过程中断开连接会取消生成请求
+        with self.connect() as session:
+            session.send_json({"type": "chat.message", "content": "你好"})
+            self.assertEqual(session.receive_json()["event"], "content_block_start")
+            self.assertEqual(session.receive_json()["event"], "content_block_delta")
+        generation = self.generations[0]
+        wait_until(lambda: generation.finish_reason is not None)
+        self.assertEqual(generation.finish_reason, "cancelled")
+        self.assertLess(len(generation.output_ids), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+from unittest import mock
+from app.models.compiled import parse_buckets, bucket_length, compile_model
+from app.models.scheduler import BatchScheduler, GenerationRequest
+from helpers import build_tokenizer, build_model
+
+
+class TestPrefillBuckets(unittest.TestCase):
+    def test_parse_and_select_bucket(self):
+        # 测试解析分桶配置并选择不小于输入长度的最小分桶
+        buckets = parse_buckets("64, 32,,bad,0,32")
+        self.assertEqual(buckets, [32, 64])
+        self.assertEqual(bucket_length(5, buckets), 32)
+        self.assertEqual(bucket_length(64, buckets), 64)
+        self.assertEqual(bucket_length(100, buckets), 100)
+
+    def test_padded_prefill_output_unchanged(self):
+        # 测试预填充右填充到分桶长度后，贪心解码的输出与不填充时一致
+        tokenizer = build_tokenizer()
+        model = build_model(len(tokenizer), seed=0)
+        prompt_ids = tokenizer.encode("User: 你好\nAssistant:", add_special_tokens=False)
+        outputs = []
+        for buckets in (None, [16, 64]):
+            scheduler = BatchScheduler(model, tokenizer, prefill_buckets=buckets)
+            try:
+                request = scheduler.submit(GenerationRequest(prompt_ids, max_new_tokens=20, temperature=0))
+                outputs.append(request.result(timeout=60))
+            finally:
+                scheduler.stop()
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_runtime_compile_failure_falls_back_to_eager(self):
+        # 测试编译后的前向在运行中出错时恢复eager前向并重试，请求仍正常完成且输出不变
+        tokenizer = build_tokenizer()
+        model = build_model(len(tokenizer), seed=0)
+        prompt_ids = tokenizer.encode("User: 你好\nAssistant:", add_special_tokens=False)
+        outputs = []
+        for compiled in (False, True):
+            if compiled:
+                failing = mock.Mock(side_effect=RuntimeError("recompile failed"))
+                with mock.patch("app.models.compiled.torch.compile", return_value=failing):
+                    eager_forward = compile_model(model)
+            scheduler = BatchScheduler(model, tokenizer)
+            try:
+                request = scheduler.submit(GenerationRequest(prompt_ids, max_new_tokens=20, temperature=0))
+                outputs.append(request.result(timeout=60))
+            finally:
+                scheduler.stop()
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(failing.call_count, 1)
+        self.assertIs(model.forward, eager_forward)
+
+
+if __name__ == '__main__':
+    unittest.main()
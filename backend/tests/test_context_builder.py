@@ -0,0 +1,75 @@
+import unittest
+from app.models.context import ContextBuilder, pack_token_ids, unpack_token_ids
+from app.models.schemas import ChatMessage
+from helpers import build_tokenizer
+
+
+class TestContextBuilder(unittest.TestCase):
+    def setUp(self):
+        self.tokenizer = build_tokenizer()
+        self.history = []
+        for i in range(20):
+            self.history.append(ChatMessage(role="user", content=f"第{i}个问题"))
+            self.history.append(ChatMessage(role="assistant", content=f"第{i}个回答"))
+        self.history.append(ChatMessage(role="user", content="最新的问题"))
+
+    def decode(self, token_ids):
+        return self.tokenizer.decode(token_ids)
+
+    def test_keeps_recent_turns_within_budget(self):
+        # 测试提示词不超过预算，且保留最新的消息
+        builder = ContextBuilder(self.tokenizer, max_context_tokens=200)
+        prompt_ids = builder.build(self.history, max_new_tokens=50)
+        self.assertLessEqual(len(prompt_ids), 150)
+        prompt = self.decode(prompt_ids)
+        self.assertTrue(prompt.endswith("User: 最新的问题\nAssistant:"))
+        self.assertIn("第19个回答", prompt)
+        self.assertNotIn("第0个问题", prompt)
+
+    def test_full_history_when_it_fits(self):
+        # 测试预算足够时与完整渲染一致
+        builder = ContextBuilder(self.tokenizer, max_context_tokens=100000)
+        prompt = self.decode(builder.build(self.history, max_new_tokens=50))
+        self.assertTrue(prompt.startswith("User: 第0个问题\n"))
+
+    def test_system_prefix_is_kept(self):
+        # 测试开头的system消息被渲染为固定前缀，截断历史时也保留
+        builder = ContextBuilder(self.tokenizer, max_context_tokens=200)
+        messages = [ChatMessage(role="system", content="你是一个助手")] + self.history
+        prefix_ids = builder.system_prefix(messages)
+        prompt_ids = builder.build(messages, max_new_tokens=50)
+        self.assertLessEqual(len(prompt_ids), 150)
+        self.assertEqual(prompt_ids[:len(prefix_ids)], prefix_ids)
+        self.assertEqual(self.decode(prefix_ids), "System: 你是一个助手\n")
+        self.assertNotIn("第0个问题", self.decode(prompt_ids))
+
+    def test_oversized_message_keeps_tail(self):
+        # 测试单条消息超出预算时保留其末尾
+        builder = ContextBuilder(self.tokenizer, max_context_tokens=40)
+        messages = [ChatMessage(role="user", content="很长的问题" * 50 + "结尾")]
+        prompt_ids = builder.build(messages, max_new_tokens=10)
+        self.assertLessEqual(len(prompt_ids), 30)
+        self.assertTrue(self.decode(prompt_ids).endswith("结尾\nAssistant:"))
+
+    def test_token_counts_are_cached(self):
+        # 测试单条消息的token只编码一次
+        builder = ContextBuilder(self.tokenizer, max_context_tokens=200)
+        message = self.history[0]
+        first = builder.encode_message(message)
+        self.assertIs(builder.encode_message(message), first)
+        self.assertEqual(builder.count_tokens(message), len(first))
+
+    def test_uses_stored_token_ids(self):
+        # 测试来源一致时直接使用数据库中保存的token id，来源不同时重新分词
+        builder = ContextBuilder(self.tokenizer, max_context_tokens=200)
+        expected = builder.encode_message(ChatMessage(role="user", content="已保存的消息"))
+        self.assertEqual(unpack_token_ids(pack_token_ids(expected)), expected)
+        message = ChatMessage(role="user", content="已保存的消息")
+        message._token_ids, message._token_source = [1, 2, 3], builder.source
+        self.assertEqual(builder.encode_message(message), [1, 2, 3])
+        message._token_source = "other-tokenizer#1"
+        self.assertEqual(builder.encode_message(message), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
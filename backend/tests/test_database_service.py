@@ -72,5 +72,17 @@ class TestDatabaseService(unittest.TestCase):
         self.assertEqual(messages[0].role, "user")
         self.assertEqual(messages[1].role, "assistant")
 
+    def test_get_chat_history_within_token_budget(self):
+        # 测试按存储的token数只加载预算内最近的消息
+        session_id = str(uuid.uuid4())
+        self.database_service.create_session(self.db, session_id, "测试会话")
+        for i in range(10):
+            self.database_service.add_message(self.db, session_id, "user", f"问题{i}", 10)
+            self.database_service.add_message(self.db, session_id, "assistant", f"回答{i}", 20)
+
+        history = self.database_service.get_messages_as_chat_history(self.db, session_id, max_tokens=65)
+        self.assertEqual([msg.content for msg in history], ["问题8", "回答8", "问题9", "回答9"])
+        self.assertEqual(len(self.database_service.get_messages_as_chat_history(self.db, session_id)), 20)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,45 @@
+import unittest
+from app.models.detokenizer import IncrementalDetokenizer
+from helpers import build_tokenizer
+
+CORPUS = [
+    "你好，世界！这是一个测试消息。",
+    "StellarChat supports streaming chat completions.",
+    "增量解码需要正确处理多字节字符和合并的词片。",
+]
+
+
+class TestIncrementalDetokenizer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = build_tokenizer(CORPUS, vocab_size=400)
+
+    def stream(self, text):
+        token_ids = self.tokenizer.encode(text, add_special_tokens=False)
+        detokenizer = IncrementalDetokenizer(self.tokenizer)
+        chunks = [detokenizer.push(token_id) for token_id in token_ids]
+        chunks.append(detokenizer.flush())
+        return token_ids, [chunk for chunk in chunks if chunk]
+
+    def test_matches_full_decode(self):
+        # 测试增量输出拼接后与整体解码一致
+        text = "".join(CORPUS) * 3
+        token_ids, chunks = self.stream(text)
+        self.assertEqual("".join(chunks), self.tokenizer.decode(token_ids))
+
+    def test_no_partial_characters(self):
+        # 测试中文文本不会输出不完整的字符
+        _, chunks = self.stream("多字节字符不会被拆开，未登录的汉字如龘也一样。")
+        for chunk in chunks:
+            self.assertNotIn("�", chunk)
+
+    def test_skips_special_tokens(self):
+        # 测试结束符不会出现在输出中
+        token_ids = self.tokenizer.encode("你好", add_special_tokens=False) + [self.tokenizer.eos_token_id]
+        detokenizer = IncrementalDetokenizer(self.tokenizer)
+        text = "".join(detokenizer.push(token_id) for token_id in token_ids) + detokenizer.flush()
+        self.assertEqual(text, "你好")
+
+
+if __name__ == '__main__':
+    unittest.main()
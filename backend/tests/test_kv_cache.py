@@ -0,0 +1,84 @@
+import unittest
+from app.models.kv_cache import SessionKVCache
+from app.models.scheduler import BatchScheduler, GenerationRequest
+from helpers import build_tokenizer, build_model
+
+
+class TestSessionKVCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = build_tokenizer()
+        cls.model = build_model(len(cls.tokenizer), seed=0)
+        cls.first_turn = cls.tokenizer.encode("User: 你好\nAssistant:", add_special_tokens=False)
+
+    def setUp(self):
+        self.session_cache = SessionKVCache(max_bytes=16 * 1024 * 1024)
+        self.scheduler = BatchScheduler(self.model, self.tokenizer, max_batch_size=4, session_cache=self.session_cache)
+        self.prefill_lengths = []
+        self.hook = self.model.register_forward_pre_hook(self.record_prefill, with_kwargs=True)
+
+    def tearDown(self):
+        self.hook.remove()
+        self.scheduler.stop()
+
+    def record_prefill(self, module, args, kwargs):
+        if kwargs["input_ids"].shape[1] > 1:
+            self.prefill_lengths.append(kwargs["input_ids"].shape[1])
+
+    def generate(self, prompt_ids, session_id: str = None):
+        request = GenerationRequest(prompt_ids, max_new_tokens=10, temperature=0, session_id=session_id)
+        return self.scheduler.submit(request).result(timeout=60)
+
+    def second_turn(self, output_ids):
+        """第二轮提示词：第一轮提示词加回复，再接新的用户消息"""
+        return self.first_turn + output_ids + self.tokenizer.encode("\nUser: 再见\nAssistant:", add_special_tokens=False)
+
+    def test_second_turn_reuses_session_prefix(self):
+        # 测试第二轮只预填充上一轮缓存之后的新token，贪心解码结果与完整预填充一致
+        output_ids = self.generate(self.first_turn, "s1")
+        prompt_ids = self.second_turn(output_ids)
+        expected = self.generate(prompt_ids)
+        cached_len = len(self.session_cache._entries["s1"].token_ids)
+        self.prefill_lengths.clear()
+        self.assertEqual(self.generate(prompt_ids, "s1"), expected)
+        self.assertEqual(self.prefill_lengths, [len(prompt_ids) - cached_len])
+
+    def test_diverging_prefix_falls_back_to_full_prefill(self):
+        # 测试提示词与缓存从第一个token起就不同时完整预填充；从中间开始不同时只复用公共前缀
+        self.generate(self.first_turn, "s1")
+        prompt_ids = self.tokenizer.encode("你好\nAssistant:", add_special_tokens=False)
+        self.assertNotEqual(prompt_ids[0], self.first_turn[0])
+        expected = self.generate(prompt_ids)
+        self.prefill_lengths.clear()
+        self.assertEqual(self.generate(prompt_ids, "s1"), expected)
+        self.assertEqual(self.prefill_lengths, [len(prompt_ids)])
+
+        # 缓存已更新为上一轮的提示词和回复，修改其中一个token后只复用之前的部分
+        cached_ids = self.session_cache._entries["s1"].token_ids
+        edited = list(cached_ids)
+        edited[5] = edited[5] + 1
+        edited += self.tokenizer.encode("\nUser: 再见\nAssistant:", add_special_tokens=False)
+        expected = self.generate(edited)
+        self.prefill_lengths.clear()
+        self.assertEqual(self.generate(edited, "s1"), expected)
+        self.assertEqual(self.prefill_lengths, [len(edited) - 5])
+
+    def test_lru_eviction_by_bytes(self):
+        # 测试超出内存预算时淘汰最久未使用的会话，被淘汰的会话下一轮完整预填充
+        output_ids = self.generate(self.first_turn, "s1")
+        entry_bytes = self.session_cache.total_bytes
+        # 预算只够容纳一个会话
+        self.session_cache.max_bytes = entry_bytes * 3 // 2
+        self.generate(self.first_turn, "s2")
+        self.assertEqual(list(self.session_cache._entries), ["s2"])
+        self.assertLessEqual(self.session_cache.total_bytes, self.session_cache.max_bytes)
+
+        prompt_ids = self.second_turn(output_ids)
+        expected = self.generate(prompt_ids)
+        self.prefill_lengths.clear()
+        self.assertEqual(self.generate(prompt_ids, "s1"), expected)
+        self.assertEqual(self.prefill_lengths, [len(prompt_ids)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+from app.models.model_pool import ModelPool, ModelLoadingError, parse_model_paths
+
+MB = 1024 * 1024
+
+
+class FakeInference:
+    def __init__(self, path):
+        self.path = path
+        self.busy = False
+        self.closed = False
+        self.warmed_up = False
+
+    def warmup(self, max_new_tokens):
+        self.warmed_up = True
+
+    def close(self):
+        self.closed = True
+
+
+class FakeModelPool(ModelPool):
+    """每个模型固定占用100MB，不加载真实权重"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loaded = []
+
+    def _estimate_bytes(self, path):
+        return 100 * MB
+
+    def _load_model(self, path):
+        self.loaded.append(path)
+        return FakeInference(path)
+
+    def _model_bytes(self, llm):
+        return 100 * MB
+
+
+class TestModelPool(unittest.TestCase):
+    def setUp(self):
+        model_paths = {"a": "/models/a", "b": "/models/b", "c": "/models/c"}
+        self.pool = FakeModelPool(model_paths, default_path="/models/default", max_bytes=250 * MB)
+
+    def test_parse_model_paths(self):
+        # 测试解析 MODEL_PATHS 配置
+        self.assertEqual(parse_model_paths("a=/models/a, b = /models/b,,bad"), {"a": "/models/a", "b": "/models/b"})
+
+    def test_lazy_load_once(self):
+        # 测试首次使用时加载，之后复用同一实例；未配置的模型ID使用默认模型
+        self.assertEqual(self.pool.status("a"), "cold")
+        self.assertIs(self.pool.get("a"), self.pool.get("a"))
+        self.assertEqual(self.pool.status("a"), "resident")
+        self.assertIs(self.pool.get("unknown"), self.pool.get(None))
+        self.assertEqual(self.pool.loaded, ["/models/a", "/models/default"])
+
+    def test_evicts_least_recently_used(self):
+        # 测试超出内存预算时卸载最久未使用的模型
+        a = self.pool.get("a")
+        self.pool.get("b")
+        self.pool.get("a")
+        self.pool.get("c")
+        self.assertEqual(self.pool.status("b"), "cold")
+        self.assertEqual(self.pool.status("a"), "resident")
+        self.assertFalse(a.closed)
+        self.assertLessEqual(self.pool.total_bytes, 250 * MB)
+
+    def test_busy_models_are_not_evicted(self):
+        # 测试正在生成的模型不会被卸载
+        self.pool.get("a").busy = True
+        self.pool.get("b").busy = True
+        self.pool.get("c")
+        self.assertEqual([self.pool.status(model_id) for model_id in "abc"], ["resident"] * 3)
+
+    def test_leased_models_are_not_evicted(self):
+        # 测试持有租约（尚未提交生成）的模型不会被卸载，归还租约后才可卸载
+        a = self.pool.get("a", lease=True)
+        self.pool.get("b")
+        self.pool.get("c")
+        self.assertEqual(self.pool.status("a"), "resident")
+        self.assertEqual(self.pool.status("b"), "cold")
+        self.pool.release(a)
+        self.pool.get("b")
+        self.assertEqual(self.pool.status("a"), "cold")
+        self.assertTrue(a.closed)
+
+    def test_lease_context_releases(self):
+        # 测试lease上下文退出（包括异常退出）时归还租约
+        self.pool.get("a")
+
+        async def use():
+            async with self.pool.lease("a") as llm:
+                self.assertEqual(self.pool._entries["/models/a"].leases, 1)
+                raise ValueError(llm.path)
+
+        with self.assertRaises(ValueError):
+            asyncio.run(use())
+        self.assertEqual(self.pool._entries["/models/a"].leases, 0)
+
+    def test_aget_loads_cold_model_on_first_use(self):
+        # 测试未加载的模型在首次请求时加载，请求等待加载并预热完成后取得实例，并发请求共享一次加载
+        async def use():
+            return await asyncio.gather(self.pool.aget("a", lease=True), self.pool.aget("a"))
+
+        first, second = asyncio.run(use())
+        self.assertIs(first, second)
+        self.assertTrue(first.warmed_up)
+        self.assertEqual(self.pool.loaded, ["/models/a"])
+        self.assertEqual(self.pool._entries["/models/a"].leases, 1)
+
+    def test_aget_raises_load_error(self):
+        # 测试加载失败时请求收到加载错误，之后的请求重新加载
+        self.pool._load_model = mock.Mock(side_effect=[OSError("权重文件不存在"), FakeInference("/models/a")])
+        with self.assertRaises(OSError):
+            asyncio.run(self.pool.aget("a"))
+        self.assertEqual(self.pool.status("a"), "cold")
+        self.assertEqual(asyncio.run(self.pool.aget("a")).path, "/models/a")
+
+    def test_preloading_model_reports_loading(self):
+        # 测试启动时预加载的模型在加载完成前请求立即返回加载中，加载完成后可直接获取
+        release = threading.Event()
+        load_model = self.pool._load_model
+        self.pool._load_model = lambda path: release.wait(5) and load_model(path)
+        self.assertTrue(self.pool.load_in_background())
+        self.assertEqual(self.pool.status(), "loading")
+        with self.assertRaises(ModelLoadingError):
+            asyncio.run(self.pool.aget())
+        release.set()
+        deadline = time.monotonic() + 5
+        while self.pool.status() != "resident" and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(asyncio.run(self.pool.aget()).warmed_up)
+
+    def test_unmapped_ids_are_aliases_of_default(self):
+        # 测试未配置路径的模型ID是默认模型的别名，与默认模型共用同一实例和加载状态
+        self.assertFalse(self.pool.is_alias("a"))
+        self.assertTrue(self.pool.is_alias("unknown"))
+        self.pool.get("a")
+        self.assertEqual(self.pool.status("unknown"), "cold")
+        self.assertIs(self.pool.get("unknown"), self.pool.get(None))
+        self.assertEqual(self.pool.status("unknown"), "resident")
+        self.assertEqual(self.pool.status("b"), "cold")
+
+
+if __name__ == '__main__':
+    unittest.main()
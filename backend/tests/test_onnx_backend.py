@@ -0,0 +1,66 @@
+import importlib.util
+import tempfile
+import unittest
+import torch
+from app.models.scheduler import BatchScheduler, GenerationRequest
+from helpers import build_tokenizer, build_model
+
+ONNX_AVAILABLE = importlib.util.find_spec("onnxruntime") is not None and importlib.util.find_spec("onnx") is not None
+
+
+@unittest.skipUnless(ONNX_AVAILABLE, "需要安装onnx和onnxruntime")
+class TestOnnxBackend(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from app.models.onnx_backend import OnnxBackend, export_onnx
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.tokenizer = build_tokenizer()
+        cls.model = build_model(len(cls.tokenizer), seed=0)
+        cls.model.save_pretrained(cls.directory.name)
+        cls.tokenizer.save_pretrained(cls.directory.name)
+        cls.backend = OnnxBackend(export_onnx(cls.directory.name))
+        cls.prompts = [
+            cls.tokenizer.encode("User: 你好\nAssistant:", add_special_tokens=False),
+            cls.tokenizer.encode("User: 请介绍一下你自己\nAssistant:", add_special_tokens=False)
+        ]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def generate(self, model):
+        scheduler = BatchScheduler(model, self.tokenizer, max_batch_size=4)
+        try:
+            # 持有调度器的锁使两个请求在同一轮被接纳，以左填充的批次一起解码
+            with scheduler._cond:
+                requests = [scheduler.submit(GenerationRequest(prompt_ids, max_new_tokens=12, temperature=0))
+                            for prompt_ids in self.prompts]
+            return [request.result(timeout=60) for request in requests]
+        finally:
+            scheduler.stop()
+
+    def test_greedy_output_matches_torch(self):
+        # 测试ONNX后端经调度器批量解码的贪心输出与torch后端一致
+        self.assertEqual(self.generate(self.backend), self.generate(self.model))
+
+    def test_embeddings_unsupported(self):
+        # 测试ONNX后端声明不支持向量化（/embeddings据此返回501）
+        self.assertFalse(self.backend.supports_embeddings)
+        with self.assertRaises(NotImplementedError):
+            self.backend.embed(torch.tensor([self.prompts[0]]), torch.ones((1, len(self.prompts[0])), dtype=torch.long))
+
+    def test_forward_matches_torch(self):
+        # 测试预填充和接在KV之后的前向与torch模型的logits一致
+        input_ids = torch.tensor([self.prompts[0]])
+        logits, past = self.backend.prefill(input_ids)
+        with torch.no_grad():
+            expected = self.model(input_ids=input_ids, use_cache=True)
+        self.assertTrue(bool(torch.allclose(logits, expected.logits, atol=1e-4)))
+        logits, _ = self.backend.prefill(torch.tensor([[5, 6]]), past)
+        with torch.no_grad():
+            expected = self.model(input_ids=torch.tensor([[5, 6]]), past_key_values=expected.past_key_values, use_cache=True)
+        self.assertTrue(bool(torch.allclose(logits, expected.logits, atol=1e-4)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+from unittest import mock
+import torch
+from app.models import precision
+from app.models.precision import resolve_precision, load_dtype, apply_precision, model_size_bytes
+from helpers import build_tokenizer, build_model
+
+
+class TestResolvePrecision(unittest.TestCase):
+    def resolve(self, value, cuda=False, bf16=True, int8=True):
+        with mock.patch.object(torch.cuda, "is_available", return_value=cuda), \
+                mock.patch.object(precision, "cpu_supports_bf16", return_value=bf16), \
+                mock.patch.object(precision, "int8_supported", return_value=int8):
+            return resolve_precision(value)
+
+    def test_cpu(self):
+        # 测试CPU上各精度配置的解析，大小写和空值按auto处理
+        self.assertEqual(self.resolve(None), "fp32")
+        self.assertEqual(self.resolve("auto"), "fp32")
+        self.assertEqual(self.resolve("BF16"), "bf16")
+        self.assertEqual(self.resolve("int8"), "int8")
+
+    def test_cpu_fallbacks(self):
+        # 测试不支持或未知的精度回退到fp32
+        self.assertEqual(self.resolve("bf16", bf16=False), "fp32")
+        self.assertEqual(self.resolve("int8", int8=False), "fp32")
+        self.assertEqual(self.resolve("fp4"), "fp32")
+
+    def test_cuda(self):
+        # 测试CUDA上auto使用fp16，int8量化只支持CPU，回退到fp16
+        self.assertEqual(self.resolve("auto", cuda=True), "fp16")
+        self.assertEqual(self.resolve("bf16", cuda=True), "bf16")
+        with self.assertLogs("llm-backend", level="WARNING") as logs:
+            self.assertEqual(self.resolve("int8", cuda=True), "fp16")
+        self.assertIn("回退到fp16", logs.output[0])
+
+
+class TestApplyPrecision(unittest.TestCase):
+    def test_load_dtype(self):
+        # 测试加载权重的数据类型，int8先按fp32加载再量化
+        self.assertEqual(load_dtype("fp16"), torch.float16)
+        self.assertEqual(load_dtype("bf16"), torch.bfloat16)
+        self.assertEqual(load_dtype("fp32"), torch.float32)
+        self.assertEqual(load_dtype("int8"), torch.float32)
+
+    def test_fp32_unchanged(self):
+        model = build_model(300, seed=0)
+        self.assertIs(apply_precision(model, "fp32"), model)
+
+    @unittest.skipUnless(precision.int8_supported(), "当前torch不支持动态int8量化")
+    def test_int8_quantizes_linear_layers(self):
+        # 测试int8对全部Linear层做动态量化：权重占用变小，输出与fp32接近
+        tokenizer = build_tokenizer()
+        model = build_model(len(tokenizer), seed=0)
+        input_ids = torch.tensor([tokenizer.encode("User: 你好\nAssistant:")])
+        with torch.no_grad():
+            expected = model(input_ids).logits
+        fp32_bytes = model_size_bytes(model)
+        quantized = apply_precision(model, "int8")
+        linear_layers = [module for module in quantized.modules() if type(module) is torch.nn.Linear]
+        self.assertEqual(linear_layers, [])
+        self.assertTrue(any(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in quantized.modules()))
+        self.assertLess(model_size_bytes(quantized), fp32_bytes)
+        with torch.no_grad():
+            logits = quantized(input_ids).logits
+        self.assertTrue(torch.allclose(logits, expected, atol=0.05))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from app.models.schemas import ChatCompletionRequest, ChatMessage
+from app.services.response_cache import ResponseCache, cache_key, is_deterministic
+
+
+def make_request(content="你好", **kwargs):
+    return ChatCompletionRequest(messages=[ChatMessage(role="user", content=content)], **kwargs)
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.disk_path = os.path.join(self.temp_dir.name, "responses.db")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_only_deterministic_requests(self):
+        # 测试只有temperature为0的请求可以缓存
+        self.assertTrue(is_deterministic(make_request(temperature=0)))
+        self.assertFalse(is_deterministic(make_request(temperature=0.7)))
+
+    def test_key_depends_on_messages_and_params(self):
+        # 测试缓存键随消息、模型和采样参数变化
+        key = cache_key(make_request(temperature=0), 100)
+        self.assertEqual(key, cache_key(make_request(temperature=0), 100))
+        self.assertNotEqual(key, cache_key(make_request("再见", temperature=0), 100))
+        self.assertNotEqual(key, cache_key(make_request(temperature=0), 200))
+        self.assertNotEqual(key, cache_key(make_request(temperature=0, model="tiny"), 100))
+
+    def test_lru_eviction(self):
+        # 测试超出条数时淘汰最久未使用的响应
+        cache = ResponseCache(max_entries=2, ttl=60, disk_path="")
+        cache.put("a", {"text": "A"})
+        cache.put("b", {"text": "B"})
+        cache.get("a")
+        cache.put("c", {"text": "C"})
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), {"text": "A"})
+
+    def test_ttl_expiry(self):
+        # 测试过期的响应不会命中
+        cache = ResponseCache(max_entries=10, ttl=0, disk_path="")
+        cache.put("a", {"text": "A"})
+        time.sleep(0.01)
+        self.assertIsNone(cache.get("a"))
+
+    def test_disk_tier_survives_restart(self):
+        # 测试磁盘缓存在新实例中仍可命中
+        writer = ResponseCache(max_entries=10, ttl=60, disk_path=self.disk_path)
+        writer.put("a", {"text": "A"})
+        writer.flush()
+        cache = ResponseCache(max_entries=10, ttl=60, disk_path=self.disk_path)
+        self.assertEqual(cache.get("a"), {"text": "A"})
+        self.assertEqual(len(cache), 1)
+
+    def test_disk_io_runs_off_event_loop(self):
+        # 测试SQLite读写都在后台线程执行：put不等待落盘，aget内存未命中时在后台线程读取磁盘
+        writer = ResponseCache(max_entries=10, ttl=60, disk_path=self.disk_path)
+        cache = ResponseCache(max_entries=10, ttl=60, disk_path=self.disk_path)
+        threads = []
+        load, store = cache._load, writer._store
+        cache._load = lambda *args: threads.append(threading.current_thread()) or load(*args)
+        writer._store = lambda *args: threads.append(threading.current_thread()) or store(*args)
+
+        async def run():
+            writer.put("a", {"text": "A"})
+            writer.flush()
+            return await cache.aget("a"), await cache.aget("a"), await cache.aget("b")
+
+        self.assertEqual(asyncio.run(run()), ({"text": "A"}, {"text": "A"}, None))
+        # 第二次查询命中内存，不再读取磁盘
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(threading.main_thread(), threads)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+import torch
+from app.models.sampling import sample, sampling_probs
+from app.models.scheduler import GenerationRequest
+
+
+class TestSampling(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.logits = torch.randn(4, 50)
+
+    def test_mixed_parameters_in_one_batch(self):
+        # 测试同一批次中各行按自己的参数采样：贪心、top_k=1、top_p截断和普通采样互不影响
+        requests = [
+            GenerationRequest([1], temperature=0),
+            GenerationRequest([1], temperature=1.0, top_k=1),
+            GenerationRequest([1], temperature=0.5, top_p=0.3),
+            GenerationRequest([1], temperature=1.0, top_k=5),
+        ]
+        token_ids = sample(self.logits, requests)
+        argmax = self.logits.argmax(dim=-1).tolist()
+        self.assertEqual(token_ids[:2], argmax[:2])
+        probs = sampling_probs(self.logits, requests)
+        self.assertTrue(bool(torch.allclose(probs.sum(dim=-1), torch.ones(4))))
+        self.assertEqual(int((probs[3] > 0).sum()), 5)
+        self.assertIn(token_ids[3], self.logits[3].topk(5).indices.tolist())
+        expected = sampling_probs(self.logits[2:3], requests[2:3])[0]
+        self.assertTrue(bool(torch.allclose(probs[2], expected)))
+        self.assertGreater(float(probs[2][token_ids[2]]), 0)
+
+    def test_seed_is_reproducible(self):
+        # 测试相同seed的请求采样序列相同，且不受批次中其他行的影响
+        def draw(batch_size):
+            request = GenerationRequest([1], temperature=1.0, seed=42)
+            others = [GenerationRequest([1], temperature=1.0) for _ in range(batch_size - 1)]
+            return [sample(self.logits[:batch_size], [request] + others)[0] for _ in range(20)]
+        self.assertEqual(draw(1), draw(4))
+
+    def test_repetition_penalty_lowers_seen_tokens(self):
+        # 测试重复惩罚使已出现的token不再被贪心选中
+        top = int(self.logits[0].argmax())
+        request = GenerationRequest([top], temperature=0, repetition_penalty=1e6)
+        self.assertNotEqual(sample(self.logits[:1], [request])[0], top)
+        self.assertEqual(sample(self.logits[:1], [GenerationRequest([top], temperature=0)])[0], top)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+import asyncio
+import threading
+import time
+import unittest
+from app.models.scheduler import BatchScheduler, GenerationRequest, EmbeddingTask, QueueFullError
+from helpers import build_tokenizer, build_model
+
+
+class TestBatchScheduler(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = build_tokenizer()
+        cls.model = build_model(len(cls.tokenizer), seed=0)
+        cls.prompt_ids = cls.tokenizer.encode("User: 你好\nAssistant:", add_special_tokens=False)
+
+    def setUp(self):
+        self.scheduler = BatchScheduler(self.model, self.tokenizer, max_batch_size=4)
+        self.prefill_lengths = []
+        self.decode_batches = []
+        self.hook = self.model.register_forward_pre_hook(self.record_prefill, with_kwargs=True)
+
+    def tearDown(self):
+        self.hook.remove()
+        self.scheduler.stop()
+
+    def record_prefill(self, module, args, kwargs):
+        if kwargs["input_ids"].shape[1] > 1:
+            self.prefill_lengths.append(kwargs["input_ids"].shape[1])
+        else:
+            self.decode_batches.append(kwargs["input_ids"].shape[0])
+
+    def test_request_joins_running_batch(self):
+        # 测试解码过程中到达的请求在下一个解码步之前接纳，与正在解码的序列组成同一批次
+        expected = self.scheduler.submit(GenerationRequest(self.prompt_ids, max_new_tokens=40, temperature=0)).result(timeout=60)
+        self.decode_batches.clear()
+        first = self.scheduler.submit(GenerationRequest(self.prompt_ids, max_new_tokens=40, temperature=0))
+        tokens = first.iter_tokens()
+        for _ in range(3):
+            next(tokens)
+        second = self.scheduler.submit(GenerationRequest(self.prompt_ids, max_new_tokens=40, temperature=0))
+        self.assertEqual([first.result(timeout=60), second.result(timeout=60)], [expected] * 2)
+        self.assertEqual(self.decode_batches[0], 1)
+        self.assertIn(2, self.decode_batches)
+
+    def test_padded_batch_matches_single(self):
+        # 测试不同长度的提示词左填充后在同一批次中解码，贪心解码结果与逐个单独解码一致
+        prompts = [self.prompt_ids, self.tokenizer.encode("User: 请介绍一下你自己\nAssistant:", add_special_tokens=False)]
+        self.assertNotEqual(len(prompts[0]), len(prompts[1]))
+        expected = [
+            self.scheduler.submit(GenerationRequest(prompt_ids, max_new_tokens=20, temperature=0)).result(timeout=60)
+            for prompt_ids in prompts
+        ]
+        self.decode_batches.clear()
+        with self.scheduler._cond:
+            requests = [self.scheduler.submit(GenerationRequest(prompt_ids, max_new_tokens=20, temperature=0))
+                        for prompt_ids in prompts]
+        self.assertEqual([request.result(timeout=60) for request in requests], expected)
+        self.assertEqual(max(self.decode_batches), 2)
+
+    def test_finished_rows_released(self):
+        # 测试先结束的序列立即移出批次并归还KV块，其余序列继续解码
+        with self.scheduler._cond:
+            short = self.scheduler.submit(GenerationRequest(self.prompt_ids, max_new_tokens=5, temperature=0))
+            long = self.scheduler.submit(GenerationRequest(self.prompt_ids, max_new_tokens=30, temperature=0))
+        short.result(timeout=60)
+        self.assertEqual(short.finish_reason, "length")
+        long.result(timeout=60)
+        self.assertEqual(len(long.output_ids), 30)
+        # 两个序列各生成一个token后才进入解码步，短序列结束后批次只剩一行
+        self.assertEqual(self.decode_batches, [2] * 4 + [1] * 25)
+        # 结果在序列移出批次之前交付，稍等调度线程完成本步
+        deadline = time.monotonic() + 5
+        while self.scheduler.num_running and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.scheduler.num_running, 0)
+        self.assertEqual(self.scheduler.kv_cache.used_blocks, 0)
+
+    def collect_async(self, request: GenerationRequest, on_token=None) -> list:
+        """在事件循环中逐个接收token，返回 (token id, 接收时是否已生成结束) 列表"""
+        async def collect():
+            received = []
+            async for token_id in request.aiter_tokens():
+                received.append((token_id, request.done))
+                if on_token is not None:
+                    on_token(len(received))
+            return received
+
+        return asyncio.run(collect())
+
+    def test_async_tokens_arrive_while_decoding(self):
+        # 测试调度线程产生的token经call_soon_threadsafe逐个送达事件循环，解码仍在进行时已能收到第一个token
+        gate = threading.Event()
+
+        def wait_gate(module, args, kwargs):
+            if kwargs["input_ids"].shape[1] == 1:
+                gate.wait(60)
+
+        hook = self.model.register_forward_pre_hook(wait_gate, with_kwargs=True)
+        self.addCleanup(hook.remove)
+        self.addCleanup(gate.set)
+        request = self.scheduler.submit(GenerationRequest(self.prompt_ids, max_new_tokens=20, temperature=0))
+        # 第一个解码步等到事件循环收到预填充产生的token后才开始
+        received = self.collect_async(request, on_token=lambda count: gate.set())
+        self.assertFalse(received[0][1])
+        self.assertEqual([token_id for token_id, _ in received], request.output_ids)
+        self.assertEqual(len(received), 20)
+        self.assertEqual(request.finish_reason, "length")
+
+    def test_async_stream_ends_on_cancel(self):
+        # 测试事件循环中取消请求后流在下一个解码步结束，已收到的token与生成结果一致
+        request = self.scheduler.submit(GenerationRequest(self.prompt_ids, max_new_tokens=200, temperature=0))
+        received = self.collect_async(request, on_token=lambda count: count == 3 and request.cancel())
+        self.assertEqual(request.finish_reason, "cancelled")
+        self.assertLess(len(received), 200)
+        self.assertEqual([token_id for token_id, _ in received], request.output_ids)
+
+    def test_async_stream_after_finish(self):
+        # 测试绑定事件循环之前已产生的token迁移到异步队列，生成已结束时流照常结束
+        request = self.scheduler.submit(GenerationRequest(self.prompt_ids, max_new_tokens=10, temperature=0))
+        output_ids = request.result(timeout=60)
+        self.assertEqual([token_id for token_id, _ in self.collect_async(request)], output_ids)
+
+    def test_forks_share_one_prefill(self):
+        # 测试n个候选只做一次预填充，贪心解码时各候选与单独生成的结果一致
+        expected = self.scheduler.submit(GenerationRequest(self.prompt_ids, max_new_tokens=10, temperature=0)).result(timeout=60)
+        request = GenerationRequest(self.prompt_ids, max_new_tokens=10, temperature=0)
+        request.fork()
+        request.fork()
+        self.scheduler.submit(request)
+        outputs = [member.result(timeout=60) for member in request.group]
+        self.assertEqual(outputs, [expected] * 3)
+        self.assertEqual(len(self.prefill_lengths), 2)
+        self.assertLess(request.mean_logprob, 0)
+
+    def test_background_requests_prefill_together(self):
+        # 测试后台请求一次前向批量预填充，贪心解码时与逐个生成的结果一致
+        prompts = [self.prompt_ids, self.tokenizer.encode("User: 请介绍一下你自己\nAssistant:", add_special_tokens=False)]
+        expected = [
+            self.scheduler.submit(GenerationRequest(prompt_ids, max_new_tokens=10, temperature=0)).result(timeout=60)
+            for prompt_ids in prompts
+        ]
+        self.prefill_lengths.clear()
+        with self.scheduler._cond:
+            # 持有锁保证两个请求在同一轮被接纳
+            requests = [
+                self.scheduler.submit(GenerationRequest(prompt_ids, max_new_tokens=10, temperature=0, low_priority=True))
+                for prompt_ids in prompts
+            ]
+        self.assertEqual([request.result(timeout=60) for request in requests], expected)
+        self.assertEqual(self.prefill_lengths, [max(len(prompt_ids) for prompt_ids in prompts)])
+
+    def test_shared_prefix_prefilled_once(self):
+        # 测试以相同固定前缀开头的请求只预填充前缀之后的部分，贪心解码结果与完整预填充一致
+        prefix_ids = self.tokenizer.encode("System: 你是一个助手\n", add_special_tokens=False)
+        prompts = [prefix_ids + self.prompt_ids, prefix_ids + self.tokenizer.encode("User: 请介绍一下你自己\nAssistant:", add_special_tokens=False)]
+        expected = [
+            self.scheduler.submit(GenerationRequest(prompt_ids, max_new_tokens=10, temperature=0)).result(timeout=60)
+            for prompt_ids in prompts
+        ]
+        self.prefill_lengths.clear()
+        outputs = [
+            self.scheduler.submit(GenerationRequest(prompt_ids, max_new_tokens=10, temperature=0, prefix_len=len(prefix_ids))).result(timeout=60)
+            for prompt_ids in prompts
+        ]
+        self.assertEqual(outputs, expected)
+        self.assertEqual(self.prefill_lengths, [len(prompts[0]), len(prompts[1]) - len(prefix_ids)])
+        self.assertEqual(len(self.scheduler.prefix_cache), 1)
+
+        # 后台请求共享同一前缀时一次前向批量预填充各自的后缀
+        self.prefill_lengths.clear()
+        with self.scheduler._cond:
+            requests = [
+                self.scheduler.submit(GenerationRequest(prompt_ids, max_new_tokens=10, temperature=0, low_priority=True,
+                                                        prefix_len=len(prefix_ids)))
+                for prompt_ids in prompts
+            ]
+        self.assertEqual([request.result(timeout=60) for request in requests], expected)
+        self.assertEqual(self.prefill_lengths, [max(len(prompt_ids) for prompt_ids in prompts) - len(prefix_ids)])
+
+    def test_embeddings_batched_match_single(self):
+        # 测试不同长度的文本合批计算的向量与单独计算一致，且为单位向量
+        long_ids = self.tokenizer.encode("User: 请介绍一下你自己\nAssistant:", add_special_tokens=False)
+        single = self.scheduler.submit_embedding(EmbeddingTask(self.prompt_ids)).result(timeout=60)
+        with self.scheduler._cond:
+            tasks = [self.scheduler.submit_embedding(EmbeddingTask(ids)) for ids in (self.prompt_ids, long_ids)]
+        batched = [task.result(timeout=60) for task in tasks]
+        for a, b in zip(single, batched[0]):
+            self.assertAlmostEqual(a, b, places=5)
+        self.assertAlmostEqual(sum(x * x for x in batched[1]), 1.0, places=5)
+        self.assertEqual(len(self.prefill_lengths), 0)
+
+    def test_embedding_queue_bounded_and_cancellable(self):
+        # 测试向量化队列超出上限时整个请求被拒绝（队列为空时总是接纳），已取消的任务不再计算
+        scheduler = BatchScheduler(self.model, self.tokenizer, max_queue_size=1, embedding_batch_size=2)
+        try:
+            with scheduler._cond:
+                tasks = scheduler.submit_embeddings([EmbeddingTask(self.prompt_ids) for _ in range(4)])
+                with self.assertRaises(QueueFullError):
+                    scheduler.submit_embeddings([EmbeddingTask(self.prompt_ids)])
+                tasks[0].cancel()
+            results = [task.result(timeout=60) for task in tasks]
+        finally:
+            scheduler.stop()
+        self.assertEqual(tasks[0].finish_reason, "cancelled")
+        self.assertIsNone(results[0])
+        self.assertTrue(all(task.finish_reason == "stop" for task in tasks[1:]))
+
+    def test_stop_sequence_halts_decoding(self):
+        # 测试生成的文本出现停止序列时立即停止，而不是生成到max_new_tokens
+        expected = self.scheduler.submit(GenerationRequest(self.prompt_ids, max_new_tokens=30, temperature=0)).result(timeout=60)
+        text = self.tokenizer.decode(expected, skip_special_tokens=True)
+        stop = text[len(text) // 2:len(text) // 2 + 2]
+        request = self.scheduler.submit(GenerationRequest(self.prompt_ids, max_new_tokens=30, temperature=0, stop=[stop]))
+        output_ids = request.result(timeout=60)
+        self.assertEqual(request.finish_reason, "stop")
+        self.assertLess(len(output_ids), len(expected))
+        self.assertEqual(output_ids, expected[:len(output_ids)])
+        self.assertIn(stop, self.tokenizer.decode(output_ids, skip_special_tokens=True))
+
+    def test_small_kv_pool_defers_admission(self):
+        # 测试KV块不足时推迟接纳新请求，块归还后继续处理且结果不变，结束后块全部归还
+        expected = self.scheduler.submit(GenerationRequest(self.prompt_ids, max_new_tokens=10, temperature=0)).result(timeout=60)
+        # 内存池只够容纳一个请求的KV
+        kv_cache = self.scheduler.kv_cache
+        blocks = self.scheduler._blocks_needed(GenerationRequest(self.prompt_ids, max_new_tokens=10))
+        block_bytes = kv_cache.nbytes // kv_cache.num_blocks
+        self.scheduler.stop()
+        self.scheduler = BatchScheduler(self.model, self.tokenizer, max_batch_size=4, kv_cache_bytes=block_bytes * blocks)
+        self.assertEqual(self.scheduler.kv_cache.num_blocks, blocks)
+        with self.scheduler._cond:
+            requests = [
+                self.scheduler.submit(GenerationRequest(self.prompt_ids, max_new_tokens=10, temperature=0))
+                for _ in range(3)
+            ]
+        self.assertEqual([request.result(timeout=60) for request in requests], [expected] * 3)
+        self.assertEqual(len(self.prefill_lengths), 4)
+        self.assertEqual(self.scheduler.kv_cache.used_blocks, 0)
+
+    def test_cancel_stops_whole_group(self):
+        # 测试取消请求时兄弟请求一并停止
+        request = GenerationRequest(self.prompt_ids, max_new_tokens=200, temperature=1.0)
+        request.fork()
+        request.cancel()
+        self.scheduler.submit(request)
+        for member in request.group:
+            member.result(timeout=60)
+            self.assertEqual(member.finish_reason, "cancelled")
+
+
+if __name__ == '__main__':
+    unittest.main()
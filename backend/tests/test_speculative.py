@@ -0,0 +1,57 @@
+import unittest
+from app.models.kv_cache import SessionKVCache
+from app.models.scheduler import BatchScheduler, GenerationRequest
+from helpers import build_tokenizer, build_model
+
+
+class TestSpeculativeDecoding(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = build_tokenizer()
+        cls.model = build_model(len(cls.tokenizer), seed=0)
+        cls.draft_model = build_model(len(cls.tokenizer), seed=1)
+        cls.prompt_ids = cls.tokenizer.encode("User: 你好\nAssistant:", add_special_tokens=False)
+
+    def generate(self, draft_model=None):
+        scheduler = BatchScheduler(self.model, self.tokenizer, max_batch_size=1, draft_model=draft_model,
+                                   num_speculative_tokens=3)
+        try:
+            request = scheduler.submit(GenerationRequest(self.prompt_ids, max_new_tokens=30, temperature=0))
+            return request.result(timeout=60), scheduler
+        finally:
+            scheduler.stop()
+
+    def test_greedy_output_unchanged(self):
+        # 测试贪心解码时推测解码的输出与只用主模型一致
+        expected, _ = self.generate()
+        output, scheduler = self.generate(self.draft_model)
+        self.assertEqual(output, expected)
+        self.assertGreater(scheduler.draft_tokens, 0)
+
+    def test_same_model_accepts_all(self):
+        # 测试草稿模型与主模型相同时全部草稿token被接受
+        _, scheduler = self.generate(self.model)
+        self.assertEqual(scheduler.acceptance_rate, 1.0)
+
+    def test_session_cache_after_early_stop(self):
+        # 测试推测解码在停止序列处提前结束（KV比已输出的token多）时，会话KV仍按已输出的token保存
+        expected, _ = self.generate()
+        stop = self.tokenizer.decode(expected[:3])[-2:]
+        session_cache = SessionKVCache(max_bytes=16 * 1024 * 1024)
+        scheduler = BatchScheduler(self.model, self.tokenizer, max_batch_size=1, draft_model=self.model,
+                                   num_speculative_tokens=3, session_cache=session_cache)
+        try:
+            request = scheduler.submit(GenerationRequest(self.prompt_ids, max_new_tokens=30, temperature=0,
+                                                         session_id="s1", stop=[stop]))
+            request.result(timeout=60)
+        finally:
+            scheduler.stop()
+        self.assertEqual(request.finish_reason, "stop")
+        entry = session_cache._entries.get("s1")
+        self.assertIsNotNone(entry)
+        self.assertEqual(entry.past[0][0].shape[2], len(entry.token_ids))
+        self.assertEqual(entry.token_ids, (self.prompt_ids + request.output_ids)[:len(entry.token_ids)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+from app.models.stopping import StopMatcher, stop_sequences, truncate_at_stop
+
+
+class TestStopMatcher(unittest.TestCase):
+    def test_holds_back_partial_stop_sequence(self):
+        # 测试停止序列被拆成多段生成时，开头部分先暂存，匹配后不输出停止序列
+        matcher = StopMatcher(["\nUser:"])
+        output = [matcher.push(text) for text in ["你好", "！\n", "Us", "er: 再见"]]
+        self.assertEqual(output, ["你好", "！", "", ""])
+        self.assertTrue(matcher.stopped)
+        self.assertEqual(matcher.flush(), "")
+
+    def test_flush_outputs_held_text_without_stop(self):
+        # 测试没有遇到停止序列时，结束时输出暂存的文本
+        matcher = StopMatcher(["END"])
+        self.assertEqual(matcher.push("the EN"), "the ")
+        self.assertEqual(matcher.push("D"), "")
+        matcher = StopMatcher(["END"])
+        self.assertEqual(matcher.push("the EN") + matcher.push("ding") + matcher.flush(), "the ENding")
+        self.assertFalse(matcher.stopped)
+
+    def test_stop_sequences_include_turn_boundary(self):
+        # 测试请求的停止序列与轮次边界合并去重，并按最早出现的序列截断
+        self.assertEqual(stop_sequences("###"), ["###", "\nUser:", "\nAssistant:"])
+        self.assertEqual(stop_sequences(["\nUser:", ""]), ["\nUser:", "\nAssistant:"])
+        self.assertEqual(truncate_at_stop("好的\nUser: 嗯###", stop_sequences("###")), "好的")
+
+
+if __name__ == '__main__':
+    unittest.main()
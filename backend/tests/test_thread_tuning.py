@@ -0,0 +1,37 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from app.config import settings
+from app.models.thread_tuning import ThreadAutotuner, candidate_configs, parse_cores
+from app.models.backends import TorchBackend
+from helpers import build_tokenizer, build_model
+
+
+class TestThreadTuning(unittest.TestCase):
+    def test_candidate_configs(self):
+        # 测试候选配置覆盖全部核、留一个核、一半的核，线程数少于核数时另测绑核
+        configs = candidate_configs([0, 1, 2, 3])
+        self.assertEqual([config["threads"] for config in configs], [4, 3, 3, 2, 2])
+        self.assertIn({"threads": 2, "cores": [0, 1]}, configs)
+        self.assertEqual(candidate_configs([5]), [{"threads": 1, "cores": None}])
+        self.assertEqual(parse_cores("0-2, 6,1"), [0, 1, 2, 6])
+
+    def test_result_is_saved_and_reused(self):
+        # 测试调优结果写入文件，之后启动时直接使用而不再测量
+        tokenizer = build_tokenizer()
+        backend = TorchBackend(build_model(len(tokenizer), seed=0), tokenizer)
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(settings, "THREAD_AUTOTUNE", True):
+            tuner = ThreadAutotuner(path=os.path.join(directory, "tuning.json"), prompt_tokens=16, decode_tokens=4)
+            config = tuner.configure(backend, "model")
+            self.assertEqual(config["source"], "autotune")
+            self.assertGreater(config["tokens_per_second"], 0)
+            with mock.patch.object(tuner, "tune") as tune:
+                saved = tuner.configure(backend, "model")
+                tune.assert_not_called()
+            self.assertEqual(saved["source"], "saved")
+            self.assertEqual(saved["threads"], config["threads"])
+
+
+if __name__ == '__main__':
+    unittest.main()
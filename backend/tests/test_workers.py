@@ -0,0 +1,126 @@
+import asyncio
+import contextlib
+import tempfile
+import time
+import unittest
+from unittest import mock
+from fastapi import HTTPException
+from app.config import settings
+from app.models.inference import LLMInference
+from app.models.scheduler import QueueFullError
+from app.models.schemas import ChatMessage, ChatCompletionRequest
+from app.models.workers import WorkerPoolInference
+from app.services import chat_service as chat_service_module
+from helpers import build_tokenizer, build_model
+
+MESSAGES = [ChatMessage(role="user", content="你好")]
+
+
+def wait_until(condition, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("等待超时")
+        time.sleep(0.05)
+
+
+class TestWorkerPoolInference(unittest.TestCase):
+    """启动两个真实的推理进程，加载保存到临时目录的小模型"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        tokenizer = build_tokenizer()
+        build_model(len(tokenizer), seed=0).save_pretrained(cls.directory.name)
+        tokenizer.save_pretrained(cls.directory.name)
+        cls.settings = mock.patch.multiple(settings, WORKER_CHECK_INTERVAL=0.1, WORKER_START_TIMEOUT=300)
+        cls.settings.start()
+        cls.pool = WorkerPoolInference(cls.directory.name, "", num_workers=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+        cls.settings.stop()
+        cls.directory.cleanup()
+
+    def test_dispatch_matches_in_process_inference(self):
+        llm = LLMInference(self.directory.name, "")
+        try:
+            expected = llm.submit(MESSAGES, max_new_tokens=20, temperature=0).result(timeout=60)
+        finally:
+            llm.close()
+        requests = [self.pool.submit(MESSAGES, max_new_tokens=20, temperature=0) for _ in range(4)]
+        for request in requests:
+            self.assertEqual(request.result(timeout=60), expected)
+        self.assertEqual(self.pool.precision, llm.precision)
+        self.assertFalse(self.pool.compiled)
+        wait_until(lambda: not self.pool.busy)
+
+    def test_cancel_stops_generation_in_worker(self):
+        request = self.pool.submit(MESSAGES, max_new_tokens=200, temperature=0)
+        next(request.iter_tokens())
+        request.cancel()
+        request.result(timeout=60)
+        self.assertEqual(request.finish_reason, "cancelled")
+        self.assertLess(len(request.output_ids), 200)
+        wait_until(lambda: not self.pool.busy)
+
+    @contextlib.contextmanager
+    def flooded(self):
+        """放大API进程的容量估计并提交超出推理进程队列容量的请求，使之后的请求由推理进程的调度器拒绝
+
+        贪心解码这条提示词不会提前生成结束符，请求在取消前一直占用队列。
+        """
+        with mock.patch.object(self.pool, "capacity", self.pool.capacity * 10):
+            requests = [self.pool.submit(MESSAGES, max_new_tokens=200, temperature=0)
+                        for _ in range(2 * (settings.MAX_BATCH_SIZE + settings.INFERENCE_QUEUE_SIZE) + 20)]
+            try:
+                yield requests
+            finally:
+                for request in requests:
+                    request.cancel()
+        wait_until(lambda: not self.pool.busy)
+
+    def test_worker_rejection_maps_to_queue_full(self):
+        with self.flooded() as requests:
+            wait_until(lambda: any(request.error is not None for request in requests))
+            rejected = [request for request in requests if request.error is not None]
+            self.assertTrue(rejected)
+            for request in rejected:
+                with self.assertRaises(QueueFullError):
+                    request.result()
+
+    def test_worker_rejection_returns_503(self):
+        @contextlib.asynccontextmanager
+        async def lease(model_id):
+            yield self.pool
+
+        request = ChatCompletionRequest(model="test", messages=MESSAGES, max_tokens=20, temperature=0.7)
+        with self.flooded(), mock.patch.object(chat_service_module.model_pool, "lease", lease):
+            with self.assertRaises(HTTPException) as context:
+                asyncio.run(chat_service_module.ChatService().generate_completion(request))
+        self.assertEqual(context.exception.status_code, 503)
+
+    def test_worker_death_restarts_and_routes_after_ready(self):
+        worker = self.pool._workers[0]
+        request = self.pool.submit(MESSAGES, max_new_tokens=200, temperature=0)
+        next(request.iter_tokens())
+        for member_worker in self.pool._workers:
+            if request.request_id in member_worker.inflight:
+                worker = member_worker
+        worker.process.kill()
+        with self.assertRaises(RuntimeError):
+            request.result(timeout=60)
+
+        wait_until(lambda: self.pool._workers[worker.index] is not worker)
+        restarted = self.pool._workers[worker.index]
+        if not restarted.ready:
+            # 重启中的进程仍在加载模型，请求只分派给其他进程
+            with self.pool._lock:
+                self.assertIsNot(self.pool._select_worker(), restarted)
+        wait_until(lambda: restarted.ready)
+        self.assertTrue(self.pool.submit(MESSAGES, max_new_tokens=5, temperature=0).result(timeout=60))
+
+
+if __name__ == "__main__":
+    unittest.main()